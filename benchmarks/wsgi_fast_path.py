@@ -0,0 +1,145 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+"""
+Compare the requests per second served by Django's WSGI application with
+those served by the HTCPCP fast path of django_htcpcp_tea.wsgi.
+
+Requests are passed to the WSGI applications directly, without a server, so
+only the time spent by Django and this app is measured. Run from the root of
+the repository:
+
+    python benchmarks/wsgi_fast_path.py [--requests N]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import django
+from django.conf import settings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+settings.configure(
+    DEBUG=False,
+    SECRET_KEY="benchmark",
+    ALLOWED_HOSTS=["testserver"],
+    INSTALLED_APPS=[
+        "django.contrib.admin",
+        "django.contrib.auth",
+        "django.contrib.contenttypes",
+        "django.contrib.sessions",
+        "django.contrib.messages",
+        "django_htcpcp_tea",
+    ],
+    # A typical middleware stack of a Django project.
+    MIDDLEWARE=[
+        "django.middleware.security.SecurityMiddleware",
+        "django.contrib.sessions.middleware.SessionMiddleware",
+        "django.middleware.common.CommonMiddleware",
+        "django.middleware.csrf.CsrfViewMiddleware",
+        "django.contrib.auth.middleware.AuthenticationMiddleware",
+        "django.contrib.messages.middleware.MessageMiddleware",
+        "django.middleware.clickjacking.XFrameOptionsMiddleware",
+        "django_htcpcp_tea.middleware.HTCPCPTeaMiddleware",
+    ],
+    ROOT_URLCONF=__name__,
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+    TEMPLATES=[
+        {
+            "BACKEND": "django.template.backends.django.DjangoTemplates",
+            "APP_DIRS": True,
+            "OPTIONS": {
+                "context_processors": [
+                    "django.contrib.auth.context_processors.auth",
+                    "django.contrib.messages.context_processors.messages",
+                ]
+            },
+        }
+    ],
+    HTCPCP_POT_SESSIONS=False,
+    HTCPCP_CATALOG_SNAPSHOT=True,
+)
+django.setup()
+
+from django.core.management import call_command  # noqa: E402
+from django.core.wsgi import get_wsgi_application  # noqa: E402
+from django.test.client import RequestFactory  # noqa: E402
+from django.urls import include, path  # noqa: E402
+
+from django_htcpcp_tea.wsgi import HTCPCPTeaWSGIHandler  # noqa: E402
+
+urlpatterns = [path("", include("django_htcpcp_tea.urls"))]
+
+SCENARIOS = [
+    ("BREW coffee", "/pot-4/", "message/coffeepot", "start"),
+    ("BREW tea", "/pot-4/earl-grey/", "message/teapot", "start"),
+    ("BREW teapot (418)", "/pot-3/", "message/coffeepot", "start"),
+    ("WHEN", "/pot-4/", "message/coffeepot", "stop"),
+]
+
+
+def measure(application, path, content_type, body, requests):
+    """
+    Return the requests per second served by the WSGI application, and the
+    status of its responses.
+    """
+    factory = RequestFactory()
+    method = "WHEN" if body == "stop" else "BREW"
+    statuses = set()
+
+    def start_response(status, headers, exc_info=None):
+        statuses.add(status)
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        environ = factory.generic(method, path, body, content_type=content_type).environ
+        result = application(environ, start_response)
+        b"".join(result)
+        result.close()
+    elapsed = time.perf_counter() - started
+    (status,) = statuses
+    return requests / elapsed, status
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    call_command("migrate", verbosity=0)
+    call_command(
+        "loaddata", "demo_pots", "rfc_2324_additions", "rfc_7168_teas", verbosity=0
+    )
+
+    django_application = get_wsgi_application()
+    fast_path = HTCPCPTeaWSGIHandler(django_application)
+
+    print(
+        "{:<20} {:<18} {:>12} {:>12} {:>8}".format(
+            "", "Status", "Django", "Fast path", "Ratio"
+        )
+    )
+    for name, path, content_type, body in SCENARIOS:
+        # Warm up the caches of both applications before measuring
+        for application in (django_application, fast_path):
+            measure(application, path, content_type, body, 50)
+        standard, status = measure(
+            django_application, path, content_type, body, args.requests
+        )
+        fast, fast_status = measure(fast_path, path, content_type, body, args.requests)
+        assert status == fast_status, (status, fast_status)
+        print(
+            "{:<20} {:<18} {:>10.0f}/s {:>10.0f}/s {:>7.2f}x".format(
+                name, status, standard, fast, fast / standard
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
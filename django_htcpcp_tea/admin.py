@@ -39,16 +39,6 @@ class RelatedItemsExistsListFilter(admin.SimpleListFilter):
             return queryset.filter(**{lookup_param: True})
 
 
-class BrewTeaListFilter(RelatedItemsExistsListFilter):
-    """Admin list filter for whether a pots serves any teas."""
-
-    title = "able to brew tea"
-
-    parameter_name = "brew_tea"
-
-    related_item_field = "supported_teas"
-
-
 class ServedByAPotListFilter(RelatedItemsExistsListFilter):
     """Admin list filter for whether an object is served by a pot."""
 
@@ -88,7 +78,7 @@ class PotAdmin(admin.ModelAdmin):
 
     list_filter = (
         "brew_coffee",
-        BrewTeaListFilter,
+        "tea_capable",
         ("supported_teas", admin.RelatedOnlyFieldListFilter),
     )
 
@@ -100,7 +90,7 @@ class PotAdmin(admin.ModelAdmin):
 
     tea_capable_view.boolean = True
     tea_capable_view.short_description = "able to brew tea"
-    tea_capable_view.admin_order_field = "supported_teas"
+    tea_capable_view.admin_order_field = "tea_capable"
 
     def tea_count_view(self, obj):
         "Display the number of tea types that the given pot supports."
@@ -116,12 +106,6 @@ class PotAdmin(admin.ModelAdmin):
     addition_count_view.admin_order_field = "addition_count"
     addition_count_view.short_description = "supported additions"
 
-    def get_queryset(self, request):
-        queryset = super().get_queryset(request)
-        queryset = queryset.prefetch_related("supported_teas")
-        queryset = queryset.prefetch_related("supported_additions")
-        return queryset.with_tea_count().with_addition_count()
-
 
 class PotsServingMixin:
     """
@@ -10,3 +10,7 @@ from django.apps import AppConfig
 class HTCPCPTeaConfig(AppConfig):
     name = "django_htcpcp_tea"
     verbose_name = "HTCPCP-TEA Server"
+
+    def ready(self):
+        # Connect the signal receivers that invalidate the catalog snapshot.
+        from . import catalog  # noqa: F401
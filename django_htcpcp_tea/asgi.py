@@ -0,0 +1,336 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+"""
+ASGI entry point for projects serving HTCPCP requests.
+
+Django 2 can only be served over WSGI, so the ASGI application wraps the
+project's WSGI application. The bodies of HTCPCP requests and of complete
+responses are exchanged with clients on the event loop, and only the handling
+of complete requests by Django (including ``HTCPCPTeaMiddleware`` and the
+``brew_pot`` view) is run in a pool of worker threads. Slow HTCPCP clients
+therefore hold an idle connection instead of a worker thread.
+
+The bodies of other requests are not held in memory: they are received as the
+worker reads them, or spooled to a temporary file if their length is unknown.
+Streaming responses are sent as they are generated.
+"""
+
+import asyncio
+import itertools
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+
+from .middleware import HTCPCPTeaMiddleware
+from .settings import htcpcp_settings
+
+
+class HTCPCPTeaASGIHandler:
+    """
+    ASGI 3 application that serves HTTP requests with a Django WSGI
+    application run in a thread pool.
+
+    Requests that cannot be HTCPCP requests are passed to ``application``,
+    an optional ASGI application for the rest of the project, if one is given.
+    Only as much of the body of an HTCPCP request is read from the client as
+    the ``MAX_REQUEST_BODY`` setting allows, so that ``HTCPCPTeaMiddleware``
+    can reject oversized bodies without the rest being received. The bodies
+    of other requests are passed to the WSGI application as a stream.
+    """
+
+    def __init__(self, wsgi_application, application=None, max_workers=None):
+        self.wsgi_application = wsgi_application
+        self.application = application
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="htcpcp-tea"
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._handle_lifespan(scope, receive, send)
+            return
+
+        if scope["type"] != "http":
+            if self.application is None:
+                raise ValueError(
+                    "Unsupported ASGI scope type {!r}".format(scope["type"])
+                )
+            await self.application(scope, receive, send)
+            return
+
+        headers = _decode_headers(scope)
+        content_type = headers.get("content-type", "").split(";")[0].strip()
+        may_be_htcpcp = HTCPCPTeaMiddleware(None)._may_be_htcpcp(
+            scope["method"], content_type, _get_path_info(scope)
+        )
+        if not may_be_htcpcp and self.application is not None:
+            await self.application(scope, receive, send)
+            return
+
+        loop = asyncio.get_running_loop()
+        if may_be_htcpcp and content_type in HTCPCPTeaMiddleware.HTCPCP_MIME_TYPES:
+            body = await _read_body(receive, htcpcp_settings.MAX_REQUEST_BODY)
+            if body is None:
+                return  # The client disconnected
+            environ = _build_environ(scope, headers, BytesIO(body), len(body))
+        elif "content-length" in headers:
+            environ = _build_environ(scope, headers, _ReceivedBody(receive, loop))
+        else:
+            # WSGI applications can only read bodies of a known length.
+            body, length = await _spool_body(receive)
+            if body is None:
+                return
+            environ = _build_environ(scope, headers, body, length)
+
+        response = await loop.run_in_executor(
+            self.executor, self._get_response, environ, send, loop
+        )
+        if response is not None:
+            status, response_headers, content = response
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": response_headers,
+                }
+            )
+            await send({"type": "http.response.body", "body": content})
+
+    def _get_response(self, environ, send, loop):
+        """
+        Return the status code, headers, and content of the response of the
+        WSGI application to the given request.
+
+        Streaming responses are instead sent to the client from the worker
+        thread as they are generated, and None is returned. Either way, the
+        response is consumed and closed in the worker thread, so that the
+        database connections of the thread are cleaned up by Django.
+        """
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = status, headers
+
+        def send_threadsafe(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            if not getattr(result, "streaming", True):
+                content = b"".join(result)
+                return _encode_start(*started) + (content,)
+
+            chunks = iter(result)
+            # WSGI applications may start the response on the first chunk.
+            first_chunk = next(chunks, b"")
+            status, headers = _encode_start(*started)
+            send_threadsafe(
+                {"type": "http.response.start", "status": status, "headers": headers}
+            )
+            for chunk in itertools.chain([first_chunk], chunks):
+                if chunk:
+                    send_threadsafe(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+            send_threadsafe({"type": "http.response.body", "body": b""})
+            return None
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    async def _handle_lifespan(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+class _ReceivedBody:
+    """
+    File-like body of a request that is received from the client as a worker
+    thread reads it.
+
+    Each message is only received once the previous one has been read, so at
+    most one chunk of the body is held in memory.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b""
+        self._more_body = True
+
+    def read(self, size=-1):
+        chunks = []
+        while size:
+            if not self._buffer:
+                if not self._more_body:
+                    break
+                message = asyncio.run_coroutine_threadsafe(
+                    self._receive(), self._loop
+                ).result()
+                if message["type"] == "http.disconnect":
+                    raise OSError("The client disconnected")
+                self._buffer = message.get("body", b"")
+                self._more_body = message.get("more_body", False)
+                continue
+            if size < 0:
+                chunk, self._buffer = self._buffer, b""
+            else:
+                chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+                size -= len(chunk)
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+
+def _encode_start(status, headers):
+    """Return the ASGI status code and headers of a WSGI response."""
+    return (
+        int(status.split(" ", 1)[0]),
+        [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in headers
+        ],
+    )
+
+
+async def _spool_body(receive):
+    """
+    Return a file containing the body of the request received from the
+    client, and its length, or (None, None) if the client disconnected.
+
+    The body is kept in memory up to the ``FILE_UPLOAD_MAX_MEMORY_SIZE``
+    setting, and written to disk beyond it.
+    """
+    body = tempfile.SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, mode="w+b"
+    )
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.close()
+            return None, None
+        body.write(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    length = body.tell()
+    body.seek(0)
+    return body, length
+
+
+async def _read_body(receive, limit=None):
+    """
+    Return the body of the request received from the client, or None if the
+    client disconnected.
+
+    If ``limit`` is given, stop reading once more than that many bytes were
+    received.
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        chunks.append(chunk)
+        size += len(chunk)
+        if limit is not None and size > limit:
+            break
+        if not message.get("more_body", False):
+            break
+    return b"".join(chunks)
+
+
+def _decode_headers(scope):
+    """
+    Return the headers of the request as a dictionary from lowercase names to
+    values, joining repeated headers with commas, or repeated cookie headers
+    (as sent by HTTP/2 clients) with semicolons.
+    """
+    headers = {}
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").lower()
+        value = value.decode("latin-1")
+        if name in headers:
+            separator = "; " if name == "cookie" else ","
+            value = headers[name] + separator + value
+        headers[name] = value
+    return headers
+
+
+def _get_path_info(scope):
+    """Return the path of the request relative to the root of the project."""
+    script_name = scope.get("root_path", "")
+    path_info = scope["path"]
+    if script_name and path_info.startswith(script_name):
+        path_info = path_info[len(script_name) :]
+    return path_info
+
+
+def _build_environ(scope, headers, body, content_length=None):
+    """
+    Return the WSGI environ of the request described by the ASGI scope, whose
+    body is read from the given file.
+    """
+    script_name = scope.get("root_path", "")
+    path_info = _get_path_info(scope)
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        # WSGI paths are strings of the bytes of the path decoded as latin-1
+        "SCRIPT_NAME": script_name.encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path_info.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": "HTTP/{}".format(scope.get("http_version", "1.1")),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+        environ["REMOTE_PORT"] = str(scope["client"][1])
+    for name, value in headers.items():
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            environ["HTTP_" + name.upper().replace("-", "_")] = value
+    # Chunked request bodies have been read in full, or up to the limit of
+    # HTCPCP request bodies, so their length is known.
+    if content_length is not None:
+        environ.setdefault("CONTENT_LENGTH", str(content_length))
+    return environ
+
+
+def get_asgi_application(application=None, max_workers=None):
+    """
+    Set up Django and return an ASGI application serving the project's WSGI
+    application in a pool of at most ``max_workers`` threads.
+
+    If ``application`` is given, requests that cannot be HTCPCP requests, and
+    connections other than HTTP requests, are passed to that ASGI application
+    instead.
+    """
+    return HTCPCPTeaASGIHandler(
+        get_wsgi_application(), application=application, max_workers=max_workers
+    )
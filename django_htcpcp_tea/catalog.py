@@ -0,0 +1,772 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+"""
+Process-local snapshot of the pots, teas, additions and forbidden combinations
+served by this app.
+
+The snapshot is stored as compact, immutable records that mirror the read-only
+interface of the corresponding models. It is loaded on first use and discarded
+whenever one of the catalog models is saved, deleted, or has its many-to-many
+relations changed in this process.
+"""
+
+from collections import defaultdict, namedtuple
+from functools import wraps
+from operator import itemgetter
+from types import MappingProxyType
+
+import django
+from django.core.signals import setting_changed
+from django.db import connection, transaction
+from django.db.models import Count, Max, Sum
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.urls import reverse
+
+from .models import Addition, ForbiddenCombination, Pot, TeaType, resolve_additions
+from .settings import htcpcp_settings
+
+
+class RecordSet(tuple):
+    """
+    Immutable sequence of records.
+
+    Provides the ``all()`` method of a related manager so that records can be
+    used in place of model instances in views and templates.
+    """
+
+    __slots__ = ()
+
+    def all(self):
+        return self
+
+
+class TeaRecord(namedtuple("TeaRecord", "id name slug")):
+    """Immutable snapshot of a TeaType."""
+
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return self.name
+
+
+class AdditionRecord(namedtuple("AdditionRecord", "id name type type_display")):
+    """Immutable snapshot of an Addition."""
+
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    @property
+    def is_milk(self):
+        return self.type == Addition.MILK
+
+    def get_type_display(self):
+        return self.type_display
+
+    def __str__(self):
+        return "{} / {}".format(self.type_display, self.name)
+
+
+class PotRecord(
+    namedtuple(
+        "PotRecord",
+        "id name brew_coffee capability_version supported_teas"
+        " supported_additions tea_slugs addition_map",
+    )
+):
+    """
+    Immutable snapshot of a Pot.
+
+    In addition to the fields of a Pot, the record holds the frozenset of the
+    slugs of its supported teas and a read-only mapping from addition names to
+    its supported additions.
+    """
+
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return "{} - {}".format(self.id, self.name)
+
+    def get_absolute_url(self):
+        return reverse("pot-detail", args=(self.id,))
+
+    @property
+    def tea_capable(self):
+        """Return True if this pot can serve tea."""
+        return bool(self.tea_slugs)
+
+    @property
+    def tea_count(self):
+        """Return the number of teas that this pot supports."""
+        return len(self.supported_teas)
+
+    @property
+    def addition_count(self):
+        """Return the number of additions that this pot supports."""
+        return len(self.supported_additions)
+
+    @property
+    def is_teapot(self):
+        """Return True if this pot can serve tea, but cannot serve coffee."""
+        return self.tea_capable and not self.brew_coffee
+
+    def supports_tea(self, tea_slug):
+        """Return True if this pot can brew the tea with the given slug."""
+        return tea_slug in self.tea_slugs
+
+    def fetch_additions(self, addition_names):
+        """
+        Return the additions that this pot supports whose names are in the
+        provided sequence, without duplicates.
+
+        If this pot does not support an Addition whose name is provided, raise
+        an AdditionsNotSupported error.
+        """
+        return resolve_additions(self.addition_map, addition_names)
+
+
+class ForbiddenCombinationRecord(
+    namedtuple("ForbiddenCombinationRecord", "id tea additions addition_ids reason")
+):
+    """Immutable snapshot of a ForbiddenCombination."""
+
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    def __str__(self):
+        return "{} / {}".format(
+            "All" if not self.tea else self.tea.name,
+            ", ".join(a.name for a in self.additions),
+        )
+
+    def forbids_additions(self, requested_additions):
+        """
+        Return True if the combination of additions that this record prohibits
+        is contained in the specified sequence of additions.
+        """
+        return self.addition_ids.issubset(a.id for a in requested_additions)
+
+
+class Catalog:
+    """Immutable snapshot of every pot and forbidden combination."""
+
+    def __init__(self, version, pots, forbidden_combinations):
+        self.version = version
+        self.pots = MappingProxyType(pots)
+        self.forbidden_combinations = RecordSet(forbidden_combinations)
+        self.forbidden_matcher = ForbiddenCombinationMatcher(
+            (fc, fc.tea.slug if fc.tea else None, fc.addition_ids)
+            for fc in self.forbidden_combinations
+        )
+
+    @classmethod
+    def load(cls, version):
+        """Load a new snapshot of the catalog from the database."""
+        teas = {}
+        for values in TeaType.objects.order_by("pk").values_list("id", "name", "slug"):
+            teas[values[0]] = TeaRecord(*values)
+
+        type_display = dict(Addition.TYPE_CHOICES)
+        additions = {}
+        for addition_id, name, type_ in Addition.objects.order_by("pk").values_list(
+            "id", "name", "type"
+        ):
+            additions[addition_id] = AdditionRecord(
+                addition_id, name, type_, type_display.get(type_, type_)
+            )
+
+        pot_teas = _load_relation(Pot.supported_teas, teas)
+        pot_additions = _load_relation(Pot.supported_additions, additions)
+
+        pots = {}
+        for pot_id, name, brew_coffee, capability_version in Pot.objects.order_by(
+            "pk"
+        ).values_list("id", "name", "brew_coffee", "capability_version"):
+            pots[pot_id] = _make_pot_record(
+                pot_id,
+                name,
+                brew_coffee,
+                capability_version,
+                pot_teas[pot_id],
+                pot_additions[pot_id],
+            )
+
+        combination_additions = _load_relation(
+            ForbiddenCombination.additions, additions
+        )
+        forbidden_combinations = []
+        for combination_id, tea_id, reason in ForbiddenCombination.objects.order_by(
+            "pk"
+        ).values_list("id", "tea_id", "reason"):
+            if tea_id is not None and tea_id not in teas:
+                # The tea was created after the teas were loaded. Skip the
+                # combination rather than applying it to every beverage.
+                invalidate_catalog()
+                continue
+            combination_addition_list = combination_additions[combination_id]
+            forbidden_combinations.append(
+                ForbiddenCombinationRecord(
+                    id=combination_id,
+                    tea=teas.get(tea_id),
+                    additions=RecordSet(combination_addition_list),
+                    addition_ids=frozenset(a.id for a in combination_addition_list),
+                    reason=reason,
+                )
+            )
+
+        return cls(version, pots, forbidden_combinations)
+
+    def get_pot(self, pot_id):
+        """Return the PotRecord with the given id, or None if none exists."""
+        return self.pots.get(pot_id)
+
+    def find_forbidden_combinations(self, requested_additions, tea_slug=None):
+        """
+        Return the list of ForbiddenCombinationRecords that prohibit some part
+        of the requested additions.
+        """
+        return self.forbidden_matcher.match(
+            (a.id for a in requested_additions), tea_slug
+        )
+
+
+class ForbiddenCombinationMatcher:
+    """
+    Set of forbidden combinations compiled into integer bitmasks.
+
+    Each addition that appears in some combination is assigned one bit, and
+    each combination is compiled into the mask of its additions. Combinations
+    are grouped by the slug of the tea they apply to, with combinations that
+    apply to all beverages included in every group. Within a group, each
+    combination is filed under the lowest bit of its mask so that a check only
+    visits the combinations that could possibly match the requested additions.
+    """
+
+    def __init__(self, combinations):
+        """
+        Compile the given ``(combination, tea_slug, addition_ids)`` triples.
+
+        Matches are returned in the order that their combinations are given.
+        """
+        self._bits = {}
+        compiled = []
+        for index, (combination, tea_slug, addition_ids) in enumerate(combinations):
+            mask = 0
+            for addition_id in addition_ids:
+                mask |= 1 << self._bits.setdefault(addition_id, len(self._bits))
+            compiled.append((tea_slug, (index, mask, combination)))
+
+        self._global_group = _MatcherGroup()
+        self._tea_groups = defaultdict(_MatcherGroup)
+        for tea_slug, entry in compiled:
+            if tea_slug is None:
+                self._global_group.add(entry)
+            else:
+                self._tea_groups[tea_slug].add(entry)
+        for group in self._tea_groups.values():
+            group.extend(self._global_group)
+        self._tea_groups = dict(self._tea_groups)
+
+    def match(self, addition_ids, tea_slug=None):
+        """
+        Return the combinations whose additions are all among the given
+        addition ids and that apply to the tea with the given slug (or to all
+        beverages).
+        """
+        group = self._tea_groups.get(tea_slug, self._global_group)
+
+        requested = 0
+        for addition_id in addition_ids:
+            bit = self._bits.get(addition_id)
+            if bit is not None:
+                requested |= 1 << bit
+
+        matches = list(group.unconditional)
+        remaining = requested
+        while remaining:
+            lowest = remaining & -remaining
+            remaining ^= lowest
+            for entry in group.buckets.get(lowest, ()):
+                if entry[1] & requested == entry[1]:
+                    matches.append(entry)
+
+        matches.sort()
+        return [combination for _, _, combination in matches]
+
+
+class _MatcherGroup:
+    """Compiled combinations that apply to a single beverage."""
+
+    def __init__(self):
+        self.unconditional = []
+        self.buckets = defaultdict(list)
+
+    def add(self, entry):
+        mask = entry[1]
+        if mask:
+            self.buckets[mask & -mask].append(entry)
+        else:
+            # Combinations without additions forbid every request.
+            self.unconditional.append(entry)
+
+    def extend(self, other):
+        self.unconditional.extend(other.unconditional)
+        for lowest, entries in other.buckets.items():
+            self.buckets[lowest].extend(entries)
+
+
+class CapabilityIndex:
+    """
+    Index of the beverages and additions supported by pots, compiled into
+    integer bitsets.
+
+    Each pot is assigned one bit, in order of pot id, and each tea slug and
+    addition name is mapped to the bitset of the pots that support it, so that
+    the pots supporting a combination are found by intersecting bitsets.
+    """
+
+    def __init__(self, pots):
+        """
+        Compile the given ``(pot_id, brew_coffee, tea_slugs, addition_names)``
+        tuples.
+        """
+        self.pot_ids = []
+        self._coffee = 0
+        self._teas = defaultdict(int)
+        self._additions = defaultdict(int)
+        for bit, (pot_id, brew_coffee, tea_slugs, addition_names) in enumerate(
+            sorted(pots, key=itemgetter(0))
+        ):
+            mask = 1 << bit
+            self.pot_ids.append(pot_id)
+            if brew_coffee:
+                self._coffee |= mask
+            for tea_slug in tea_slugs:
+                self._teas[tea_slug] |= mask
+            for addition_name in addition_names:
+                self._additions[addition_name] |= mask
+        self._all = (1 << len(self.pot_ids)) - 1
+        self._teas = dict(self._teas)
+        self._additions = dict(self._additions)
+
+    @classmethod
+    def load(cls):
+        """Compile a new index from the database."""
+        pot_teas = defaultdict(list)
+        for pot_id, slug in Pot.supported_teas.through.objects.values_list(
+            "pot_id", "teatype__slug"
+        ):
+            pot_teas[pot_id].append(slug)
+
+        pot_additions = defaultdict(list)
+        for pot_id, name in Pot.supported_additions.through.objects.values_list(
+            "pot_id", "addition__name"
+        ):
+            pot_additions[pot_id].append(name)
+
+        return cls(
+            (pot_id, brew_coffee, pot_teas[pot_id], pot_additions[pot_id])
+            for pot_id, brew_coffee in Pot.objects.values_list("id", "brew_coffee")
+        )
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        """Compile a new index from a catalog snapshot."""
+        return cls(
+            (pot.id, pot.brew_coffee, pot.tea_slugs, pot.addition_map)
+            for pot in catalog.pots.values()
+        )
+
+    def find_pots(self, coffee=False, tea_slug=None, addition_names=()):
+        """
+        Return the ids of the pots that brew coffee (if ``coffee`` is True),
+        that brew the tea with the given slug (if any), and that support every
+        addition whose name is given, ordered by id.
+        """
+        mask = self._coffee if coffee else self._all
+        if tea_slug is not None:
+            mask &= self._teas.get(tea_slug, 0)
+        for addition_name in addition_names:
+            if not mask:
+                break
+            mask &= self._additions.get(addition_name, 0)
+
+        pot_ids = []
+        while mask:
+            lowest = mask & -mask
+            mask ^= lowest
+            pot_ids.append(self.pot_ids[lowest.bit_length() - 1])
+        return pot_ids
+
+
+def load_pot_record(pot_id):
+    """
+    Load a PotRecord for the pot with the given id from the database, or
+    return None if no such pot exists.
+
+    The pot and its supported teas are fetched in one query. Its supported
+    additions are fetched in a second, unless they are cached for the pot's
+    current capability version. On PostgreSQL with Django 2.2 or later (whose
+    ``ArrayAgg`` accepts an ordering), the supported teas are aggregated into
+    arrays so that the first query returns a single row.
+    """
+    pots = Pot.objects.filter(pk=pot_id)
+    if connection.vendor == "postgresql" and django.VERSION >= (2, 2):
+        from django.contrib.postgres.aggregates import ArrayAgg
+
+        tea_fields = (
+            "supported_teas__id",
+            "supported_teas__name",
+            "supported_teas__slug",
+        )
+        rows = pots.annotate(
+            **{
+                "tea_{}s".format(index): ArrayAgg(field, ordering="supported_teas__id")
+                for index, field in enumerate(tea_fields)
+            }
+        ).values_list(
+            "id",
+            "name",
+            "brew_coffee",
+            "capability_version",
+            "tea_0s",
+            "tea_1s",
+            "tea_2s",
+        )
+        try:
+            (
+                pot_id,
+                name,
+                brew_coffee,
+                capability_version,
+                tea_ids,
+                tea_names,
+                tea_slugs,
+            ) = rows.get()
+        except Pot.DoesNotExist:
+            return None
+        tea_rows = zip(tea_ids, tea_names, tea_slugs)
+    else:
+        rows = pots.order_by("supported_teas__id").values_list(
+            "id",
+            "name",
+            "brew_coffee",
+            "capability_version",
+            "supported_teas__id",
+            "supported_teas__name",
+            "supported_teas__slug",
+        )
+        rows = list(rows)
+        if not rows:
+            return None
+        pot_id, name, brew_coffee, capability_version = rows[0][:4]
+        tea_rows = (row[4:] for row in rows)
+
+    # Pots without teas produce a single row of nulls from the outer join.
+    teas = [TeaRecord(*values) for values in tea_rows if values[0] is not None]
+
+    addition_map = _get_addition_record_map(pot_id, capability_version)
+
+    return _make_pot_record(
+        pot_id,
+        name,
+        brew_coffee,
+        capability_version,
+        teas,
+        tuple(addition_map.values()),
+        addition_map,
+    )
+
+
+# Maps the id of each pot to its capability version and a mapping from names
+# to the AdditionRecords of its supported additions.
+_addition_record_maps = {}
+
+
+def _get_addition_record_map(pot_id, capability_version):
+    """
+    Return a read-only mapping from names to AdditionRecords for the additions
+    supported by the pot with the given id, ordered by id.
+
+    Like ``Pot.addition_map``, the mapping is cached by this process until the
+    capability version of the pot changes. Mappings loaded inside an atomic
+    block are not cached, since the version may be rolled back and reused.
+    """
+    try:
+        version, addition_map = _addition_record_maps[pot_id]
+        if version == capability_version:
+            return addition_map
+    except KeyError:
+        pass
+    type_display = dict(Addition.TYPE_CHOICES)
+    addition_map = MappingProxyType(
+        {
+            addition_name: AdditionRecord(
+                addition_id, addition_name, type_, type_display.get(type_, type_)
+            )
+            for addition_id, addition_name, type_ in Addition.objects.filter(
+                pot_list=pot_id
+            )
+            .order_by("pk")
+            .values_list("id", "name", "type")
+        }
+    )
+    if not _in_transaction():
+        _addition_record_maps[pot_id] = (capability_version, addition_map)
+    return addition_map
+
+
+def _make_pot_record(
+    pot_id, name, brew_coffee, capability_version, teas, additions, addition_map=None
+):
+    if addition_map is None:
+        addition_map = MappingProxyType(
+            {addition.name: addition for addition in additions}
+        )
+    return PotRecord(
+        id=pot_id,
+        name=name,
+        brew_coffee=brew_coffee,
+        capability_version=capability_version,
+        supported_teas=RecordSet(teas),
+        supported_additions=RecordSet(additions),
+        tea_slugs=frozenset(tea.slug for tea in teas),
+        addition_map=addition_map,
+    )
+
+
+def _load_relation(descriptor, records):
+    """
+    Return a mapping from source ids to the records related through the given
+    many-to-many descriptor, ordered by record id.
+
+    The catalog is loaded with separate queries, so records that were created
+    and related after ``records`` was loaded may be referenced. These are
+    skipped, and the catalog is invalidated so that the snapshot being loaded
+    is replaced on the next request.
+    """
+    field = descriptor.field
+    related = defaultdict(list)
+    rows = descriptor.through.objects.order_by(field.m2m_reverse_name()).values_list(
+        field.m2m_column_name(), field.m2m_reverse_name()
+    )
+    for source_id, target_id in rows:
+        try:
+            related[source_id].append(records[target_id])
+        except KeyError:
+            invalidate_catalog()
+    return related
+
+
+_catalog_version = 0
+
+
+def catalog_version():
+    """
+    Return the current catalog version.
+
+    The version is incremented every time the catalog is invalidated, so it can
+    be used to key other process-local caches derived from the catalog.
+    """
+    return _catalog_version
+
+
+def _in_transaction():
+    return connection.in_atomic_block
+
+
+def cached_by_catalog_version(func):
+    """
+    Decorator that caches the results of a function, keyed by its positional
+    arguments, until the catalog is next invalidated.
+
+    Keyword arguments are passed through to the function without being
+    included in the cache key. Results computed inside an atomic block are
+    not cached, since they may include changes that are later rolled back.
+    """
+    cache = {}
+
+    @wraps(func)
+    def _cached(*args, **kwargs):
+        version = _catalog_version
+        try:
+            cached_version, value = cache[args]
+            if cached_version == version:
+                return value
+        except KeyError:
+            pass
+        value = func(*args, **kwargs)
+        if not _in_transaction():
+            cache[args] = (version, value)
+        return value
+
+    _cached.cache_clear = cache.clear
+    return _cached
+
+
+def cached_by_fingerprint(get_fingerprint):
+    """
+    Decorator that caches the result of a function without arguments until the
+    value returned by ``get_fingerprint`` changes.
+
+    The fingerprint is read on every call, typically with a single query, so
+    that changes made to the database by other processes are seen. As with
+    ``cached_by_catalog_version``, results computed inside an atomic block are
+    not cached.
+    """
+
+    def decorator(func):
+        cached = None
+
+        @wraps(func)
+        def _cached():
+            nonlocal cached
+            fingerprint = get_fingerprint()
+            if cached is not None and cached[0] == fingerprint:
+                return cached[1]
+            value = func()
+            if not _in_transaction():
+                cached = (fingerprint, value)
+            return value
+
+        def cache_clear():
+            nonlocal cached
+            cached = None
+
+        _cached.cache_clear = cache_clear
+        return _cached
+
+    return decorator
+
+
+def _get_fingerprint(model, version_field):
+    """
+    Return a fingerprint of the instances of the model in the database, which
+    changes whenever an instance is created or deleted, or the given version
+    field of an instance is incremented.
+    """
+    values = model.objects.aggregate(
+        count=Count("pk"), max_id=Max("pk"), versions=Sum(version_field)
+    )
+    return values["count"], values["max_id"], values["versions"]
+
+
+@cached_by_catalog_version
+def get_catalog():
+    """Return the current catalog snapshot, loading it if necessary."""
+    return Catalog.load(_catalog_version)
+
+
+def _get_forbidden_combination_fingerprint():
+    # The version of a forbidden combination is incremented whenever it, its
+    # tea, or its additions are changed.
+    return _get_fingerprint(ForbiddenCombination, "version")
+
+
+@cached_by_fingerprint(_get_forbidden_combination_fingerprint)
+def get_forbidden_combination_matcher():
+    """
+    Return a ForbiddenCombinationMatcher for the ForbiddenCombinations in the
+    database, compiling it if necessary.
+
+    The matcher is compiled again whenever the fingerprint of the
+    ForbiddenCombinations in the database changes, so that combinations
+    changed by other processes are seen. Unlike the catalog snapshot, the
+    matcher yields ForbiddenCombination model instances.
+    """
+    combinations = (
+        ForbiddenCombination.objects.select_related("tea")
+        .prefetch_related("additions")
+        .order_by("pk")
+    )
+    return ForbiddenCombinationMatcher(
+        (fc, fc.tea.slug if fc.tea else None, [a.id for a in fc.additions.all()])
+        for fc in combinations
+    )
+
+
+def get_capability_index():
+    """
+    Return a CapabilityIndex of every pot.
+
+    If the ``CATALOG_SNAPSHOT`` setting is enabled, the index is compiled from
+    the catalog snapshot and kept until the catalog is next invalidated.
+    Otherwise, the index is kept until the fingerprint of the pots in the
+    database changes, so that changes made by other processes are seen at the
+    cost of a single aggregate query.
+    """
+    if htcpcp_settings.CATALOG_SNAPSHOT:
+        return _get_snapshot_capability_index()
+    return _get_loaded_capability_index()
+
+
+def _get_pot_fingerprint():
+    # The capability version of a pot is incremented whenever its teas or
+    # additions, or whether it brews coffee, are changed.
+    return _get_fingerprint(Pot, "capability_version")
+
+
+@cached_by_fingerprint(_get_pot_fingerprint)
+def _get_loaded_capability_index():
+    return CapabilityIndex.load()
+
+
+@cached_by_catalog_version
+def _get_snapshot_capability_index():
+    return CapabilityIndex.from_catalog(get_catalog())
+
+
+def invalidate_catalog(**kwargs):
+    """
+    Discard the current catalog snapshot and any caches derived from it.
+
+    Accepts arbitrary keyword arguments so that it may be connected directly
+    to model signals. If called inside an atomic block, the catalog is
+    invalidated again once the transaction is committed, so that caches
+    filled by other threads before the commit are discarded.
+    """
+    _increment_catalog_version()
+    transaction.on_commit(_increment_catalog_version, using=kwargs.get("using"))
+
+
+def _increment_catalog_version():
+    global _catalog_version
+    _catalog_version += 1
+
+
+for _model in (Pot, TeaType, Addition, ForbiddenCombination):
+    post_save.connect(invalidate_catalog, sender=_model)
+    post_delete.connect(invalidate_catalog, sender=_model)
+
+for _descriptor in (
+    Pot.supported_teas,
+    Pot.supported_additions,
+    ForbiddenCombination.additions,
+):
+    m2m_changed.connect(invalidate_catalog, sender=_descriptor.through)
+
+
+@receiver(setting_changed)
+def _invalidate_catalog_on_setting_changed(setting, **kwargs):
+    # Caches derived from the catalog may depend on this app's settings and
+    # on the URLs that pots are served under.
+    if setting == "ROOT_URLCONF" or setting.startswith("HTCPCP_"):
+        invalidate_catalog()
@@ -0,0 +1,102 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+"""
+Strategies for choosing the pot that brews a beverage requested of the HTCPCP
+index URI.
+
+Each strategy is given the ids of the pots that are able to brew the beverage
+and a function returning the loads of a sequence of pots, in the same order.
+The load of a pot is zero if it is idle, or one more than the number of
+beverages queued for it if it is busy. A strategy returns the id of the chosen
+pot, and requests the loads of the pots it considers with a single call, so
+that the states of those pots are read from the pot state backend at once.
+"""
+
+import itertools
+import random
+from operator import itemgetter
+
+from django.core.exceptions import ImproperlyConfigured
+
+from .catalog import get_capability_index
+from .pot_state import get_pot_state_backend
+from .settings import htcpcp_settings
+
+_round_robin_counter = itertools.count()
+
+
+def round_robin(pot_ids, get_loads):
+    """
+    Choose the first idle pot after the pot chosen last, or the next pot in
+    turn if every pot is busy.
+    """
+    start = next(_round_robin_counter) % len(pot_ids)
+    rotated = pot_ids[start:] + pot_ids[:start]
+    for pot_id, load in zip(rotated, get_loads(rotated)):
+        if not load:
+            return pot_id
+    return rotated[0]
+
+
+def least_busy(pot_ids, get_loads):
+    """Choose the pot with the least load, preferring the lowest pot id."""
+    return _least_loaded(pot_ids, get_loads)
+
+
+def two_choices(pot_ids, get_loads):
+    """Choose the pot with the lesser load of two pots chosen at random."""
+    return _least_loaded(random.sample(pot_ids, min(2, len(pot_ids))), get_loads)
+
+
+def _least_loaded(pot_ids, get_loads):
+    """Return the first of the given pots with the least load."""
+    pot_id, load = min(zip(pot_ids, get_loads(pot_ids)), key=itemgetter(1))
+    return pot_id
+
+
+STRATEGIES = {
+    "round-robin": round_robin,
+    "least-busy": least_busy,
+    "two-choices": two_choices,
+}
+
+
+def choose_coffee_pot(request, addition_names):
+    """
+    Return the id of the pot chosen by the ``INDEX_DISPATCH`` strategy to brew
+    coffee with the additions whose names are given, or None if no pot can
+    brew it.
+    """
+    try:
+        strategy = STRATEGIES[htcpcp_settings.INDEX_DISPATCH]
+    except KeyError:
+        raise ImproperlyConfigured(
+            "Unknown HTCPCP_INDEX_DISPATCH strategy {!r}".format(
+                htcpcp_settings.INDEX_DISPATCH
+            )
+        )
+
+    pot_ids = get_capability_index().find_pots(
+        coffee=True, addition_names=addition_names
+    )
+    if not pot_ids:
+        return None
+
+    if not htcpcp_settings.POT_SESSIONS:
+        # The state of pots is not tracked, so every pot is idle.
+        return strategy(pot_ids, lambda pot_ids: [0] * len(pot_ids))
+
+    backend = get_pot_state_backend()
+
+    def get_loads(pot_ids):
+        states = backend.get_many(request, pot_ids)
+        return [
+            1 + len(states[pot_id].get("queue", ())) if pot_id in states else 0
+            for pot_id in pot_ids
+        ]
+
+    return strategy(pot_ids, get_loads)
@@ -0,0 +1,25 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+from django.core.management.base import BaseCommand
+
+from django_htcpcp_tea.catalog import invalidate_catalog
+from django_htcpcp_tea.models import Pot
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the teas and additions supported by every pot. Only needed if"
+        " the supported teas or additions of pots were changed without sending"
+        " the m2m_changed signal, e.g. with bulk_create() or raw SQL."
+    )
+
+    def handle(self, *args, **options):
+        count = Pot.objects.update_capabilities()
+        invalidate_catalog()
+        self.stdout.write(
+            self.style.SUCCESS("Rebuilt the capabilities of {} pot(s).".format(count))
+        )
@@ -4,6 +4,12 @@
 #  MIT License was not distributed with this file, you can obtain one
 #  at https://opensource.org/licenses/MIT.
 
+import re
+from io import BytesIO
+
+from django.utils.cache import patch_vary_headers
+
+from .renderer import render_static_htcpcp
 from .settings import htcpcp_settings
 from .utils import render_alternates_header
 from .views import brew_pot
@@ -12,8 +18,12 @@ from .views import brew_pot
 class HTCPCPTeaMiddleware:
     HTCPCP_MESSAGE_KEYWORDS = (b"start", b"stop")
 
+    HTCPCP_MESSAGE_PATTERN = re.compile(b"start|stop")
+
     HTCPCP_MIME_TYPES = ("message/teapot", "message/coffeepot")
 
+    BODY_CHUNK_SIZE = 512
+
     def __init__(self, get_response):
         self.get_response = get_response
         self.valid_methods = ("BREW", "WHEN")
@@ -21,30 +31,43 @@ class HTCPCPTeaMiddleware:
             self.valid_methods += ("POST",)
 
     def __call__(self, request):
-        htcpcp_valid = True
+        if not self._may_be_htcpcp(
+            request.method, request.content_type, request.path_info
+        ):
+            # Skip reading the request body and rewriting the response
+            # headers for requests that cannot be valid HTCPCP requests.
+            request.htcpcp_valid = False
+            return self.get_response(request)
+
+        body = self._read_body(request)
 
-        if request.method not in self.valid_methods:
-            htcpcp_valid = False
+        if body is None:
+            if request.content_type not in self.HTCPCP_MIME_TYPES:
+                # Oversized bodies are only rejected for requests that
+                # explicitly claim to be HTCPCP requests.
+                request.htcpcp_valid = False
+                return self.get_response(request)
+            reason = "HTCPCP request bodies are limited to {} bytes.".format(
+                htcpcp_settings.MAX_REQUEST_BODY
+            )
+            return render_static_htcpcp(
+                request, "django_htcpcp_tea/413.html", reason, status=413
+            )
+
+        htcpcp_valid = True
 
         # Resolve HTCPCP message type (start or stop)
         if htcpcp_settings.STRICT_REQUEST_BODY:
-            if request.body not in self.HTCPCP_MESSAGE_KEYWORDS:
+            if body not in self.HTCPCP_MESSAGE_KEYWORDS:
                 htcpcp_valid = False
             else:
-                request.htcpcp_message_type = request.body.decode(encoding="utf-8")
+                request.htcpcp_message_type = body.decode(encoding="utf-8")
         else:
-            for keyword in self.HTCPCP_MESSAGE_KEYWORDS:
-                if keyword in request.body:
-                    request.htcpcp_message_type = keyword.decode(encoding="utf-8")
-                    break  # Trigger else branch if no keyword is found
-            else:
+            keyword = self._find_message_keyword(body)
+            if keyword is None:
                 htcpcp_valid = False
-
-        if (
-            htcpcp_settings.STRICT_MIME_TYPE
-            and request.content_type not in self.HTCPCP_MIME_TYPES
-        ):
-            htcpcp_valid = False
+            else:
+                request.htcpcp_message_type = keyword.decode(encoding="utf-8")
 
         request.htcpcp_valid = htcpcp_valid
 
@@ -75,7 +98,90 @@ class HTCPCPTeaMiddleware:
                 response["Server"] = update_server_name.format(**request.META)
 
         content_type_override = htcpcp_settings.RESPONSE_CONTENT_TYPE
-        if htcpcp_valid and content_type_override is not None:
+        if (
+            htcpcp_valid
+            and content_type_override is not None
+            and getattr(response, "htcpcp_representation", "html") != "json"
+        ):
             response["Content-Type"] = content_type_override
 
+        if htcpcp_valid and htcpcp_settings.NEGOTIATE_CONTENT:
+            patch_vary_headers(response, ("Accept", "Prefer"))
+
         return response
+
+    def _may_be_htcpcp(self, method, content_type, path_info):
+        """
+        Return True if a request could be a valid HTCPCP request judging
+        only from its method, path, and content type.
+
+        If the ``URL_PREFIXES`` setting is specified, only requests whose path
+        begins with one of the given prefixes (or requests for the root URI,
+        if it is overridden) are considered.
+        """
+        if method not in self.valid_methods:
+            return False
+
+        if (
+            htcpcp_settings.STRICT_MIME_TYPE
+            and content_type not in self.HTCPCP_MIME_TYPES
+        ):
+            return False
+
+        prefixes = htcpcp_settings.URL_PREFIXES
+        if prefixes is not None:
+            if path_info == "/" and htcpcp_settings.OVERRIDE_ROOT_URI:
+                return True
+            return path_info.startswith(tuple(prefixes))
+
+        return True
+
+    def _read_body(self, request):
+        """
+        Read the body of the request from its stream in chunks, returning None
+        if the body is larger than the ``MAX_REQUEST_BODY`` setting allows.
+
+        When possible, oversized bodies are rejected using the request's
+        Content-Length before any of the body is read. The body that is read
+        is retained on the request so that it remains available to views as
+        ``request.body``.
+        """
+        limit = htcpcp_settings.MAX_REQUEST_BODY
+
+        if limit is not None:
+            try:
+                content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+            except ValueError:
+                content_length = 0
+            if content_length > limit:
+                return None
+
+        chunks = []
+        size = 0
+        for chunk in iter(lambda: request.read(self.BODY_CHUNK_SIZE), b""):
+            size += len(chunk)
+            if limit is not None and size > limit:
+                return None
+            chunks.append(chunk)
+
+        body = b"".join(chunks)
+        # Store the body the same way HttpRequest.body does after reading
+        # the request stream.
+        request._body = body
+        request._stream = BytesIO(body)
+        return body
+
+    def _find_message_keyword(self, body):
+        """
+        Return the HTCPCP message keyword contained in the request body, or
+        None if no keyword is found.
+
+        The body is scanned once for both keywords. If both are present,
+        ``start`` takes precedence.
+        """
+        found = None
+        for match in self.HTCPCP_MESSAGE_PATTERN.finditer(body):
+            found = match.group()
+            if found == self.HTCPCP_MESSAGE_KEYWORDS[0]:
+                break
+        return found
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_htcpcp_tea', '0005_forbiddencombination'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PotState',
+            fields=[
+                ('pot', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='state', serialize=False, to='django_htcpcp_tea.Pot')),
+                ('state', models.TextField(blank=True, help_text='The state of the beverage as JSON, or empty if idle.')),
+                ('updated', models.DateTimeField(help_text='When the state was last changed.')),
+            ],
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:21
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_capabilities(apps, schema_editor):
+    Pot = apps.get_model('django_htcpcp_tea', 'Pot')
+
+    def count_related(through):
+        counts = through.objects.filter(pot_id=OuterRef('pk')).order_by().values(
+            'pot_id'
+        ).annotate(count=Count('*')).values('count')
+        return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+
+    Pot.objects.update(
+        tea_count=count_related(Pot.supported_teas.through),
+        addition_count=count_related(Pot.supported_additions.through),
+        tea_capable=Exists(
+            Pot.supported_teas.through.objects.filter(pot_id=OuterRef('pk'))
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_htcpcp_tea', '0006_potstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pot',
+            name='addition_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='The number of additions that this pot supports.'),
+        ),
+        migrations.AddField(
+            model_name='pot',
+            name='tea_capable',
+            field=models.BooleanField(default=False, editable=False, help_text='Can this pot brew tea?', verbose_name='able to brew tea'),
+        ),
+        migrations.AddField(
+            model_name='pot',
+            name='tea_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='The number of teas that this pot supports.'),
+        ),
+        migrations.RunPython(count_capabilities, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 17:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_htcpcp_tea', '0007_pot_capabilities'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pot',
+            name='capability_version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Incremented whenever the teas or additions that this pot supports are changed.'),
+        ),
+    ]
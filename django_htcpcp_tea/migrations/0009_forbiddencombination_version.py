@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-17 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_htcpcp_tea', '0008_pot_capability_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forbiddencombination',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Incremented whenever this combination, its tea or its additions are changed.'),
+        ),
+    ]
@@ -4,22 +4,63 @@
 #  MIT License was not distributed with this file, you can obtain one
 #  at https://opensource.org/licenses/MIT.
 
+from types import MappingProxyType
+
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Count
+from django.db import connection, models
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.urls import reverse
-from django.utils.functional import cached_property
 
 
 class PotQuerySet(models.QuerySet):
-    def _count_relation(self, field, annotation_name):
-        return self.annotate(**{annotation_name: Count(field, distinct=True)})
-
     def with_tea_count(self):
-        return self._count_relation("supported_teas", "tea_count")
+        """
+        Return a copy of this queryset.
+
+        The number of teas supported by each pot is stored in its ``tea_count``
+        field, so no annotation is needed.
+        """
+        return self.all()
 
     def with_addition_count(self):
-        return self._count_relation("supported_additions", "addition_count")
+        """
+        Return a copy of this queryset.
+
+        The number of additions supported by each pot is stored in its
+        ``addition_count`` field, so no annotation is needed.
+        """
+        return self.all()
+
+    def update_capabilities(self):
+        """
+        Recount the teas and additions supported by the pots in this queryset,
+        store the results in their capability fields, and increment their
+        capability versions.
+
+        Returns the number of pots updated.
+        """
+        return self.update(
+            capability_version=F("capability_version") + 1,
+            tea_count=_count_related(Pot.supported_teas.through),
+            addition_count=_count_related(Pot.supported_additions.through),
+            tea_capable=Exists(
+                Pot.supported_teas.through.objects.filter(pot_id=OuterRef("pk"))
+            ),
+        )
+
+
+def _count_related(through):
+    """Return a subquery counting the rows of ``through`` for each pot."""
+    counts = (
+        through.objects.filter(pot_id=OuterRef("pk"))
+        .order_by()
+        .values("pot_id")
+        .annotate(count=Count("*"))
+        .values("count")
+    )
+    return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
 
 
 class Pot(models.Model):
@@ -46,39 +87,140 @@ class Pot(models.Model):
         "Addition", blank=True, related_name="pot_list"
     )
 
+    tea_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="The number of teas that this pot supports.",
+    )
+
+    addition_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="The number of additions that this pot supports.",
+    )
+
+    tea_capable = models.BooleanField(
+        verbose_name="able to brew tea",
+        default=False,
+        editable=False,
+        help_text="Can this pot brew tea?",
+    )
+
+    capability_version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text="Incremented whenever the teas or additions that this pot"
+        " supports are changed.",
+    )
+
     objects = PotQuerySet.as_manager()
 
     def __str__(self):
         return "{} - {}".format(self.id, self.name)
 
+    def save(
+        self, force_insert=False, force_update=False, using=None, update_fields=None
+    ):
+        # The capability fields of existing pots are only written by
+        # update_capabilities(), so that saving a stale instance cannot
+        # overwrite the values stored when its teas or additions changed.
+        updating = not self._state.adding and not force_insert
+        if updating:
+            if update_fields is None:
+                update_fields = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key
+                ]
+            update_fields = [
+                name for name in update_fields if name not in _CAPABILITY_FIELDS
+            ]
+        super().save(
+            force_insert=force_insert,
+            force_update=force_update,
+            using=using,
+            update_fields=update_fields,
+        )
+        if updating and "brew_coffee" in update_fields:
+            # Whether the pot brews coffee is part of its capabilities.
+            Pot.objects.filter(pk=self.pk).update(
+                capability_version=F("capability_version") + 1
+            )
+
     def get_absolute_url(self):
         return reverse("pot-detail", args=(self.pk,))
 
-    @cached_property
-    def tea_capable(self):
-        """Return True if this pot can serve tea."""
-        return self.supported_teas.exists()
-
     @property
     def is_teapot(self):
         """Return True if this pot can serve tea, but cannot serve coffee."""
         return self.tea_capable and not self.brew_coffee
 
+    def supports_tea(self, tea_slug):
+        """Return True if this pot can brew the tea with the given slug."""
+        return self.supported_teas.filter(slug=tea_slug).exists()
+
+    @property
+    def addition_map(self):
+        """
+        Read-only mapping from names to the Additions that this pot supports.
+
+        The mapping is cached by this process until the ``capability_version``
+        of the pot changes. Mappings loaded inside an atomic block are not
+        cached, since they may include changes that are later rolled back.
+        """
+        try:
+            version, addition_map = _addition_maps[self.pk]
+            if version == self.capability_version:
+                return addition_map
+        except KeyError:
+            pass
+        addition_map = MappingProxyType(
+            {addition.name: addition for addition in self.supported_additions.all()}
+        )
+        if not _in_transaction():
+            _addition_maps[self.pk] = (self.capability_version, addition_map)
+        return addition_map
+
     def fetch_additions(self, addition_names):
         """
         Return the Additions that this pot supports whose names are in the
-        provided sequence.
+        provided sequence, without duplicates.
 
         If this pot does not support an Addition whose name is provided, raise
-        an Addition.DoesNotExist error.
+        an AdditionsNotSupported error.
         """
-        additions = self.supported_additions.filter(name__in=addition_names)
-        # Resolve the query set to compute its length.
-        # Replace this len() call with a queryset annotation if further
-        # filtering becomes necessary.
-        if len(addition_names) != len(additions):
-            raise Addition.DoesNotExist
-        return additions
+        return resolve_additions(self.addition_map, addition_names)
+
+
+# Maps the id of each pot to its capability version and addition map.
+_addition_maps = {}
+
+
+def _in_transaction():
+    return connection.in_atomic_block
+
+
+def normalize_addition_names(addition_names):
+    """
+    Return a tuple of the given addition names with surrounding whitespace
+    removed and without blanks or duplicates, in their original order.
+    """
+    return tuple(dict.fromkeys(filter(None, (name.strip() for name in addition_names))))
+
+
+def resolve_additions(addition_map, addition_names):
+    """
+    Return the additions in ``addition_map`` whose names are given, without
+    duplicates.
+
+    If some of the names are not in ``addition_map``, raise an
+    AdditionsNotSupported error listing them.
+    """
+    addition_names = normalize_addition_names(addition_names)
+    unsupported = [name for name in addition_names if name not in addition_map]
+    if unsupported:
+        raise AdditionsNotSupported(unsupported)
+    return [addition_map[name] for name in addition_names]
 
 
 class TeaType(models.Model):
@@ -165,6 +307,38 @@ class Addition(models.Model):
         return self.type == self.MILK
 
 
+class AdditionsNotSupported(Addition.DoesNotExist):
+    """
+    Raised when a pot does not support some of the requested additions.
+
+    The names of the unsupported additions are given by ``names``.
+    """
+
+    def __init__(self, names):
+        self.names = tuple(names)
+        super().__init__("Unsupported additions: {}".format(", ".join(self.names)))
+
+
+class ForbiddenCombinationQuerySet(models.QuerySet):
+    def forbidding_additions(self, additions):
+        """
+        Filter to the ForbiddenCombinations whose additions are all contained
+        in the specified sequence of additions.
+
+        The check is performed in the database by counting the additions of
+        each combination that are not among the specified additions.
+        """
+        addition_ids = [addition.pk for addition in additions]
+        if addition_ids:
+            excluded = ~Q(additions__in=addition_ids)
+            outside_count = Count("additions", filter=excluded)
+        else:
+            outside_count = Count("additions")
+        return self.annotate(outside_addition_count=outside_count).filter(
+            outside_addition_count=0
+        )
+
+
 class ForbiddenCombination(models.Model):
     """
     A combination of additions that is "contrary to the sensibilities of a
@@ -188,16 +362,165 @@ class ForbiddenCombination(models.Model):
 
     reason = models.CharField(max_length=180)
 
+    version = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        help_text=(
+            "Incremented whenever this combination, its tea or its additions are"
+            " changed."
+        ),
+    )
+
+    objects = ForbiddenCombinationQuerySet.as_manager()
+
     def __str__(self):
         return "{} / {}".format(
             "All" if not self.tea else self.tea.name,
             ", ".join(a.name for a in self.additions.all()),
         )
 
+    def save(
+        self, force_insert=False, force_update=False, using=None, update_fields=None
+    ):
+        # The version of an existing combination is only ever incremented in
+        # the database, so that saving a stale instance cannot reset it.
+        updating = not self._state.adding and not force_insert
+        if updating:
+            if update_fields is None:
+                update_fields = [
+                    field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key
+                ]
+            update_fields = [name for name in update_fields if name != "version"]
+        super().save(
+            force_insert=force_insert,
+            force_update=force_update,
+            using=using,
+            update_fields=update_fields,
+        )
+        if updating:
+            ForbiddenCombination.objects.filter(pk=self.pk).update(
+                version=F("version") + 1
+            )
+
     def forbids_additions(self, requested_additions):
         """
         Return True if the combination of additions that this
         ForbiddenCombination prohibits is contained in the specified sequence
         of additions.
         """
-        return set(self.additions.all()).issubset(requested_additions)
+        # Compare primary keys so that records of additions may be given
+        return {a.pk for a in self.additions.all()}.issubset(
+            a.pk for a in requested_additions
+        )
+
+
+class PotState(models.Model):
+    """
+    The state of the beverage being brewed by a pot, shared by every client.
+
+    Pots without a PotState, or whose state is empty, are idle.
+    """
+
+    pot = models.OneToOneField(
+        Pot, on_delete=models.CASCADE, primary_key=True, related_name="state"
+    )
+
+    state = models.TextField(
+        blank=True, help_text="The state of the beverage as JSON, or empty if idle."
+    )
+
+    updated = models.DateTimeField(help_text="When the state was last changed.")
+
+    def __str__(self):
+        return "State of pot {}".format(self.pot_id)
+
+
+# Fields of Pot that are derived from its supported teas and additions.
+_CAPABILITY_FIELDS = (
+    "capability_version",
+    "tea_count",
+    "addition_count",
+    "tea_capable",
+)
+
+
+def _update_capabilities_on_m2m_changed(instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+    # Versions may be reused if this transaction is rolled back, so discard the
+    # addition maps cached by this process as well.
+    _addition_maps.clear()
+    if not reverse:
+        Pot.objects.filter(pk=instance.pk).update_capabilities()
+        # Refresh the instance so that saving it again does not overwrite the
+        # new counts.
+        instance.refresh_from_db(fields=_CAPABILITY_FIELDS)
+    elif pk_set is None:
+        # The pots that a tea or addition was cleared from are not known.
+        Pot.objects.update_capabilities()
+    else:
+        Pot.objects.filter(pk__in=pk_set).update_capabilities()
+
+
+def _update_versions_on_forbidden_additions_changed(
+    instance, action, reverse, pk_set, **kwargs
+):
+    if not action.startswith("post_"):
+        return
+    if not reverse:
+        combinations = ForbiddenCombination.objects.filter(pk=instance.pk)
+    elif pk_set is None:
+        # The combinations that an addition was cleared from are not known.
+        combinations = ForbiddenCombination.objects.all()
+    else:
+        combinations = ForbiddenCombination.objects.filter(pk__in=pk_set)
+    combinations.update(version=F("version") + 1)
+
+
+def _collect_pots_on_pre_delete(instance, **kwargs):
+    # Deleting a tea or addition removes it from its pots and forbidden
+    # combinations without sending m2m_changed, so remember which pots must be
+    # recounted and which combinations have changed.
+    instance._htcpcp_pot_ids = list(instance.pot_list.values_list("pk", flat=True))
+    instance._htcpcp_forbidden_combination_ids = list(
+        instance.forbidden_combinations.values_list("pk", flat=True)
+    )
+
+
+def _update_capabilities_on_post_delete(instance, **kwargs):
+    pot_ids = getattr(instance, "_htcpcp_pot_ids", None)
+    if pot_ids:
+        _addition_maps.clear()
+        Pot.objects.filter(pk__in=pot_ids).update_capabilities()
+    # Combinations of a deleted tea are deleted along with it, so this only
+    # updates the combinations that a deleted addition was removed from.
+    combination_ids = getattr(instance, "_htcpcp_forbidden_combination_ids", None)
+    if combination_ids:
+        ForbiddenCombination.objects.filter(pk__in=combination_ids).update(
+            version=F("version") + 1
+        )
+
+
+def _update_capability_versions_on_related_saved(instance, created, **kwargs):
+    # The capabilities of the pots supporting a changed tea or addition, such
+    # as their addition maps, are stale.
+    if not created:
+        _addition_maps.clear()
+        instance.pot_list.update(capability_version=F("capability_version") + 1)
+        instance.forbidden_combinations.update(version=F("version") + 1)
+
+
+for _descriptor in (Pot.supported_teas, Pot.supported_additions):
+    m2m_changed.connect(_update_capabilities_on_m2m_changed, sender=_descriptor.through)
+
+m2m_changed.connect(
+    _update_versions_on_forbidden_additions_changed,
+    sender=ForbiddenCombination.additions.through,
+)
+
+for _model in (TeaType, Addition):
+    pre_delete.connect(_collect_pots_on_pre_delete, sender=_model)
+    post_delete.connect(_update_capabilities_on_post_delete, sender=_model)
+    post_save.connect(_update_capability_versions_on_related_saved, sender=_model)
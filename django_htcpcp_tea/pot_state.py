@@ -0,0 +1,407 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+"""
+Storage backends for the state of the beverages being brewed by pots.
+
+The state of a pot is a JSON-serializable dictionary describing the beverage
+that it is brewing, or None if the pot is idle. Backends only need to support
+three operations: reading the state of a pot, replacing it if it has not been
+changed in the meantime, and clearing it.
+"""
+
+import json
+import threading
+import time
+from datetime import timedelta
+
+from django.core import signing
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import PotState
+from .settings import htcpcp_settings
+
+
+class BasePotStateBackend:
+    """
+    Base class for pot state backends.
+
+    Every method receives the current request, so that backends may store the
+    state of pots separately for each client.
+    """
+
+    def get(self, request, pot_id):
+        """Return the state of the pot with the given id, or None if idle."""
+        raise NotImplementedError
+
+    def get_many(self, request, pot_ids):
+        """
+        Return a dictionary from the ids of the given pots that are not idle
+        to their states.
+
+        Calls ``get`` for each pot by default. Backends that store the state
+        of pots outside of the process should read every state at once.
+        """
+        states = {}
+        for pot_id in pot_ids:
+            state = self.get(request, pot_id)
+            if state:
+                states[pot_id] = state
+        return states
+
+    def compare_and_set(self, request, pot_id, expected, state):
+        """
+        Replace the state of the pot with the given id with ``state`` if its
+        current state is equal to ``expected``.
+
+        Either state may be None, in which case the pot is expected to be
+        idle, or is made idle, respectively. Return True if the state was
+        replaced.
+        """
+        raise NotImplementedError
+
+    def delete(self, request, pot_id):
+        """Clear the state of the pot with the given id."""
+        raise NotImplementedError
+
+    def finalize_response(self, request, pot_id, response):
+        """
+        Update the response to a request that used the state of the pot with
+        the given id.
+
+        Does nothing by default.
+        """
+
+
+class SessionPotStateBackend(BasePotStateBackend):
+    """
+    Store the state of pots in the session of each client.
+
+    Each client sees its own state for every pot.
+    """
+
+    def _key(self, pot_id):
+        return "htcpcp_pot_{}".format(pot_id)
+
+    def get(self, request, pot_id):
+        return request.session.get(self._key(pot_id))
+
+    def compare_and_set(self, request, pot_id, expected, state):
+        key = self._key(pot_id)
+        if request.session.get(key) != expected:
+            return False
+        if state is None:
+            request.session.pop(key, None)
+        else:
+            request.session[key] = state
+        return True
+
+    def delete(self, request, pot_id):
+        request.session.pop(self._key(pot_id), None)
+
+
+class CachePotStateBackend(BasePotStateBackend):
+    """
+    Store the state of pots in one of the caches configured in the ``CACHES``
+    setting.
+
+    The state of a pot is shared by every client. Conditional updates are
+    serialized with a short-lived lock entry in the cache.
+    """
+
+    def __init__(self, cache_alias="default", timeout=3600, lock_timeout=5):
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, pot_id):
+        return "htcpcp_pot_state:{}".format(pot_id)
+
+    def get(self, request, pot_id):
+        return self.cache.get(self._key(pot_id))
+
+    def get_many(self, request, pot_ids):
+        keys = {self._key(pot_id): pot_id for pot_id in pot_ids}
+        return {
+            keys[key]: state
+            for key, state in self.cache.get_many(keys).items()
+            if state
+        }
+
+    def compare_and_set(self, request, pot_id, expected, state):
+        cache = self.cache
+        key = self._key(pot_id)
+        if expected is None and state is not None:
+            # add() only stores the state if the pot is idle.
+            return cache.add(key, state, self.timeout)
+
+        lock_key = key + ":lock"
+        if not cache.add(lock_key, True, self.lock_timeout):
+            return False
+        try:
+            if cache.get(key) != expected:
+                return False
+            if state is None:
+                cache.delete(key)
+            else:
+                cache.set(key, state, self.timeout)
+            return True
+        finally:
+            cache.delete(lock_key)
+
+    def delete(self, request, pot_id):
+        self.cache.delete(self._key(pot_id))
+
+
+class LocMemPotStateBackend(BasePotStateBackend):
+    """
+    Store the state of pots in a dictionary local to the current process.
+
+    The state of a pot is shared by every client served by this process, and
+    expires after ``timeout`` seconds.
+    """
+
+    def __init__(self, timeout=3600):
+        self.timeout = timeout
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _get(self, pot_id):
+        try:
+            expires, state = self._states[pot_id]
+        except KeyError:
+            return None
+        if expires is not None and expires <= time.monotonic():
+            del self._states[pot_id]
+            return None
+        return state
+
+    def get(self, request, pot_id):
+        with self._lock:
+            return self._get(pot_id)
+
+    def get_many(self, request, pot_ids):
+        with self._lock:
+            states = {pot_id: self._get(pot_id) for pot_id in pot_ids}
+        return {pot_id: state for pot_id, state in states.items() if state}
+
+    def compare_and_set(self, request, pot_id, expected, state):
+        with self._lock:
+            if self._get(pot_id) != expected:
+                return False
+            if state is None:
+                self._states.pop(pot_id, None)
+            else:
+                expires = None
+                if self.timeout is not None:
+                    expires = time.monotonic() + self.timeout
+                self._states[pot_id] = (expires, state)
+            return True
+
+    def delete(self, request, pot_id):
+        with self._lock:
+            self._states.pop(pot_id, None)
+
+    def clear(self):
+        """Clear the state of every pot."""
+        with self._lock:
+            self._states.clear()
+
+
+class DatabasePotStateBackend(BasePotStateBackend):
+    """
+    Store the state of pots in the database with the PotState model.
+
+    The state of a pot is shared by every client. Every change is made with
+    a single conditional update, so that concurrent requests for the same pot
+    can never both change its state. If ``timeout`` is given, the state of a
+    pot expires after the given number of seconds without changes.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def _dumps(self, state):
+        # Serialize deterministically so that states can be compared in SQL.
+        # Idle pots have an empty state.
+        if state is None:
+            return ""
+        return json.dumps(state, sort_keys=True, separators=(",", ":"))
+
+    def _current(self):
+        """Return a filter for the states that have not expired."""
+        if self.timeout is None:
+            return Q()
+        return Q(updated__gt=timezone.now() - timedelta(seconds=self.timeout))
+
+    def get(self, request, pot_id):
+        state = (
+            PotState.objects.filter(self._current(), pot_id=pot_id)
+            .exclude(state="")
+            .values_list("state", flat=True)
+            .first()
+        )
+        return None if state is None else json.loads(state)
+
+    def get_many(self, request, pot_ids):
+        rows = (
+            PotState.objects.filter(self._current(), pot_id__in=pot_ids)
+            .exclude(state="")
+            .values_list("pot_id", "state")
+        )
+        return {pot_id: json.loads(state) for pot_id, state in rows}
+
+    def compare_and_set(self, request, pot_id, expected, state):
+        states = PotState.objects.filter(pot_id=pot_id)
+        if expected is None:
+            # Idle pots have an empty or expired state
+            states = states.filter(Q(state="") | ~self._current())
+        else:
+            states = states.filter(self._current(), state=self._dumps(expected))
+        if states.update(state=self._dumps(state), updated=timezone.now()):
+            return True
+        if expected is not None:
+            return False
+
+        # The pot may not have a PotState yet
+        try:
+            with transaction.atomic():
+                PotState.objects.create(
+                    pot_id=pot_id, state=self._dumps(state), updated=timezone.now()
+                )
+        except IntegrityError:
+            return False
+        return True
+
+    def delete(self, request, pot_id):
+        PotState.objects.filter(pot_id=pot_id).update(state="", updated=timezone.now())
+
+
+class SignedTokenPotStateBackend(BasePotStateBackend):
+    """
+    Return the state of pots to clients as signed tokens, without storing
+    anything on the server.
+
+    The token is sent in the ``Brew-Token`` response header, and clients are
+    expected to echo it in the ``Brew-Token`` header of their next request of
+    the same pot. Tokens are signed with the ``SECRET_KEY`` setting and are
+    only valid for the pot they were issued for. Invalid or expired tokens
+    are ignored, as if the pot were idle.
+    """
+
+    def __init__(self, header="Brew-Token", max_age=3600):
+        self.header = header
+        self.max_age = max_age
+        self._meta_key = "HTTP_" + header.upper().replace("-", "_")
+
+    def _salt(self, pot_id):
+        return "django_htcpcp_tea.pot_state.pot-{}".format(pot_id)
+
+    def _states(self, request):
+        # The states set for pots during the current request
+        try:
+            return request._htcpcp_pot_states
+        except AttributeError:
+            request._htcpcp_pot_states = {}
+            return request._htcpcp_pot_states
+
+    def get(self, request, pot_id):
+        states = self._states(request)
+        if pot_id in states:
+            return states[pot_id]
+        token = request.META.get(self._meta_key)
+        if not token:
+            return None
+        try:
+            return signing.loads(token, salt=self._salt(pot_id), max_age=self.max_age)
+        except signing.BadSignature:
+            return None
+
+    def compare_and_set(self, request, pot_id, expected, state):
+        if self.get(request, pot_id) != expected:
+            return False
+        self._states(request)[pot_id] = state
+        return True
+
+    def delete(self, request, pot_id):
+        self._states(request)[pot_id] = None
+
+    def finalize_response(self, request, pot_id, response):
+        state = self.get(request, pot_id)
+        if state is not None:
+            response[self.header] = signing.dumps(
+                state, salt=self._salt(pot_id), compress=True
+            )
+
+
+class BrewDurationEstimator:
+    """
+    Estimate the time taken to brew a beverage from an exponential moving
+    average of the brew durations observed by the current process.
+    """
+
+    def __init__(self, default=60, weight=0.2):
+        self.default = default
+        self.weight = weight
+        self._estimate = None
+        self._lock = threading.Lock()
+
+    @property
+    def estimate(self):
+        """The estimated brew duration in seconds."""
+        estimate = self._estimate
+        return self.default if estimate is None else estimate
+
+    def observe(self, duration):
+        """Record the duration of a beverage brewed in the given seconds."""
+        with self._lock:
+            if self._estimate is None:
+                self._estimate = duration
+            else:
+                self._estimate += self.weight * (duration - self._estimate)
+
+    def reset(self):
+        """Discard every observed duration."""
+        with self._lock:
+            self._estimate = None
+
+
+brew_durations = BrewDurationEstimator()
+
+
+_backend = None
+
+
+def get_pot_state_backend():
+    """
+    Return the pot state backend configured by the ``POT_STATE_BACKEND`` and
+    ``POT_STATE_OPTIONS`` settings.
+
+    The backend is instantiated once, and again whenever one of this app's
+    settings is changed.
+    """
+    global _backend
+    if _backend is None:
+        backend_class = import_string(htcpcp_settings.POT_STATE_BACKEND)
+        _backend = backend_class(**htcpcp_settings.POT_STATE_OPTIONS)
+    return _backend
+
+
+@receiver(setting_changed)
+def _reset_pot_state_backend(setting, **kwargs):
+    global _backend
+    if setting.startswith("HTCPCP_"):
+        _backend = None
@@ -0,0 +1,361 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+"""
+Rendering of the templates of HTCPCP responses.
+
+By default, templates are rendered with ``django.shortcuts.render()``. The
+``HTCPCP_RENDERER`` setting selects a leaner renderer that keeps the compiled
+templates and renders them with a plain context, skipping the template loaders
+and the context processors of the project, or one that renders the bundled
+Jinja2 equivalents of the templates.
+
+Unless the ``HTCPCP_NEGOTIATE_CONTENT`` setting is disabled, clients may
+instead ask for a compact JSON representation of the template context with the
+``Accept`` header, or for an empty body with ``Prefer: return=minimal``. Neither
+representation uses a template engine.
+"""
+
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import render
+from django.template import loader
+from django.template.defaultfilters import pluralize
+
+from .settings import htcpcp_settings
+
+# Renderers that may be selected with the HTCPCP_RENDERER setting.
+RENDERERS = ("django", "lean", "jinja2")
+
+# Number of static response bodies cached by each process.
+STATIC_BODY_CACHE_SIZE = 128
+
+# Number of distinct Accept header values whose negotiated representation is
+# cached by each process.
+ACCEPT_CACHE_SIZE = 64
+
+# Representations of HTCPCP responses that clients may negotiate.
+REPRESENTATIONS = ("html", "json", "empty")
+
+# Compiled templates, by renderer and template name.
+_templates = {}
+
+_jinja2_backend = None
+
+
+def render_htcpcp(request, template_name, context=None, status=None):
+    """
+    Return an HttpResponse whose content is the HTCPCP template with the given
+    name rendered with the given context.
+
+    The template is rendered by the renderer selected by the ``RENDERER``
+    setting. Only the ``"django"`` renderer makes the request available to the
+    template.
+
+    If the client negotiated the JSON or the empty representation, the context
+    is serialized as JSON or discarded instead, and no template is rendered.
+    """
+    representation = get_representation(request)
+    if representation != "html":
+        return _render_representation(representation, context, status)
+    renderer = htcpcp_settings.RENDERER
+    if renderer == "django":
+        return render(request, template_name, context, status=status)
+    return HttpResponse(
+        get_htcpcp_template(template_name).render(context), status=status
+    )
+
+
+def render_static_htcpcp(request, template_name, error_reason=None, status=None):
+    """
+    Return an HttpResponse whose content is the HTCPCP template with the given
+    name rendered with nothing but the given error reason in its context.
+
+    With the ``"lean"`` and ``"jinja2"`` renderers, the encoded content is
+    cached for the most recently rendered template and reason pairs, and
+    served without rendering the template again. Nothing is cached when the
+    ``DEBUG`` setting is enabled.
+    """
+    if (
+        htcpcp_settings.RENDERER == "django"
+        or settings.DEBUG
+        or get_representation(request) != "html"
+    ):
+        context = None if error_reason is None else {"error_reason": error_reason}
+        return render_htcpcp(request, template_name, context, status=status)
+    return HttpResponse(_render_static_body(template_name, error_reason), status=status)
+
+
+@lru_cache(maxsize=STATIC_BODY_CACHE_SIZE)
+def _render_static_body(template_name, error_reason):
+    context = None if error_reason is None else {"error_reason": error_reason}
+    content = get_htcpcp_template(template_name).render(context)
+    return content.encode(settings.DEFAULT_CHARSET)
+
+
+def get_representation(request):
+    """
+    Return the representation of HTCPCP responses negotiated by the client of
+    the given request, one of ``"html"``, ``"json"``, or ``"empty"``.
+
+    The empty representation is chosen for requests that include the
+    ``return=minimal`` preference (RFC 7240), and the JSON representation for
+    requests whose ``Accept`` header ranks ``application/json`` above
+    ``text/html``. Otherwise, and whenever the ``NEGOTIATE_CONTENT`` setting is
+    disabled, responses are rendered as HTML.
+    """
+    if not htcpcp_settings.NEGOTIATE_CONTENT:
+        return "html"
+    prefer = request.META.get("HTTP_PREFER")
+    if prefer and _prefers_minimal(prefer):
+        return "empty"
+    accept = request.META.get("HTTP_ACCEPT")
+    if accept and _accepts_json(accept):
+        return "json"
+    return "html"
+
+
+def _prefers_minimal(prefer):
+    for preference in prefer.split(","):
+        token = preference.split(";", 1)[0]
+        if token.replace(" ", "").lower() == "return=minimal":
+            return True
+    return False
+
+
+@lru_cache(maxsize=ACCEPT_CACHE_SIZE)
+def _accepts_json(accept):
+    """Return True if the Accept header value ranks JSON above HTML."""
+    media_ranges = []
+    for media_range in accept.split(","):
+        media_type, *params = media_range.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_ranges.append((media_type.strip().lower(), quality))
+
+    json_rank = _rank_media_type(media_ranges, "application/json")
+    return json_rank[0] > 0 and json_rank > _rank_media_type(media_ranges, "text/html")
+
+
+def _rank_media_type(media_ranges, media_type):
+    """
+    Return the quality of the given media type according to the most specific
+    of the given media ranges that matches it, and the specificity of that
+    range, or ``(0, -1)`` if no range matches.
+    """
+    patterns = ("*/*", media_type.split("/")[0] + "/*", media_type)
+    quality, specificity = 0.0, -1
+    for media_range, range_quality in media_ranges:
+        try:
+            range_specificity = patterns.index(media_range)
+        except ValueError:
+            continue
+        if range_specificity > specificity:
+            quality, specificity = range_quality, range_specificity
+    return quality, specificity
+
+
+def _render_representation(representation, context, status):
+    if representation == "empty":
+        response = HttpResponse(status=status)
+        response["Preference-Applied"] = "return=minimal"
+    else:
+        response = JsonResponse(
+            serialize_context(context or {}),
+            status=status,
+            json_dumps_params={"separators": (",", ":")},
+        )
+    response.htcpcp_representation = representation
+    return response
+
+
+def serialize_context(context):
+    """
+    Return the JSON-serializable representation of the context of an HTCPCP
+    template.
+
+    Variables that are only used to lay out the HTML representation are
+    omitted.
+    """
+    data = {}
+    for name, value in context.items():
+        try:
+            serializer = _CONTEXT_SERIALIZERS[name]
+        except KeyError:
+            continue
+        data[name] = serializer(value)
+    return data
+
+
+def _serialize_pot(pot):
+    return {"id": pot.id, "name": pot.name}
+
+
+def _serialize_additions(additions):
+    return [
+        {
+            "name": _resolve_variable(addition, "name"),
+            "type": _resolve_variable(addition, "get_type_display"),
+        }
+        for addition in additions
+    ]
+
+
+def _serialize_alternatives(alternatives):
+    return [{"uri": uri, "type": content_type} for uri, content_type in alternatives]
+
+
+def _serialize_combinations(combinations):
+    return [_resolve_variable(combination, "reason") for combination in combinations]
+
+
+def _identity(value):
+    return value
+
+
+_CONTEXT_SERIALIZERS = {
+    "pot": _serialize_pot,
+    "beverage": _identity,
+    "additions": _serialize_additions,
+    "alternatives": _serialize_alternatives,
+    "error_reason": _identity,
+    "queue_position": _identity,
+    "estimated_wait": _identity,
+    "retry_after": _identity,
+    "brew_duration": _identity,
+    "supported_additions": _serialize_additions,
+    "unsupported_additions": list,
+    "matched_combinations": _serialize_combinations,
+}
+
+
+def render_htcpcp_to_string(request, template_name, context=None):
+    """
+    Return the HTCPCP template with the given name rendered with the given
+    context as a string, using the renderer selected by the ``RENDERER``
+    setting.
+    """
+    if htcpcp_settings.RENDERER == "django":
+        return loader.render_to_string(template_name, context, request)
+    return get_htcpcp_template(template_name).render(context)
+
+
+def get_htcpcp_template(template_name):
+    """
+    Return the compiled HTCPCP template with the given name for the renderer
+    selected by the ``RENDERER`` setting.
+
+    Templates are compiled once and kept until the settings change, unless the
+    ``DEBUG`` setting is enabled, in which case they are loaded every time so
+    that changes to them are seen.
+    """
+    renderer = htcpcp_settings.RENDERER
+    key = (renderer, template_name)
+    try:
+        return _templates[key]
+    except KeyError:
+        pass
+
+    if renderer in ("django", "lean"):
+        template = loader.get_template(template_name)
+    elif renderer == "jinja2":
+        template = _get_jinja2_backend().get_template(template_name)
+    else:
+        raise ImproperlyConfigured(
+            "Unknown HTCPCP_RENDERER {!r}, expected one of {}".format(
+                renderer, ", ".join(RENDERERS)
+            )
+        )
+
+    if not settings.DEBUG:
+        _templates[key] = template
+    return template
+
+
+def _get_jinja2_backend():
+    global _jinja2_backend
+    if _jinja2_backend is None:
+        try:
+            from django.template.backends.jinja2 import Jinja2
+        except ImportError:
+            raise ImproperlyConfigured(
+                "The jinja2 HTCPCP_RENDERER requires Jinja2 to be installed"
+            )
+        # Templates are found in the jinja2 directory of each installed app,
+        # so that apps listed before this one can override them.
+        _jinja2_backend = Jinja2(
+            {
+                "NAME": "django_htcpcp_tea",
+                "DIRS": [],
+                "APP_DIRS": True,
+                "OPTIONS": {
+                    "environment": "django_htcpcp_tea.renderer.jinja2_environment"
+                },
+            }
+        )
+    return _jinja2_backend
+
+
+def jinja2_environment(**options):
+    """
+    Return a Jinja2 environment providing the filters used by the bundled
+    Jinja2 templates.
+    """
+    from jinja2 import Environment
+
+    environment = Environment(**options)
+    environment.filters["pluralize"] = pluralize
+    environment.filters["regroup"] = regroup
+    return environment
+
+
+def regroup(items, attribute):
+    """
+    Group consecutive items by the value of the given attribute, like Django's
+    ``regroup`` tag.
+
+    Return a list of ``(grouper, items)`` pairs. As with Django's template
+    variables, dictionary keys are looked up before attributes, and callable
+    attributes are called.
+    """
+    groups = []
+    for item in items:
+        grouper = _resolve_variable(item, attribute)
+        if groups and groups[-1][0] == grouper:
+            groups[-1][1].append(item)
+        else:
+            groups.append((grouper, [item]))
+    return groups
+
+
+def _resolve_variable(item, attribute):
+    # Look up template variables like Django's templates do, since the
+    # additions of beverages brewed earlier are stored as dictionaries.
+    try:
+        value = item[attribute]
+    except (TypeError, KeyError):
+        value = getattr(item, attribute)
+    return value() if callable(value) else value
+
+
+@receiver(setting_changed)
+def _reset_templates(setting, **kwargs):
+    global _jinja2_backend
+    if setting in ("TEMPLATES", "DEBUG") or setting.startswith("HTCPCP_"):
+        _templates.clear()
+        _render_static_body.cache_clear()
+        _jinja2_backend = None
@@ -5,50 +5,89 @@
 #  at https://opensource.org/licenses/MIT.
 
 from django.conf import settings as django_settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
 
 
 class _HTCPCPTeaSettings:
     """
-    Proxy to the standard Django settings that provides defaults for some
-    of this app's settings.
+    Snapshot of this app's settings as resolved from the standard Django
+    settings, with defaults for any settings that are not configured.
+
+    Settings are resolved once and stored as plain instance attributes. The
+    snapshot is rebuilt whenever Django's ``setting_changed`` signal reports
+    a change to one of this app's settings (e.g. from ``override_settings``).
     """
 
     ALLOW_DEPRECATED_POST = True
 
+    ALTERNATES_HEADER_LIMIT = None
+
+    BREW_QUEUE_SIZE = 0
+
+    CACHE_ALTERNATES = False
+
+    CATALOG_SNAPSHOT = False
+
     CHECK_FORBIDDEN = True
 
     RESPONSE_CONTENT_TYPE = None
 
     DISABLE_CSRF = True
 
+    FORBIDDEN_ENGINE = "python"
+
     GET_ADDITIONS = True
 
+    INDEX_DISPATCH = None
+
+    MAX_ADDITIONS = 32
+
+    MAX_REQUEST_BODY = 1024
+
+    NEGOTIATE_CONTENT = True
+
     OVERRIDE_ROOT_URI = False
 
     OVERRIDE_SERVER_NAME = True
 
     POT_SESSIONS = True
 
+    POT_STATE_BACKEND = "django_htcpcp_tea.pot_state.SessionPotStateBackend"
+
+    POT_STATE_OPTIONS = {}
+
+    RENDERER = "django"
+
+    STREAM_OPTIONS = False
+
     STRICT_MIME_TYPE = True
 
     STRICT_REQUEST_BODY = False
 
+    URL_PREFIXES = None
+
     USE_SAFE_HEADER_EXT = True
 
     def __init__(self, settings_prefix):
         self.prefix = settings_prefix
+        self.reload()
 
-    def __getattribute__(self, item):
-        try:
-            return getattr(
-                django_settings,
-                "{}_{}".format(
-                    object.__getattribute__(self, "prefix"),
-                    item,
-                ),
-            )
-        except AttributeError:
-            return object.__getattribute__(self, item)
+    def reload(self):
+        """Resolve each of this app's settings from the Django settings."""
+        for name in vars(_HTCPCPTeaSettings):
+            if name.isupper():
+                default = getattr(_HTCPCPTeaSettings, name)
+                value = getattr(
+                    django_settings, "{}_{}".format(self.prefix, name), default
+                )
+                setattr(self, name, value)
 
 
 htcpcp_settings = _HTCPCPTeaSettings("HTCPCP")
+
+
+@receiver(setting_changed)
+def _reload_htcpcp_settings(setting, **kwargs):
+    if setting.startswith(htcpcp_settings.prefix + "_"):
+        htcpcp_settings.reload()
@@ -4,77 +4,353 @@
 #  MIT License was not distributed with this file, you can obtain one
 #  at https://opensource.org/licenses/MIT.
 
+import hashlib
+from functools import lru_cache
+from itertools import islice
+
+from django.core.exceptions import SuspiciousOperation
 from django.db.models import Q
-from django.urls import reverse
+from django.urls import NoReverseMatch, get_script_prefix, get_urlconf, reverse
+from django.utils.functional import cached_property
 
-from .models import ForbiddenCombination, Pot
+from .catalog import (
+    cached_by_catalog_version,
+    get_capability_index,
+    get_catalog,
+    get_forbidden_combination_matcher,
+)
+from .models import ForbiddenCombination, Pot, normalize_addition_names
 from .settings import htcpcp_settings
 
+# Placeholder URL arguments used to resolve the URL templates for alternates.
+_POT_PLACEHOLDER = 918273645
+
+_TEA_PLACEHOLDER = "htcpcp-tea-placeholder"
+
 
-def build_alternates(index_pot=None):
+def build_alternates(index_pot=None, pots=None):
     """
     Generate the Alternates pairs for available beverages, optionally
-    for a specific pot.
+    for a specific pot or for a specific iterable of pots.
     """
     if index_pot:
         pots = (index_pot,)
+    elif pots is not None:
+        pass
+    elif htcpcp_settings.CATALOG_SNAPSHOT:
+        pots = get_catalog().pots.values()
     else:
         pots = Pot.objects.prefetch_related("supported_teas").all()
+    templates = None
     for pot in pots:
+        # Resolve the templates lazily, so that no URLs are reversed when
+        # there are no pots.
+        if templates is None:
+            pot_uri, tea_uri = templates = get_alternates_uri_templates()
         if pot.brew_coffee:
-            yield reverse("pot-detail", args=[pot.id]), "message/coffeepot"
+            yield pot_uri.format(pot.id), "message/coffeepot"
         for tea in pot.supported_teas.all():
-            yield reverse("pot-detail-tea", args=[pot.id, tea.slug]), "message/teapot"
+            yield tea_uri.format(pot.id, tea.slug), "message/teapot"
+
+
+def iter_alternates(pots=None):
+    """
+    Generate the Alternates pairs for available beverages by streaming rows
+    from the database, optionally for a specific queryset of pots.
+
+    Unlike ``build_alternates``, no model instances are created, and the rows
+    are fetched from the database in chunks.
+    """
+    if pots is None:
+        pots = Pot.objects.all()
+    rows = pots.order_by("pk", "supported_teas__pk").values_list(
+        "id", "brew_coffee", "supported_teas__slug"
+    )
+    templates = None
+    previous_pot_id = None
+    for pot_id, brew_coffee, tea_slug in rows.iterator():
+        if templates is None:
+            pot_uri, tea_uri = templates = get_alternates_uri_templates()
+        if pot_id != previous_pot_id:
+            previous_pot_id = pot_id
+            if brew_coffee:
+                yield pot_uri.format(pot_id), "message/coffeepot"
+        if tea_slug is not None:
+            yield tea_uri.format(pot_id, tea_slug), "message/teapot"
+
+
+def get_alternates_uri_templates():
+    """
+    Return format strings for the URIs of pots and of the teas served by pots.
+
+    The pot URI template accepts a pot id, and the tea URI template accepts a
+    pot id and a tea slug. The templates are resolved with ``reverse()`` once
+    for each script prefix and urlconf.
+    """
+    return _resolve_alternates_uri_templates(get_script_prefix(), get_urlconf())
+
+
+@cached_by_catalog_version
+def _resolve_alternates_uri_templates(script_prefix, urlconf):
+    def to_template(uri):
+        uri = uri.replace("{", "{{").replace("}", "}}")
+        return uri.replace(str(_POT_PLACEHOLDER), "{0}").replace(
+            _TEA_PLACEHOLDER, "{1}"
+        )
+
+    pot_uri = reverse("pot-detail", args=[_POT_PLACEHOLDER])
+    tea_uri = reverse("pot-detail-tea", args=[_POT_PLACEHOLDER, _TEA_PLACEHOLDER])
+    return to_template(pot_uri), to_template(tea_uri)
+
+
+class Alternates(tuple):
+    """
+    Immutable sequence of (uri, content-type) Alternates pairs that renders
+    its Alternates header value at most once.
+    """
+
+    @cached_property
+    def header(self):
+        """The RFC 2295 Alternates header value for these pairs."""
+        return _format_alternates_header(self)
+
+    @cached_property
+    def etag(self):
+        """
+        A strong entity tag for these pairs, or None if there are no pairs.
+        """
+        return _hash_alternates(self)
+
+
+def get_alternates(index_pot=None):
+    """
+    Return the Alternates for available beverages, optionally for a specific
+    pot.
+
+    If the ``CACHE_ALTERNATES`` setting is enabled, the Alternates are cached
+    until the catalog is next invalidated.
+    """
+    if htcpcp_settings.CACHE_ALTERNATES:
+        # URIs depend on the script prefix and urlconf of the current request
+        return _get_cached_alternates(
+            index_pot.pk if index_pot else None,
+            get_script_prefix(),
+            get_urlconf(),
+            index_pot=index_pot,
+        )
+    return Alternates(build_alternates(index_pot))
+
+
+def get_capable_alternates(addition_names):
+    """
+    Return the Alternates for the beverages of the pots that support every
+    addition whose name is given.
+
+    The pots are found with the capability index. Unlike ``get_alternates``,
+    the result is never cached, since it depends on the requested additions.
+    """
+    pot_ids = get_capability_index().find_pots(addition_names=addition_names)
+    if htcpcp_settings.CATALOG_SNAPSHOT:
+        catalog = get_catalog()
+        pots = [catalog.pots[pot_id] for pot_id in pot_ids]
+    else:
+        pots = Pot.objects.filter(pk__in=pot_ids).prefetch_related("supported_teas")
+    return Alternates(build_alternates(pots=pots))
+
+
+@cached_by_catalog_version
+def _get_cached_alternates(pot_id, script_prefix, urlconf, index_pot=None):
+    return Alternates(build_alternates(index_pot))
+
+
+def get_alternates_etag(pot_id=None):
+    """
+    Return a strong entity tag for the alternatives for available beverages,
+    optionally for the pot with the given id.
+
+    The tag is derived from the alternatives themselves. If the
+    ``CACHE_ALTERNATES`` or ``CATALOG_SNAPSHOT`` setting is enabled, the tag
+    is cached until the catalog is next invalidated, so that a client's tag
+    can be checked without querying the database.
+
+    Return None if there are no such alternatives.
+    """
+    if htcpcp_settings.CACHE_ALTERNATES or htcpcp_settings.CATALOG_SNAPSHOT:
+        return _get_cached_alternates_etag(pot_id, get_script_prefix(), get_urlconf())
+    return _compute_alternates_etag(pot_id)
+
+
+@cached_by_catalog_version
+def _get_cached_alternates_etag(pot_id, script_prefix, urlconf):
+    return _compute_alternates_etag(pot_id)
+
+
+def _compute_alternates_etag(pot_id):
+    if htcpcp_settings.CATALOG_SNAPSHOT:
+        if pot_id is None:
+            alternates = build_alternates()
+        else:
+            pot = get_catalog().get_pot(pot_id)
+            alternates = build_alternates(pot) if pot else ()
+    elif pot_id is None:
+        alternates = iter_alternates()
+    else:
+        alternates = iter_alternates(Pot.objects.filter(pk=pot_id))
+
+    return _hash_alternates(alternates)
+
+
+def _hash_alternates(alternates_pairs):
+    digest = hashlib.sha1()
+    empty = True
+    for uri, content_type in alternates_pairs:
+        digest.update("{} {}\n".format(uri, content_type).encode("utf-8"))
+        empty = False
+    return None if empty else '"{}"'.format(digest.hexdigest())
+
+
+# Number of alternatives listed in the Alternates header of responses while
+# options are streamed, unless HTCPCP_ALTERNATES_HEADER_LIMIT is set.
+STREAMED_ALTERNATES_HEADER_LIMIT = 100
+
+
+def get_alternates_header_limit():
+    """
+    Return the maximum number of alternatives listed in an ``Alternates``
+    header, or None if every alternative is listed.
+
+    While the ``STREAM_OPTIONS`` setting is enabled, the header is always
+    limited, since it must be rendered in full before the listing is streamed.
+    """
+    limit = htcpcp_settings.ALTERNATES_HEADER_LIMIT
+    if limit is None and htcpcp_settings.STREAM_OPTIONS:
+        return STREAMED_ALTERNATES_HEADER_LIMIT
+    return limit
 
 
 def render_alternates_header(alternates_pairs):
     """
     Render (uri, content-type) pairs into an RFC 2295 Alternates header value.
     """
+    if isinstance(alternates_pairs, Alternates):
+        return alternates_pairs.header
+    return _format_alternates_header(alternates_pairs)
+
+
+def _format_alternates_header(alternates_pairs):
     fmt = '{{"{}" {{type {}}}}}'
-    return ",".join(fmt.format(*pair) for pair in alternates_pairs)
+    limit = get_alternates_header_limit()
+    if limit is None:
+        return ",".join(fmt.format(*pair) for pair in alternates_pairs)
+
+    alternates_pairs = iter(alternates_pairs)
+    variants = [fmt.format(*pair) for pair in islice(alternates_pairs, limit)]
+    if next(alternates_pairs, None) is not None:
+        # Refer clients to the complete listing of beverages with an RFC 2295
+        # fallback variant.
+        try:
+            variants.append('{{"{}"}}'.format(reverse("htcpcp-index")))
+        except NoReverseMatch:
+            pass
+    return ",".join(variants)
+
+
+# Number of distinct Accept-Additions header values whose parsed names are
+# cached by each process.
+ACCEPT_ADDITIONS_CACHE_SIZE = 256
+
+
+class TooManyAdditions(SuspiciousOperation):
+    """The request lists more additions than ``HTCPCP_MAX_ADDITIONS``."""
 
 
 def resolve_requested_additions(request):
     """
-    Return the requested additions for the provided request.
+    Return a tuple of the names of the requested additions for the provided
+    request, without surrounding whitespace, blanks or duplicates.
 
     Additions may be requested in the ``Accept-Additions`` header field, or
     (if the ``HTCPCP_GET_ADDITIONS`` settings is enabled) in the query string
     of a uri.
 
+    If the request lists more additions than the ``HTCPCP_MAX_ADDITIONS``
+    setting allows, raise TooManyAdditions.
+
     Note that the returned additions are not guaranteed to be valid additions
     that are supported by any pot.
     """
-    try:
-        header = request.META["HTTP_ACCEPT_ADDITIONS"]
-        additions = [addition.strip() for addition in header.split(",")]
-    except KeyError:
-        additions = []
+    limit = htcpcp_settings.MAX_ADDITIONS
+
+    header = request.META.get("HTTP_ACCEPT_ADDITIONS")
+    if header:
+        # Count the separators before splitting, so that huge headers are
+        # rejected cheaply. Blank items are allowed for, since they are only
+        # dropped once the header is parsed.
+        if limit is not None and header.count(",") > 2 * limit:
+            raise TooManyAdditions(
+                "The Accept-Additions header lists more than {} additions.".format(
+                    limit
+                )
+            )
+        additions = parse_accept_additions(header)
+    else:
+        additions = ()
+
+    if htcpcp_settings.GET_ADDITIONS and request.GET:
+        additions = normalize_addition_names(additions + tuple(request.GET))
 
-    if htcpcp_settings.GET_ADDITIONS:
-        additions += request.GET.dict().keys()
+    if limit is not None and len(additions) > limit:
+        raise TooManyAdditions(
+            "The request lists more than {} additions.".format(limit)
+        )
 
     return additions
 
 
+@lru_cache(maxsize=ACCEPT_ADDITIONS_CACHE_SIZE)
+def parse_accept_additions(header):
+    """
+    Return a tuple of the names of the additions listed in an
+    ``Accept-Additions`` header value, without surrounding whitespace, blanks
+    or duplicates.
+
+    Results are cached for the most recently parsed header values.
+    """
+    return normalize_addition_names(header.split(","))
+
+
 def find_forbidden_combinations(requested_additions, tea_slug=None):
     """
     Return the list of ForbiddenCombinations that prohibit some part of the
     requested additions.
     """
+    if htcpcp_settings.CATALOG_SNAPSHOT:
+        return get_catalog().find_forbidden_combinations(requested_additions, tea_slug)
 
-    requested_additions = set(requested_additions)
+    if htcpcp_settings.FORBIDDEN_ENGINE == "bitmask":
+        return get_forbidden_combination_matcher().match(
+            (a.id for a in requested_additions), tea_slug
+        )
 
-    # Calls to ForbiddenCombination.forbids_additions will need the full
-    # list of forbidden additions for each retrieved objects.
-    forbidden = ForbiddenCombination.objects.prefetch_related("additions")
+    requested_additions = set(requested_additions)
 
     if tea_slug:
-        forbidden = forbidden.filter(Q(tea__slug=tea_slug) | Q(tea__isnull=True))
+        forbidden = ForbiddenCombination.objects.filter(
+            Q(tea__slug=tea_slug) | Q(tea__isnull=True)
+        )
     else:
-        forbidden = forbidden.filter(tea__isnull=True)
+        forbidden = ForbiddenCombination.objects.filter(tea__isnull=True)
+
+    if htcpcp_settings.FORBIDDEN_ENGINE == "sql":
+        # Filter ForbiddenCombinations by what additions they forbid with a
+        # single aggregated query.
+        forbidden = forbidden.forbidding_additions(requested_additions)
+        return list(forbidden.order_by("pk"))
+
+    # Calls to ForbiddenCombination.forbids_additions will need the full
+    # list of forbidden additions for each retrieved objects.
+    forbidden = forbidden.prefetch_related("additions")
 
     # Filter ForbiddenCombinations by what additions they forbid in Python
-    # since I could not find a way to accomplish this purely in the database.
+    # to avoid the aggregation required to do so in the database.
     return [fc for fc in forbidden if fc.forbids_additions(requested_additions)]
@@ -5,69 +5,161 @@
 #  at https://opensource.org/licenses/MIT.
 
 from datetime import datetime
+from itertools import islice
+from math import ceil
 
-from django.shortcuts import get_object_or_404, render
+from django.db import transaction
+from django.http import Http404, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags
 
+from .catalog import get_catalog, load_pot_record
 from .decorators import require_htcpcp
-from .models import Addition, Pot
+from .dispatch import choose_coffee_pot
+from .models import AdditionsNotSupported
+from .pot_state import brew_durations, get_pot_state_backend
+from .renderer import (
+    get_htcpcp_template,
+    get_representation,
+    render_htcpcp,
+    render_htcpcp_to_string,
+    render_static_htcpcp,
+)
 from .settings import htcpcp_settings
 from .utils import (
+    TooManyAdditions,
     build_alternates,
     find_forbidden_combinations,
+    get_alternates,
+    get_alternates_etag,
+    get_alternates_header_limit,
+    get_capable_alternates,
+    iter_alternates,
     resolve_requested_additions,
 )
 
+# Number of alternatives rendered at a time in streamed options responses.
+OPTIONS_STREAM_CHUNK_SIZE = 100
+
+# Marks where the alternatives are streamed into the options page.
+_ALTERNATIVES_PLACEHOLDER = "htcpcp-alternatives-placeholder"
+
+# Number of times a request is evaluated against the state of a pot before
+# giving up because of concurrent changes to the state.
+POT_STATE_ATTEMPTS = 3
 
+# Marks a beverage request that does not change the state of a pot.
+_UNCHANGED = object()
+
+
+# Caches derived from the catalog are not filled inside transactions, so HTCPCP
+# requests are not wrapped in one by the ATOMIC_REQUESTS setting. Pot states
+# are only ever changed by single conditional updates.
+@transaction.non_atomic_requests
 @require_htcpcp
 def brew_pot(request, pot_designator=None, tea_type=None):
-    if not pot_designator:
-        alternates = list(build_alternates())
-        context = {"alternatives": alternates}
-        response = render(
-            request, "django_htcpcp_tea/options.html", context, status=300
+    try:
+        addition_names = resolve_requested_additions(request)
+    except TooManyAdditions as e:
+        return render_static_htcpcp(
+            request, "django_htcpcp_tea/400.html", str(e), status=400
         )
-        response.htcpcp_alternates = alternates
-        return response
+
+    if not pot_designator:
+        if (
+            htcpcp_settings.INDEX_DISPATCH
+            and request.htcpcp_message_type == "start"
+            and not _request_for_tea(request, tea_type)
+        ):
+            pot_id = choose_coffee_pot(request, addition_names)
+            if pot_id is not None:
+                response = brew_pot(request, pot_designator=pot_id)
+                response["Content-Location"] = reverse("pot-detail", args=[pot_id])
+                return response
+
+        response = None
+        if (
+            htcpcp_settings.STREAM_OPTIONS
+            and not addition_names
+            and get_representation(request) == "html"
+        ):
+            etag = _negotiated_etag(request, get_alternates_etag())
+            if _etag_matches(request, etag):
+                return _options_not_modified(etag)
+            response = _stream_options(request)
+        if response is None:
+            if addition_names:
+                # Only list the beverages of the pots that support every
+                # requested addition.
+                alternates = get_capable_alternates(addition_names)
+            else:
+                alternates = get_alternates()
+            etag = _negotiated_etag(request, alternates.etag)
+            if _etag_matches(request, etag):
+                return _options_not_modified(etag)
+            context = {"alternatives": alternates}
+            response = render_htcpcp(
+                request, "django_htcpcp_tea/options.html", context, status=300
+            )
+            response.htcpcp_alternates = alternates
+        return _patch_options_cache_headers(response, etag)
 
     if request.method == "WHEN" and request.htcpcp_message_type == "start":
-        return render(
+        return render_static_htcpcp(
             request,
             "django_htcpcp_tea/400.html",
-            {"error_reason": "Cannot start a beverage with a WHEN request."},
+            "Cannot start a beverage with a WHEN request.",
             status=400,
         )
 
-    pot = get_object_or_404(Pot, id=pot_designator)
+    tea_options_requested = (
+        _request_for_tea(request, tea_type)
+        and request.htcpcp_message_type == "start"
+        and not tea_type
+    )
+    if tea_options_requested and (
+        htcpcp_settings.CACHE_ALTERNATES or htcpcp_settings.CATALOG_SNAPSHOT
+    ):
+        # Check the client's cached copy of the pot's options before the pot
+        # is fetched, since it can be answered without touching the database.
+        etag = _negotiated_etag(request, get_alternates_etag(pot_designator))
+        if _etag_matches(request, etag):
+            return _options_not_modified(etag)
+
+    pot = _get_pot(pot_designator)
 
     if _request_for_tea(request, tea_type):
         response = _precheck_teapot(request, pot, tea_type)
         # Beverage name only required when starting a new beverage
-        beverage_name = "{} Tea".format(tea_type.capitalize) if tea_type else None
+        beverage_name = "{} Tea".format(tea_type.capitalize()) if tea_type else None
     else:
         response = _precheck_coffee(request, pot)
         beverage_name = "coffee"
 
     if response is None:
-        addition_names = resolve_requested_additions(request)
         try:
             additions = list(pot.fetch_additions(addition_names))
-        except Addition.DoesNotExist:
-            # Fetch all supported additions for the requested pot.
-            # Note that this will result in an additional query.
-            context = {"supported_additions": pot.supported_additions.all()}
-            return render(request, "django_htcpcp_tea/406.html", context, status=406)
+        except AdditionsNotSupported as e:
+            context = {
+                "supported_additions": pot.supported_additions.all(),
+                "unsupported_additions": e.names,
+            }
+            return render_htcpcp(
+                request, "django_htcpcp_tea/406.html", context, status=406
+            )
 
         if htcpcp_settings.CHECK_FORBIDDEN:
             forbidden = find_forbidden_combinations(additions, tea_type)
 
             if forbidden:
                 context = {"matched_combinations": forbidden}
-                return render(
+                return render_htcpcp(
                     request, "django_htcpcp_tea/403.html", context, status=403
                 )
 
         if htcpcp_settings.POT_SESSIONS:
-            response = _finalize_beverage_with_session(
+            response = _finalize_beverage_with_state(
                 request, pot, beverage_name, additions
             )
         else:
@@ -76,6 +168,133 @@ def brew_pot(request, pot_designator=None, tea_type=None):
     return response
 
 
+def _negotiated_etag(request, etag):
+    """
+    Return the entity tag of an options listing in the representation
+    negotiated by the client of the request.
+
+    Strong entity tags must differ between the representations of a resource
+    (RFC 7232 section 2.1), so the tags of the JSON and empty representations
+    are suffixed with the name of the representation.
+    """
+    if etag is None:
+        return None
+    representation = get_representation(request)
+    if representation == "html":
+        return etag
+    return '{}-{}"'.format(etag[:-1], representation)
+
+
+def _etag_matches(request, etag):
+    """
+    Return True if the If-None-Match header of the request matches the given
+    entity tag.
+    """
+    if etag is None:
+        return False
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if not if_none_match:
+        return False
+    for tag in parse_etags(if_none_match):
+        # If-None-Match uses the weak comparison function (RFC 7232 3.2)
+        if tag == "*" or tag == etag or tag == "W/" + etag:
+            return True
+    return False
+
+
+def _options_not_modified(etag):
+    """
+    Return a 304 Not Modified response for an options listing that the client
+    already holds.
+    """
+    return _patch_options_cache_headers(HttpResponseNotModified(), etag)
+
+
+def _patch_options_cache_headers(response, etag):
+    """
+    Add the entity tag of an options listing to the response, and require
+    clients to revalidate their cached copies of the listing before use.
+    """
+    if etag is not None:
+        response["ETag"] = etag
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def _stream_options(request):
+    """
+    Return a streaming 300 response listing the alternatives for every
+    available beverage.
+
+    The alternatives are streamed from the database in chunks, so that the
+    listing is never held in memory all at once. Return None if the options
+    template does not include the alternatives template, since the page cannot
+    be split around the alternatives.
+    """
+    page = render_htcpcp_to_string(
+        request,
+        "django_htcpcp_tea/options.html",
+        {"alternatives_placeholder": _ALTERNATIVES_PLACEHOLDER},
+    )
+    parts = page.split(_ALTERNATIVES_PLACEHOLDER)
+    if len(parts) != 2:
+        return None
+    head, tail = parts
+
+    def stream_alternates():
+        if htcpcp_settings.CATALOG_SNAPSHOT:
+            return build_alternates()
+        return iter_alternates()
+
+    # One extra alternative reveals whether the header must be truncated.
+    limit = get_alternates_header_limit()
+    header_alternates = list(islice(stream_alternates(), limit + 1))
+
+    response = StreamingHttpResponse(
+        _render_options_stream(head, tail, stream_alternates()), status=300
+    )
+    response.htcpcp_alternates = header_alternates
+    return response
+
+
+def _render_options_stream(head, tail, alternates):
+    """
+    Generate the options page in chunks for the given alternatives, between
+    the parts of the page before and after the alternatives.
+    """
+    yield head
+
+    items_template = get_htcpcp_template(
+        "django_htcpcp_tea/includes/alternative_items.html"
+    )
+    while True:
+        chunk = list(islice(alternates, OPTIONS_STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        yield items_template.render({"alternatives": chunk})
+
+    yield tail
+
+
+def _get_pot(pot_designator):
+    """
+    Return a PotRecord for the requested pot, or raise Http404 if it does not
+    exist.
+
+    If the ``CATALOG_SNAPSHOT`` setting is enabled, the pot is read from the
+    catalog snapshot without querying the database. Otherwise, the pot is
+    loaded together with its supported teas and additions, so that the
+    prechecks do not issue further queries.
+    """
+    if htcpcp_settings.CATALOG_SNAPSHOT:
+        pot = get_catalog().get_pot(pot_designator)
+    else:
+        pot = load_pot_record(pot_designator)
+    if pot is None:
+        raise Http404("No pot matches the given query.")
+    return pot
+
+
 def _request_for_tea(request, tea_type):
     """
     Determine whether the given request is for tea.
@@ -101,13 +320,13 @@ def _precheck_coffee(request, pot):
     else None.
     """
     if pot.is_teapot:
-        return render(request, "django_htcpcp_tea/418.html", status=418)
+        return render_static_htcpcp(request, "django_htcpcp_tea/418.html", status=418)
 
     if not pot.brew_coffee:
-        return render(
+        return render_static_htcpcp(
             request,
             "django_htcpcp_tea/503.html",
-            {"error_reason": "Pot out of service. No coffee or tea available."},
+            "Pot out of service. No coffee or tea available.",
             status=503,
         )
 
@@ -121,22 +340,21 @@ def _precheck_teapot(request, pot, tea):
     """
     if request.htcpcp_message_type == "start":
         if not tea:  # Require tea type only when starting a new beverage
-            alternatives = list(build_alternates(index_pot=pot))
+            alternatives = get_alternates(index_pot=pot)
+            etag = _negotiated_etag(request, alternatives.etag)
+            if _etag_matches(request, etag):
+                return _options_not_modified(etag)
             context = {"alternatives": alternatives}
-            response = render(
+            response = render_htcpcp(
                 request, "django_htcpcp_tea/options.html", context, status=300
             )
             response.htcpcp_alternates = alternatives
-            return response
-        elif tea not in pot.supported_teas.values_list("slug", flat=True):
-            return render(
+            return _patch_options_cache_headers(response, etag)
+        elif not pot.supports_tea(tea):
+            return render_static_htcpcp(
                 request,
                 "django_htcpcp_tea/503.html",
-                {
-                    "error_reason": "{} is not available for this pot".format(
-                        tea.capitalize
-                    )
-                },
+                "{} is not available for this pot".format(tea.capitalize()),
                 status=503,
             )
     return None
@@ -156,127 +374,203 @@ def _finalize_beverage(request, pot, beverage_name, additions):
     if request.htcpcp_message_type == "start":
         if beverage_name == "coffee":
             # Display alternatives when brewing coffee per RFC 7168 section 2.1.1
-            alternates = list(build_alternates())
+            alternates = get_alternates()
             context["alternatives"] = alternates
-            response = render(
+            response = render_htcpcp(
                 request, "django_htcpcp_tea/brewing.html", context, status=202
             )  # Accepted
             response.htcpcp_alternates = alternates
         else:
-            response = render(
+            response = render_htcpcp(
                 request, "django_htcpcp_tea/brewing.html", context, status=202
             )  # Accepted
     else:  # request.htcpcp_message_type == 'stop':
         if any(addition.is_milk for addition in additions):
-            response = render(
+            response = render_htcpcp(
                 request, "django_htcpcp_tea/pouring.html", context, status=200
             )  # Ok
         else:
-            response = render(
+            response = render_htcpcp(
                 request, "django_htcpcp_tea/finished.html", context, status=201
             )  # Created
 
     return response
 
 
-def _finalize_beverage_with_session(request, pot, beverage_name, additions):
+def _finalize_beverage_with_state(request, pot, beverage_name, additions):
     """
     Return a response to the beverage request according to the HTCPCP standard
-    by referencing the current state of the user's session.
+    by referencing the current state of the pot.
+
+    The state of the pot is kept by the configured pot state backend. If the
+    state is changed by a concurrent request before it can be updated, the
+    request is evaluated again against the new state.
     """
-    session_key = "htcpcp_pot_{}".format(pot.id)
-    pot_status = request.session.get(session_key)
+    backend = get_pot_state_backend()
+    for _ in range(POT_STATE_ATTEMPTS):
+        pot_status = backend.get(request, pot.id)
+        template_name, context, status, new_status = _resolve_beverage_transition(
+            request, pot, beverage_name, additions, pot_status
+        )
+        if new_status is _UNCHANGED or backend.compare_and_set(
+            request, pot.id, pot_status, new_status
+        ):
+            if "brew_duration" in context:
+                brew_durations.observe(context["brew_duration"])
+            response = render_htcpcp(request, template_name, context, status=status)
+            if "retry_after" in context:
+                response["Retry-After"] = context["retry_after"]
+            backend.finalize_response(request, pot.id, response)
+            return response
 
+    response = render_static_htcpcp(
+        request,
+        "django_htcpcp_tea/503.html",
+        "Pot is busy. Please try again later.",
+        status=503,
+    )
+    response["Retry-After"] = 1
+    return response
+
+
+def _resolve_beverage_transition(request, pot, beverage_name, additions, pot_status):
+    """
+    Return the template name, context, and status code of the response to the
+    beverage request given the current state of the pot, along with the new
+    state of the pot.
+
+    The new state is None if the pot becomes idle, or ``_UNCHANGED`` if the
+    state of the pot is not changed by the request.
+    """
     context = {
         "pot": pot,
         "beverage": beverage_name,
         "additions": additions,
     }
 
-    # TODO add brew time and additions display to finished template
+    # TODO add additions display to finished template
+
+    if pot_status and request.htcpcp_message_type == "start":
+        queue = pot_status.get("queue", [])
+        wait = _estimate_wait(pot_status)
+        if len(queue) < htcpcp_settings.BREW_QUEUE_SIZE:
+            # Queue the beverage to be brewed after the pot's current beverage
+            # and the beverages queued before it.
+            context["queue_position"] = len(queue) + 1
+            context["estimated_wait"] = wait
+            new_status = dict(
+                pot_status,
+                queue=queue + [_new_beverage_status(beverage_name, additions)],
+            )
+            return "django_htcpcp_tea/queued.html", context, 202, new_status
+
+        context["beverage"] = pot_status["beverage"]
+        context["additions"] = pot_status["additions"]
+        context["error_reason"] = "Pot is busy and cannot start a new beverage."
+        context["retry_after"] = max(wait, 1)
+        return "django_htcpcp_tea/503.html", context, 503, _UNCHANGED
 
     if pot_status:
         # 'stop' requests may not be able to reproduce the name of a beverage
         # or the additions that were requested, so override these values in the
-        # context with the ones stored in the user's session.
+        # context with the ones stored in the state of the pot.
         context["beverage"] = pot_status["beverage"]
         context["additions"] = pot_status["additions"]
 
-        if request.htcpcp_message_type == "start":
-            context["error_reason"] = "Pot is busy and cannot start a new beverage."
-            response = render(
-                request, "django_htcpcp_tea/503.html", context, status=503
-            )
-        else:  # htcpcp_message_type == 'stop'
-            if request.method == "WHEN":
-                if pot_status["currently_pouring"]:
-                    response = render(
-                        request, "django_htcpcp_tea/finished.html", context, status=201
-                    )
-                    del request.session[session_key]
-                else:
-                    context[
-                        "error_reason"
-                    ] = 'No milk is being poured. Please stop shouting "WHEN!"'
-                    return render(
-                        request, "django_htcpcp_tea/400.html", context, status=400
-                    )
-            else:
-                if pot_status["currently_pouring"]:
-                    context[
-                        "error_reason"
-                    ] = 'Milk is currently being poured. Please say "WHEN"'
-                    response = render(
-                        request, "django_htcpcp_tea/400.html", context, status=400
-                    )
-                elif pot_status["needs_milk"]:  # Stop brewing and begin pouring milk
-                    response = render(
-                        request, "django_htcpcp_tea/pouring.html", context, status=200
-                    )
-                    request.session[session_key].update(
-                        {
-                            "needs_milk": False,
-                            "currently_pouring": True,
-                        }
-                    )
-                    request.session.modified = True
-                else:  # Stop brewing. No milk required.
-                    response = render(
-                        request, "django_htcpcp_tea/finished.html", context, status=201
-                    )
-                    del request.session[session_key]
-    elif request.htcpcp_message_type == "start":
-        # New session, and the client requested a new beverage
+        if request.method == "WHEN":
+            if pot_status["currently_pouring"]:
+                context["brew_duration"] = _elapsed(pot_status)
+                return (
+                    "django_htcpcp_tea/finished.html",
+                    context,
+                    201,
+                    _next_beverage_status(pot_status),
+                )
+            context[
+                "error_reason"
+            ] = 'No milk is being poured. Please stop shouting "WHEN!"'
+            return "django_htcpcp_tea/400.html", context, 400, _UNCHANGED
+
+        if pot_status["currently_pouring"]:
+            context[
+                "error_reason"
+            ] = 'Milk is currently being poured. Please say "WHEN"'
+            return "django_htcpcp_tea/400.html", context, 400, _UNCHANGED
+
+        if pot_status["needs_milk"]:  # Stop brewing and begin pouring milk
+            new_status = dict(pot_status, needs_milk=False, currently_pouring=True)
+            return "django_htcpcp_tea/pouring.html", context, 200, new_status
+
+        # Stop brewing. No milk required.
+        context["brew_duration"] = _elapsed(pot_status)
+        return (
+            "django_htcpcp_tea/finished.html",
+            context,
+            201,
+            _next_beverage_status(pot_status),
+        )
+
+    if request.htcpcp_message_type == "start":
+        # The pot is idle, and the client requested a new beverage
         if beverage_name == "coffee":
             # Display alternatives when brewing coffee per RFC 7168 section 2.1.1
-            context["alternatives"] = build_alternates(index_pot=pot)
-        response = render(
-            request, "django_htcpcp_tea/brewing.html", context, status=202
-        )  # Accepted
-        request.session[session_key] = {
-            "beverage": beverage_name,
-            # Serialize the requested additions to as dictionaries for storage
-            # in the user's session since we do not need actual Addition objects
-            # to display the additions during future requests.
-            "additions": [
-                {"name": a.name, "get_type_display": a.get_type_display()}
-                for a in additions
-            ],
-            "needs_milk": any(addition.is_milk for addition in additions),
-            "currently_pouring": False,
-            "start_time": datetime.utcnow().timestamp(),
-        }
-    else:
-        reason = (
-            "No beverage is being brewed by this pot, but the "
-            "request did not indicate that a new beverage should be "
-            "brewed"
-        )
-        response = render(
-            request, "django_htcpcp_tea/400.html", {"error_reason": reason}, status=400
-        )
+            context["alternatives"] = get_alternates(index_pot=pot)
+        new_status = _new_beverage_status(beverage_name, additions)
+        return "django_htcpcp_tea/brewing.html", context, 202, new_status  # Accepted
 
-    return response
+    reason = (
+        "No beverage is being brewed by this pot, but the "
+        "request did not indicate that a new beverage should be "
+        "brewed"
+    )
+    return "django_htcpcp_tea/400.html", {"error_reason": reason}, 400, _UNCHANGED
+
+
+def _new_beverage_status(beverage_name, additions):
+    """Return the state of a pot that begins brewing the given beverage."""
+    return {
+        "beverage": beverage_name,
+        # Serialize the requested additions as dictionaries for storage
+        # since we do not need actual Addition objects to display the
+        # additions during future requests.
+        "additions": [
+            {"name": a.name, "get_type_display": a.get_type_display()}
+            for a in additions
+        ],
+        "needs_milk": any(addition.is_milk for addition in additions),
+        "currently_pouring": False,
+        "start_time": datetime.utcnow().timestamp(),
+    }
+
+
+def _next_beverage_status(pot_status):
+    """
+    Return the state of a pot after its current beverage is finished.
+
+    The pot begins brewing the first queued beverage, if there is one.
+    """
+    queue = pot_status.get("queue")
+    if not queue:
+        return None
+    next_status = dict(queue[0], start_time=datetime.utcnow().timestamp())
+    if len(queue) > 1:
+        next_status["queue"] = queue[1:]
+    return next_status
+
+
+def _elapsed(pot_status):
+    """Return the seconds since the pot began brewing its current beverage."""
+    return max(datetime.utcnow().timestamp() - pot_status["start_time"], 0)
+
+
+def _estimate_wait(pot_status):
+    """
+    Return the estimated seconds until the pot finishes its current beverage
+    and every queued beverage.
+    """
+    duration = brew_durations.estimate
+    remaining = max(duration - _elapsed(pot_status), 0)
+    return ceil(remaining + duration * len(pot_status.get("queue", ())))
 
 
 if htcpcp_settings.DISABLE_CSRF:
@@ -0,0 +1,148 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+"""
+WSGI entry point that serves ``BREW`` and ``WHEN`` requests for the HTCPCP
+URIs without the rest of the Django stack.
+
+Requests for the URIs of this app's URL patterns are matched against patterns
+compiled from those URIs, and are handled by ``HTCPCPTeaMiddleware`` and the
+``brew_pot`` view alone. The middleware of the project, and the resolution of
+the request path against the project's URL patterns, are skipped. Every other
+request is passed to the project's WSGI application.
+"""
+
+import re
+
+from django.conf import settings
+from django.core import signals
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.handlers.wsgi import WSGIRequest, get_script_name
+from django.core.wsgi import get_wsgi_application as get_django_wsgi_application
+from django.urls import (
+    NoReverseMatch,
+    get_script_prefix,
+    get_urlconf,
+    reverse,
+    set_script_prefix,
+    set_urlconf,
+)
+
+from .catalog import cached_by_catalog_version
+from .middleware import HTCPCPTeaMiddleware
+from .pot_state import SessionPotStateBackend, get_pot_state_backend
+from .settings import htcpcp_settings
+from .utils import _POT_PLACEHOLDER, _TEA_PLACEHOLDER
+from .views import brew_pot
+
+# Request methods served by the fast path. POST requests are always passed to
+# the project, since they are likely to be meant for it.
+FAST_PATH_METHODS = ("BREW", "WHEN")
+
+
+class HTCPCPTeaWSGIHandler:
+    """
+    WSGI application that serves HTCPCP requests directly with
+    ``HTCPCPTeaMiddleware`` and ``brew_pot``, and every other request with
+    the given WSGI application.
+
+    Requests are only served directly if doing so cannot skip a middleware
+    that they need. While the ``DISABLE_CSRF`` setting is disabled, or while
+    the state of pots is stored in sessions, every request is passed to the
+    project's WSGI application.
+    """
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] not in FAST_PATH_METHODS or not _fast_path_safe():
+            return self.application(environ, start_response)
+
+        set_script_prefix(get_script_name(environ))
+        set_urlconf(settings.ROOT_URLCONF)
+        request = WSGIRequest(environ)
+        kwargs = match_htcpcp_route(request.path)
+        if kwargs is None:
+            return self.application(environ, start_response)
+
+        signals.request_started.send(sender=self.__class__, environ=environ)
+
+        def view(request):
+            return brew_pot(request, **kwargs)
+
+        handler = convert_exception_to_response(
+            HTCPCPTeaMiddleware(convert_exception_to_response(view))
+        )
+        response = handler(request)
+        response._handler_class = self.__class__
+
+        status = "{} {}".format(response.status_code, response.reason_phrase)
+        response_headers = [
+            *response.items(),
+            *(("Set-Cookie", c.output(header="")) for c in response.cookies.values()),
+        ]
+        start_response(status, response_headers)
+        return response
+
+
+def _fast_path_safe():
+    """
+    Return True if HTCPCP requests can be served without the middleware of
+    the project.
+    """
+    if not htcpcp_settings.DISABLE_CSRF:
+        return False
+    if htcpcp_settings.POT_SESSIONS and isinstance(
+        get_pot_state_backend(), SessionPotStateBackend
+    ):
+        return False
+    return True
+
+
+def match_htcpcp_route(path):
+    """
+    Return the keyword arguments of ``brew_pot`` for the HTCPCP URI with the
+    given path, or None if the path is not an HTCPCP URI.
+    """
+    for pattern in _compile_routes(get_script_prefix(), get_urlconf()):
+        match = pattern.fullmatch(path)
+        if match:
+            kwargs = match.groupdict()
+            if "pot_designator" in kwargs:
+                kwargs["pot_designator"] = int(kwargs["pot_designator"])
+            return kwargs
+    return None
+
+
+@cached_by_catalog_version
+def _compile_routes(script_prefix, urlconf):
+    def to_pattern(uri):
+        pattern = re.escape(uri)
+        pattern = pattern.replace(
+            re.escape(str(_POT_PLACEHOLDER)), "(?P<pot_designator>[0-9]+)"
+        )
+        pattern = pattern.replace(re.escape(_TEA_PLACEHOLDER), "(?P<tea_type>[^/]+)")
+        return re.compile(pattern)
+
+    try:
+        uris = [
+            reverse("htcpcp-index"),
+            reverse("pot-detail", args=[_POT_PLACEHOLDER]),
+            reverse("pot-detail-tea", args=[_POT_PLACEHOLDER, _TEA_PLACEHOLDER]),
+        ]
+    except NoReverseMatch:
+        # This app's URL patterns are not installed
+        return ()
+    return tuple(to_pattern(uri) for uri in uris)
+
+
+def get_wsgi_application():
+    """
+    Set up Django and return a WSGI application that serves HTCPCP requests
+    directly, and every other request with Django's WSGI application.
+    """
+    return HTCPCPTeaWSGIHandler(get_django_wsgi_application())
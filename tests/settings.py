@@ -4,6 +4,9 @@
 #  MIT License was not distributed with this file, you can obtain one
 #  at https://opensource.org/licenses/MIT.
 
+import os
+import tempfile
+
 SECRET_KEY = 'supr-s3krit-kee'
 
 INSTALLED_APPS = [
@@ -22,11 +25,17 @@ MIDDLEWARE = [
     'django_htcpcp_tea.middleware.HTCPCPTeaMiddleware',
 ]
 
-# Use in-memory SQLite database for tests
+# Use a temporary SQLite database file for tests, since shared in-memory
+# databases do not support the concurrent writers of the concurrency tests.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
+        'TEST': {
+            'NAME': os.path.join(
+                tempfile.gettempdir(), 'django_htcpcp_tea_test_{}.sqlite3'.format(os.getpid())
+            ),
+        },
     }
 }
 
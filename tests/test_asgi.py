@@ -0,0 +1,241 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+import asyncio
+
+from django.db import connections
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import include, path
+from django_htcpcp_tea.asgi import _decode_headers, get_asgi_application
+
+from .utils import HTCPCP_COFFEE_CONTENT
+
+
+def echo(request):
+    return HttpResponse(request.body, content_type='text/plain')
+
+
+def ignore(request):
+    return HttpResponse(status=204)
+
+
+urlpatterns = [
+    path('echo/', echo),
+    path('ignore/', ignore),
+    path('', include('django_htcpcp_tea.urls')),
+]
+
+
+def http_scope(method, path, content_type=HTCPCP_COFFEE_CONTENT, headers=()):
+    return {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'root_path': '',
+        'query_string': b'',
+        'headers': [(b'content-type', content_type.encode())] + list(headers),
+        'client': ('127.0.0.1', 50000),
+        'server': ('testserver', 80),
+    }
+
+
+def call_asgi(application, scope, chunks):
+    """
+    Call the ASGI application with a request whose body is sent in the given
+    chunks, and return the messages sent by the application.
+    """
+    received = []
+    messages = [
+        {'type': 'http.request', 'body': chunk, 'more_body': i < len(chunks) - 1}
+        for i, chunk in enumerate(chunks)
+    ]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        received.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    return received
+
+
+@override_settings(ROOT_URLCONF=__name__, HTCPCP_POT_SESSIONS=False)
+class ASGIHandlerTests(TransactionTestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def setUp(self):
+        self.application = get_asgi_application(max_workers=1)
+
+    def tearDown(self):
+        # Close the database connections of the worker thread.
+        self.application.executor.submit(connections.close_all).result()
+        self.application.executor.shutdown()
+
+    def test_brew_coffee(self):
+        start, body = call_asgi(
+            self.application, http_scope('BREW', '/pot-4/'), [b'sta', b'rt']
+        )
+        self.assertEqual(start['status'], 202)
+        self.assertIn(b'Brewing', body['body'])
+        headers = dict(start['headers'])
+        self.assertTrue(headers[b'alternates'])
+        self.assertTrue(headers[b'server'].startswith(b'HTCPCP-TEA'))
+
+    def test_teapot(self):
+        start, body = call_asgi(
+            self.application, http_scope('BREW', '/pot-3/'), [b'start']
+        )
+        self.assertEqual(start['status'], 418)
+
+    def test_invalid_htcpcp_request(self):
+        start, body = call_asgi(
+            self.application, http_scope('BREW', '/pot-4/'), [b'lemon']
+        )
+        self.assertEqual(start['status'], 404)
+
+    @override_settings(HTCPCP_MAX_REQUEST_BODY=8)
+    def test_oversized_body_not_read(self):
+        chunks = [b'start', b'x' * 8, b'never read']
+        received = []
+
+        def application(scope, receive, send):
+            async def counting_receive():
+                message = await receive()
+                received.append(message)
+                return message
+            return self.application(scope, counting_receive, send)
+
+        start, body = call_asgi(application, http_scope('BREW', '/pot-4/'), chunks)
+        self.assertEqual(start['status'], 413)
+        self.assertEqual(len(received), 2)
+
+    def test_slow_clients_do_not_hold_workers(self):
+        async def brew_slowly():
+            sent = []
+            chunks = [b's', b't', b'a', b'r', b't']
+
+            async def receive():
+                await asyncio.sleep(0.01)
+                chunk = chunks.pop(0)
+                return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+
+            async def send(message):
+                sent.append(message)
+
+            await self.application(http_scope('BREW', '/pot-3/'), receive, send)
+            return sent[0]['status']
+
+        async def brew_concurrently():
+            return await asyncio.gather(*(brew_slowly() for _ in range(50)))
+
+        # With a single worker, the requests are only received concurrently.
+        self.assertEqual(asyncio.run(brew_concurrently()), [418] * 50)
+
+    def test_client_disconnect(self):
+        self.assertEqual(call_asgi(self.application, http_scope('BREW', '/pot-4/'), []), [])
+
+    def test_other_requests_passed_to_application(self):
+        calls = []
+
+        async def application(scope, receive, send):
+            calls.append(scope['path'])
+            await send({'type': 'http.response.start', 'status': 204, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        self.application.application = application
+        start, body = call_asgi(
+            self.application, http_scope('GET', '/admin/', 'text/html'), [b'']
+        )
+        self.assertEqual(start['status'], 204)
+        self.assertEqual(calls, ['/admin/'])
+
+    def test_other_requests_served_by_django(self):
+        start, body = call_asgi(
+            self.application, http_scope('GET', '/pot-4/', 'text/html'), [b'']
+        )
+        self.assertEqual(start['status'], 404)
+
+    def test_request_body_received_as_read(self):
+        received = []
+
+        def application(scope, receive, send):
+            async def counting_receive():
+                message = await receive()
+                received.append(message)
+                return message
+            return self.application(scope, counting_receive, send)
+
+        headers = [(b'content-length', b'6')]
+        chunks = [b'ab', b'cd', b'ef']
+        start, body = call_asgi(
+            application, http_scope('POST', '/echo/', 'text/plain', headers), chunks
+        )
+        self.assertEqual(body['body'], b'abcdef')
+        self.assertEqual(len(received), 3)
+
+        received.clear()
+        start, body = call_asgi(
+            application, http_scope('POST', '/ignore/', 'text/plain', headers), chunks
+        )
+        self.assertEqual(start['status'], 204)
+        self.assertEqual(received, [])
+
+    def test_request_body_without_length_spooled(self):
+        start, body = call_asgi(
+            self.application,
+            http_scope('POST', '/echo/', 'text/plain'),
+            [b'ab', b'cd', b'ef'],
+        )
+        self.assertEqual(body['body'], b'abcdef')
+
+    @override_settings(HTCPCP_STREAM_OPTIONS=True, HTCPCP_ALTERNATES_HEADER_LIMIT=2)
+    def test_streaming_response_sent_in_chunks(self):
+        start, *bodies = call_asgi(
+            self.application, http_scope('BREW', '/'), [b'start']
+        )
+        self.assertEqual(start['status'], 300)
+        self.assertGreater(len(bodies), 2)
+        self.assertTrue(all(message['more_body'] for message in bodies[:-1]))
+        self.assertFalse(bodies[-1].get('more_body', False))
+        self.assertIn(b'<a href="/pot-4/earl-grey/">', b''.join(m['body'] for m in bodies))
+
+    def test_lifespan(self):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        application = get_asgi_application()
+        asyncio.run(application({'type': 'lifespan'}, receive, send))
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        with self.assertRaises(RuntimeError):
+            application.executor.submit(print)
+
+
+class DecodeHeadersTests(SimpleTestCase):
+
+    def test_repeated_headers_joined(self):
+        scope = {'headers': [
+            (b'Cookie', b'sessionid=abc'),
+            (b'cookie', b'csrftoken=def'),
+            (b'accept', b'text/html'),
+            (b'accept', b'application/json'),
+        ]}
+        self.assertEqual(_decode_headers(scope), {
+            'cookie': 'sessionid=abc; csrftoken=def',
+            'accept': 'text/html,application/json',
+        })
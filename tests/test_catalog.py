@@ -0,0 +1,436 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+import unittest
+from unittest import mock
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django_htcpcp_tea import catalog, urls
+from django_htcpcp_tea.catalog import (
+    CapabilityIndex, ForbiddenCombinationMatcher, catalog_version,
+    get_capability_index, get_catalog, get_forbidden_combination_matcher,
+    invalidate_catalog, load_pot_record,
+)
+from django_htcpcp_tea.models import Addition, ForbiddenCombination, Pot, TeaType
+
+from .utils import CatalogCacheMixin
+
+# URL patterns for CatalogTests
+urlpatterns = urls.urlpatterns
+
+
+class ForbiddenCombinationMatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = ForbiddenCombinationMatcher([
+            ('a', None, [1, 2]),
+            ('b', 'earl-grey', [3]),
+            ('c', None, [2, 1000]),
+            ('d', 'earl-grey', []),
+            ('e', 'darjeeling', [1]),
+        ])
+
+    def test_match_none(self):
+        self.assertEqual(self.matcher.match([]), [])
+        self.assertEqual(self.matcher.match([1, 3, 5]), [])
+
+    def test_match_global(self):
+        self.assertEqual(self.matcher.match([2, 1]), ['a'])
+        self.assertEqual(self.matcher.match([1, 2, 1000]), ['a', 'c'])
+
+    def test_match_preserves_order(self):
+        self.assertEqual(
+            self.matcher.match([1000, 3, 2, 1], 'earl-grey'),
+            ['a', 'b', 'c', 'd'],
+        )
+
+    def test_match_ignores_other_teas(self):
+        self.assertEqual(self.matcher.match([1, 3], 'darjeeling'), ['e'])
+        self.assertEqual(self.matcher.match([1, 3], 'peppermint'), [])
+
+    def test_empty_combination_forbids_everything(self):
+        self.assertEqual(self.matcher.match([], 'earl-grey'), ['d'])
+
+
+class CapabilityIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = CapabilityIndex([
+            (7, True, [], ['Cream', 'Rum']),
+            (2, False, ['earl-grey', 'oolong'], ['Cream']),
+            (30, True, ['oolong'], ['Rum']),
+        ])
+
+    def test_find_all(self):
+        self.assertEqual(self.index.find_pots(), [2, 7, 30])
+
+    def test_find_coffee(self):
+        self.assertEqual(self.index.find_pots(coffee=True), [7, 30])
+
+    def test_find_tea(self):
+        self.assertEqual(self.index.find_pots(tea_slug='oolong'), [2, 30])
+        self.assertEqual(self.index.find_pots(tea_slug='darjeeling'), [])
+
+    def test_find_additions(self):
+        self.assertEqual(self.index.find_pots(addition_names=['Rum']), [7, 30])
+        self.assertEqual(self.index.find_pots(addition_names=['Rum', 'Cream']), [7])
+        self.assertEqual(self.index.find_pots(addition_names=['Rum', 'Sea-Salt']), [])
+
+    def test_find_combination(self):
+        self.assertEqual(
+            self.index.find_pots(tea_slug='oolong', addition_names=['Cream']),
+            [2],
+        )
+        self.assertEqual(
+            self.index.find_pots(coffee=True, tea_slug='oolong', addition_names=['Rum']),
+            [30],
+        )
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class CatalogTests(CatalogCacheMixin, TestCase):
+    fixtures = [
+        'demo_pots',
+        'rfc_2324_additions',
+        'rfc_7168_teas',
+        'demo_forbidden_combinations'
+    ]
+
+    def setUp(self):
+        super().setUp()
+        invalidate_catalog()
+
+    def test_pots_mirror_database(self):
+        catalog = get_catalog()
+        self.assertEqual(
+            [(p.id, p.name, p.brew_coffee, p.tea_capable, p.is_teapot)
+             for p in catalog.pots.values()],
+            [(p.id, p.name, p.brew_coffee, p.tea_capable, p.is_teapot)
+             for p in Pot.objects.order_by('pk')],
+        )
+
+    def test_pot_relations_mirror_database(self):
+        catalog = get_catalog()
+        for pot in Pot.objects.all():
+            record = catalog.get_pot(pot.id)
+            self.assertEqual(
+                [t.slug for t in record.supported_teas.all()],
+                [t.slug for t in pot.supported_teas.order_by('pk')],
+            )
+            self.assertEqual(
+                [str(a) for a in record.supported_additions.all()],
+                [str(a) for a in pot.supported_additions.order_by('pk')],
+            )
+
+    def test_get_pot_missing(self):
+        self.assertIsNone(get_catalog().get_pot(100))
+
+    def test_record_supports_tea(self):
+        record = get_catalog().get_pot(4)
+        self.assertTrue(record.supports_tea('earl-grey'))
+        self.assertFalse(record.supports_tea('peppermint'))
+
+    def test_record_fetch_additions(self):
+        record = get_catalog().get_pot(2)
+        names = ['Cream', 'Half-and-Half', 'Vanilla']
+        self.assertEqual([a.name for a in record.fetch_additions(names)], names)
+        with self.assertRaises(Addition.DoesNotExist):
+            get_catalog().get_pot(4).fetch_additions(names)
+
+    def test_find_forbidden_combinations(self):
+        additions = Addition.objects.all()
+        self.assertEqual(
+            [str(fc) for fc in get_catalog().find_forbidden_combinations(additions, 'earl-grey')],
+            [
+                'All / Cream, Skim',
+                'Earl Grey / Aquavit',
+                'Earl Grey / Rum',
+                'Earl Grey / Whisky',
+                'Earl Grey / Kahlua',
+                'All / Whisky, Rum, Kahlua, Aquavit',
+            ],
+        )
+
+    def test_snapshot_reused(self):
+        catalog = get_catalog()
+        with self.assertNumQueries(0):
+            self.assertIs(get_catalog(), catalog)
+
+    def test_invalidated_on_save(self):
+        catalog = get_catalog()
+        Pot.objects.create(name='New Pot')
+        self.assertIsNot(get_catalog(), catalog)
+        self.assertIn('New Pot', [p.name for p in get_catalog().pots.values()])
+
+    def test_invalidated_on_delete(self):
+        version = catalog_version()
+        TeaType.objects.get(slug='peppermint').delete()
+        self.assertGreater(catalog_version(), version)
+        self.assertNotIn('peppermint', get_catalog().get_pot(3).tea_slugs)
+
+    def test_invalidated_on_m2m_changed(self):
+        get_catalog()
+        Pot.objects.get(pk=1).supported_additions.add(Addition.objects.get(name='Rum'))
+        self.assertIn('Rum', get_catalog().get_pot(1).addition_map)
+
+        get_catalog()
+        ForbiddenCombination.objects.get(pk=1).additions.clear()
+        self.assertEqual(get_catalog().forbidden_combinations[0].additions, ())
+
+    def test_additions_created_while_loading_skipped(self):
+        load_relation = catalog._load_relation
+
+        def create_addition_then_load(descriptor, records):
+            if descriptor is Pot.supported_additions:
+                addition = Addition.objects.create(name='Oat', type=Addition.MILK)
+                Pot.objects.get(pk=1).supported_additions.add(addition)
+            return load_relation(descriptor, records)
+
+        with mock.patch.object(catalog, '_load_relation', create_addition_then_load):
+            snapshot = get_catalog()
+        self.assertNotIn('Oat', snapshot.get_pot(1).addition_map)
+        self.assertIn('Oat', get_catalog().get_pot(1).addition_map)
+
+    def test_forbidden_combinations_of_teas_created_while_loading_skipped(self):
+        load_relation = catalog._load_relation
+
+        def create_tea_then_load(descriptor, records):
+            if descriptor is ForbiddenCombination.additions:
+                tea = TeaType.objects.create(name='Oolong', slug='oolong')
+                ForbiddenCombination.objects.create(tea=tea, reason='No oolong')
+            return load_relation(descriptor, records)
+
+        with mock.patch.object(catalog, '_load_relation', create_tea_then_load):
+            snapshot = get_catalog()
+        self.assertEqual(snapshot.find_forbidden_combinations([]), [])
+        self.assertEqual(
+            [fc.reason for fc in get_catalog().find_forbidden_combinations([], 'oolong')],
+            ['No oolong'],
+        )
+
+    def test_forbidden_combination_matcher_yields_models(self):
+        additions = Addition.objects.filter(name__in=['Cream', 'Skim'])
+        self.assertEqual(
+            get_forbidden_combination_matcher().match([a.id for a in additions]),
+            [ForbiddenCombination.objects.get(pk=1)],
+        )
+
+    def test_forbidden_combination_matcher_recompiled(self):
+        matcher = get_forbidden_combination_matcher()
+        # Only the fingerprint of the combinations is read
+        with self.assertNumQueries(1):
+            self.assertIs(get_forbidden_combination_matcher(), matcher)
+        ForbiddenCombination.objects.get(pk=1).additions.remove(
+            Addition.objects.get(name='Skim')
+        )
+        cream = Addition.objects.get(name='Cream')
+        self.assertEqual(
+            [fc.pk for fc in get_forbidden_combination_matcher().match([cream.id])],
+            [1],
+        )
+
+    def test_forbidden_combination_matcher_recompiled_after_changes_by_other_processes(self):
+        matcher = get_forbidden_combination_matcher()
+        skim = Addition.objects.get(name='Skim')
+        # Changes made by another process do not send signals in this one
+        ForbiddenCombination.additions.through.objects.filter(
+            forbiddencombination_id=1, addition=skim,
+        ).delete()
+        self.assertIs(get_forbidden_combination_matcher(), matcher)
+        ForbiddenCombination.objects.filter(pk=1).update(version=F('version') + 1)
+        cream = Addition.objects.get(name='Cream')
+        self.assertEqual(
+            [fc.pk for fc in get_forbidden_combination_matcher().match([cream.id])],
+            [1],
+        )
+
+    def test_forbidden_combination_matcher_recompiled_after_related_changes(self):
+        get_forbidden_combination_matcher()
+        rule = ForbiddenCombination.objects.create(
+            reason='No oat milk', tea=TeaType.objects.get(slug='earl-grey'),
+        )
+        matcher = get_forbidden_combination_matcher()
+        self.assertEqual(matcher.match([], 'earl-grey'), [rule])
+        tea = TeaType.objects.get(slug='earl-grey')
+        tea.slug = 'lady-grey'
+        tea.save()
+        self.assertEqual(
+            get_forbidden_combination_matcher().match([], 'lady-grey'), [rule],
+        )
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class CatalogTransactionTests(TransactionTestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def setUp(self):
+        invalidate_catalog()
+
+    def test_catalog_loaded_in_transaction_not_cached(self):
+        with transaction.atomic():
+            pot = Pot.objects.create(name='Rolled back', brew_coffee=True)
+            self.assertIn(pot.id, get_catalog().pots)
+            transaction.set_rollback(True)
+        self.assertNotIn(pot.id, get_catalog().pots)
+
+    def test_catalog_invalidated_on_commit(self):
+        with transaction.atomic():
+            Pot.objects.create(name='Committed', brew_coffee=True)
+            # Another thread may cache the catalog before the commit.
+            with mock.patch.object(catalog, '_in_transaction', return_value=False):
+                stale = get_catalog()
+        self.assertIsNot(get_catalog(), stale)
+        self.assertIs(get_catalog(), get_catalog())
+
+
+class CapabilityIndexDatabaseTests(CatalogCacheMixin, TestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def setUp(self):
+        super().setUp()
+        invalidate_catalog()
+
+    def test_index_mirrors_database(self):
+        index = get_capability_index()
+        self.assertEqual(index.find_pots(coffee=True), [1, 2, 4])
+        self.assertEqual(
+            index.find_pots(addition_names=['Cream', 'Skim']),
+            list(
+                Pot.objects.filter(supported_additions__name='Cream')
+                .filter(supported_additions__name='Skim')
+                .order_by('pk').values_list('pk', flat=True)
+            ),
+        )
+        for tea in TeaType.objects.all():
+            self.assertEqual(
+                index.find_pots(tea_slug=tea.slug),
+                list(tea.pot_list.order_by('pk').values_list('pk', flat=True)),
+            )
+
+    def test_index_loaded_with_three_queries(self):
+        with self.assertNumQueries(4):
+            index = get_capability_index()
+        with self.assertNumQueries(0):
+            index.find_pots(coffee=True, addition_names=['Cream'])
+
+    def test_index_cached_by_pot_fingerprint(self):
+        index = get_capability_index()
+        with self.assertNumQueries(1):
+            self.assertIs(get_capability_index(), index)
+
+    def test_index_reloaded_after_changes_by_other_processes(self):
+        self.assertEqual(get_capability_index().find_pots(addition_names=['Cream']), [2, 4])
+        # Change the supported additions without sending signals, as another
+        # process would.
+        Pot.supported_additions.through.objects.filter(
+            pot_id=4, addition__name='Cream'
+        ).delete()
+        Pot.objects.filter(pk=4).update_capabilities()
+        self.assertEqual(get_capability_index().find_pots(addition_names=['Cream']), [2])
+
+    def test_index_reloaded_after_pot_changes(self):
+        get_capability_index()
+        pot = Pot.objects.get(pk=4)
+        pot.brew_coffee = False
+        pot.save()
+        self.assertEqual(get_capability_index().find_pots(coffee=True), [1, 2])
+        TeaType.objects.filter(slug='earl-grey').update(slug='lady-grey')
+        self.assertEqual(get_capability_index().find_pots(tea_slug='lady-grey'), [])
+        tea = TeaType.objects.get(slug='lady-grey')
+        tea.save()
+        self.assertEqual(get_capability_index().find_pots(tea_slug='lady-grey'), [3, 4])
+
+    @override_settings(HTCPCP_CATALOG_SNAPSHOT=True)
+    def test_index_compiled_from_snapshot(self):
+        get_catalog()
+        with self.assertNumQueries(0):
+            index = get_capability_index()
+            self.assertIs(get_capability_index(), index)
+        self.assertEqual(index.pot_ids, CapabilityIndex.load().pot_ids)
+
+    def test_index_recompiled_on_m2m_changed(self):
+        self.assertEqual(get_capability_index().find_pots(addition_names=['Rum']), [2])
+        Pot.objects.get(pk=4).supported_additions.add(Addition.objects.get(name='Rum'))
+        self.assertEqual(get_capability_index().find_pots(addition_names=['Rum']), [2, 4])
+
+
+class LoadPotRecordTests(CatalogCacheMixin, TestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def test_record_mirrors_snapshot(self):
+        catalog = get_catalog()
+        for pot in Pot.objects.all():
+            self.assertEqual(load_pot_record(pot.id), catalog.get_pot(pot.id))
+
+    def test_record_mirrors_pot(self):
+        fields = ('tea_count', 'addition_count', 'capability_version', 'tea_capable', 'is_teapot')
+        for pot in Pot.objects.all():
+            record = load_pot_record(pot.id)
+            for field in fields:
+                self.assertEqual(getattr(record, field), getattr(pot, field), field)
+
+    def test_record_without_teas(self):
+        record = load_pot_record(1)
+        self.assertEqual(record.supported_teas, ())
+        self.assertFalse(record.tea_capable)
+
+    def test_record_missing(self):
+        self.assertIsNone(load_pot_record(100))
+
+    def test_record_loaded_with_two_queries(self):
+        with self.assertNumQueries(2):
+            record = load_pot_record(4)
+        with self.assertNumQueries(0):
+            record.is_teapot
+            record.supports_tea('earl-grey')
+            record.fetch_additions(['Cream'])
+            list(record.supported_additions.all())
+
+    def test_record_reuses_cached_additions(self):
+        record = load_pot_record(4)
+        with self.assertNumQueries(1):
+            self.assertEqual(load_pot_record(4), record)
+
+    def test_record_additions_cache_versioned(self):
+        load_pot_record(4)
+        Pot.objects.get(pk=4).supported_additions.remove(Addition.objects.get(name='Cream'))
+        with self.assertNumQueries(2):
+            self.assertNotIn('Cream', load_pot_record(4).addition_map)
+
+    def test_record_additions_cache_detects_other_processes(self):
+        load_pot_record(4)
+        # Changes made by other processes are only seen through the version.
+        Pot.supported_additions.through.objects.filter(
+            pot_id=4, addition__name='Cream'
+        ).delete()
+        self.assertIn('Cream', load_pot_record(4).addition_map)
+        Pot.objects.filter(pk=4).update_capabilities()
+        self.assertNotIn('Cream', load_pot_record(4).addition_map)
+
+
+@unittest.skipUnless(
+    connection.vendor == 'postgresql', 'Teas are only aggregated on PostgreSQL'
+)
+class LoadPotRecordPostgreSQLTests(CatalogCacheMixin, TestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def test_teas_aggregated_into_arrays(self):
+        catalog._addition_record_maps.clear()
+        with CaptureQueriesContext(connection) as queries:
+            record = load_pot_record(4)
+        self.assertIn('ARRAY_AGG', queries[0]['sql'])
+        self.assertEqual(record, get_catalog().get_pot(4))
+
+    def test_teas_not_aggregated_before_django_2_2(self):
+        catalog._addition_record_maps.clear()
+        with mock.patch('django.VERSION', (2, 1, 15, 'final', 0)), \
+                CaptureQueriesContext(connection) as queries:
+            record = load_pot_record(4)
+        self.assertNotIn('ARRAY_AGG', queries[0]['sql'])
+        self.assertEqual(record, get_catalog().get_pot(4))
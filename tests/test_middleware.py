@@ -173,6 +173,102 @@ class MiddlewareTests(unittest.TestCase):
                 request = self.rf.post('/', content_type='message/other', data='start')
                 HTCPCPTeaMiddleware(get_response=checker)(request)
 
+    def test_invalid_method_does_not_read_body(self):
+        checker = self._make_assert_htcpcp_valid(is_valid=False)
+        request = self.rf.put('/', content_type=HTCPCP_COFFEE_CONTENT, data='start')
+        HTCPCPTeaMiddleware(get_response=checker)(request)
+        self.assertFalse(request._read_started)
+
+    @override_settings(HTCPCP_STRICT_MIME_TYPE=True)
+    def test_invalid_mime_type_does_not_read_body(self):
+        checker = self._make_assert_htcpcp_valid(is_valid=False)
+        request = self.rf.post('/', content_type='application/octet-stream', data='start')
+        HTCPCPTeaMiddleware(get_response=checker)(request)
+        self.assertFalse(request._read_started)
+
+    @override_settings(HTCPCP_URL_PREFIXES=['/htcpcp/'])
+    def test_url_prefixes(self):
+        valid_paths = ['/htcpcp/', '/htcpcp/pot-1/']
+        invalid_paths = ['/', '/upload/', '/htcpcp']
+
+        checker = self._make_assert_htcpcp_valid(is_valid=True)
+        middleware = HTCPCPTeaMiddleware(get_response=checker)
+        for path in valid_paths:
+            request = self.rf.post(path, content_type=HTCPCP_COFFEE_CONTENT, data='start')
+            middleware(request)
+
+        checker = self._make_assert_htcpcp_valid(is_valid=False)
+        middleware = HTCPCPTeaMiddleware(get_response=checker)
+        for path in invalid_paths:
+            request = self.rf.post(path, content_type=HTCPCP_COFFEE_CONTENT, data='start')
+            middleware(request)
+            self.assertFalse(request._read_started)
+
+    @override_settings(HTCPCP_URL_PREFIXES=['/htcpcp/'], HTCPCP_OVERRIDE_SERVER_NAME=True)
+    def test_url_prefixes_skips_header_rewriting(self):
+        middleware = HTCPCPTeaMiddleware(lambda request: HttpResponse())
+        request = self.rf.post('/other/', content_type=HTCPCP_COFFEE_CONTENT, data='start')
+        self.assertIsNone(middleware(request).get('Server'))
+
+    def test_body_available_after_scan(self):
+        payload = 'please ' * 100 + 'stop'
+
+        def get_response(request):
+            self.assertEqual(request.body, payload.encode())
+            self.assertEqual(request.htcpcp_message_type, 'stop')
+            return HttpResponse()
+
+        request = self.rf.post('/', content_type=HTCPCP_COFFEE_CONTENT, data=payload)
+        HTCPCPTeaMiddleware(get_response=get_response)(request)
+
+    def test_start_takes_precedence_over_stop(self):
+        def get_response(request):
+            self.assertEqual(request.htcpcp_message_type, 'start')
+            return HttpResponse()
+
+        request = self.rf.post('/', content_type=HTCPCP_COFFEE_CONTENT, data='stop, then start')
+        HTCPCPTeaMiddleware(get_response=get_response)(request)
+
+    @override_settings(HTCPCP_MAX_REQUEST_BODY=16)
+    def test_oversized_body_rejected(self):
+        def get_response(request):
+            self.fail('Oversized HTCPCP request passed to the view')
+
+        request = self.rf.post('/', content_type=HTCPCP_COFFEE_CONTENT, data='start' * 10)
+        response = HTCPCPTeaMiddleware(get_response=get_response)(request)
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(request._read_started)
+
+    @override_settings(HTCPCP_MAX_REQUEST_BODY=16)
+    def test_oversized_body_without_content_length_rejected(self):
+        def get_response(request):
+            self.fail('Oversized HTCPCP request passed to the view')
+
+        request = self.rf.post('/', content_type=HTCPCP_COFFEE_CONTENT, data='start' * 10)
+        # Force the body length to be discovered while reading the stream
+        request.META['CONTENT_LENGTH'] = ''
+        response = HTCPCPTeaMiddleware(get_response=get_response)(request)
+        self.assertEqual(response.status_code, 413)
+
+    @override_settings(HTCPCP_MAX_REQUEST_BODY=16, HTCPCP_STRICT_MIME_TYPE=False)
+    def test_oversized_non_htcpcp_body_passed_through(self):
+        payload = 'start' * 10
+
+        def get_response(request):
+            self.assertFalse(request.htcpcp_valid)
+            self.assertEqual(request.body, payload.encode())
+            return HttpResponse()
+
+        request = self.rf.post('/', content_type='text/plain', data=payload)
+        response = HTCPCPTeaMiddleware(get_response=get_response)(request)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(HTCPCP_MAX_REQUEST_BODY=None)
+    def test_unlimited_body(self):
+        checker = self._make_assert_htcpcp_valid(is_valid=True)
+        request = self.rf.post('/', content_type=HTCPCP_COFFEE_CONTENT, data='a' * 5000 + 'start')
+        HTCPCPTeaMiddleware(get_response=checker)(request)
+
     def _make_assert_htcpcp_valid(self, is_valid=True):
         def _assert_htcpcp_valid(request):
             self.assertEqual(request.htcpcp_valid, is_valid)
@@ -197,3 +293,13 @@ class MiddlewareDBTests(TestCase):
             request = self.rf.post('/', content_type=HTCPCP_COFFEE_CONTENT, data='start')
             response = HTCPCPTeaMiddleware(lambda request: HttpResponse('Ok'))(request)
             self.assertContains(response, 'Ok', status_code=200)
+
+    @override_settings(
+        HTCPCP_STRICT_MIME_TYPE=True,
+        HTCPCP_OVERRIDE_ROOT_URI=True,
+        HTCPCP_URL_PREFIXES=['/htcpcp/'],
+    )
+    def test_override_root_with_url_prefixes(self):
+        request = self.rf.post('/', content_type=HTCPCP_COFFEE_CONTENT, data='start')
+        response = HTCPCPTeaMiddleware(lambda request: HttpResponse('Ok'))(request)
+        self.assertContains(response, 'Options', status_code=300)
@@ -4,12 +4,20 @@
 #  MIT License was not distributed with this file, you can obtain one
 #  at https://opensource.org/licenses/MIT.
 
+from io import StringIO
+from unittest import mock
+
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
 from django.test import TestCase
-from django_htcpcp_tea.models import Addition, ForbiddenCombination, Pot, TeaType
+from django_htcpcp_tea.models import (
+    Addition, AdditionsNotSupported, ForbiddenCombination, Pot, TeaType,
+)
+
+from .utils import CatalogCacheMixin
 
 
-class PotTests(TestCase):
+class PotTests(CatalogCacheMixin, TestCase):
     fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
 
     def test_pot_tea_capable(self):
@@ -75,6 +83,59 @@ class PotTests(TestCase):
         with self.assertRaises(Addition.DoesNotExist):
             pot.fetch_additions(names)
 
+    def test_fetch_additions_reports_unsupported_names(self):
+        pot = Pot.objects.get(name="A Talented Cow")
+
+        with self.assertRaises(AdditionsNotSupported) as cm:
+            pot.fetch_additions(['Cream', 'Vanilla', 'Wood', 'Vanilla'])
+        self.assertEqual(cm.exception.names, ('Vanilla', 'Wood'))
+
+    def test_fetch_additions_normalizes_names(self):
+        pot = Pot.objects.get(name="A Talented Cow")
+        additions = pot.fetch_additions(['Cream', ' Skim', 'Cream '])
+        self.assertEqual([a.name for a in additions], ['Cream', 'Skim'])
+
+    def test_fetch_additions_cached_between_instances(self):
+        Pot.objects.get(name="A Talented Cow").fetch_additions(['Cream'])
+        pot = Pot.objects.get(name="A Talented Cow")
+        with self.assertNumQueries(0):
+            pot.fetch_additions(['Cream', 'Skim'])
+            with self.assertRaises(AdditionsNotSupported):
+                pot.fetch_additions(['Vanilla'])
+
+    @mock.patch('django_htcpcp_tea.models._in_transaction', return_value=True)
+    def test_fetch_additions_not_cached_in_transaction(self, in_transaction):
+        Pot.objects.get(name="A Talented Cow").fetch_additions(['Cream'])
+        pot = Pot.objects.get(name="A Talented Cow")
+        with self.assertNumQueries(1):
+            pot.fetch_additions(['Cream'])
+
+    def test_fetch_additions_cache_versioned(self):
+        pot = Pot.objects.get(name="A Talented Cow")
+        version = pot.capability_version
+        pot.fetch_additions(['Cream'])
+
+        vanilla = Addition.objects.get(name='Vanilla')
+        pot.supported_additions.add(vanilla)
+        self.assertEqual(pot.capability_version, version + 1)
+        self.assertEqual(pot.fetch_additions(['Vanilla']), [vanilla])
+
+        vanilla.name = 'French-Vanilla'
+        vanilla.save()
+        pot.refresh_from_db()
+        self.assertEqual(pot.fetch_additions(['French-Vanilla'])[0].name, 'French-Vanilla')
+
+    def test_fetch_additions_cache_detects_other_processes(self):
+        pot = Pot.objects.get(name="A Talented Cow")
+        pot.fetch_additions(['Cream'])
+        # Simulate a change made by another process, which does not clear the
+        # addition maps cached by this process.
+        Pot.supported_additions.through.objects.filter(pot=pot).delete()
+        Pot.objects.filter(pk=pot.pk).update_capabilities()
+        pot.refresh_from_db()
+        with self.assertRaises(AdditionsNotSupported):
+            pot.fetch_additions(['Cream'])
+
     def test_query_set_with_tea_count(self):
         pots = Pot.objects.with_tea_count().all()
         tea_couts = [(p.name, p.tea_count) for p in pots]
@@ -106,6 +167,93 @@ class PotTests(TestCase):
         self.assertEqual(str(pot), '4 - A Talented Cow')
 
 
+class PotCapabilityTests(TestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def setUp(self):
+        self.pot = Pot.objects.get(name='French Press')
+        self.tea = TeaType.objects.get(slug='earl-grey')
+        self.addition = Addition.objects.get(name='Cream')
+
+    def assertCapabilities(self, pot, tea_count, addition_count):
+        pot.refresh_from_db()
+        self.assertEqual(
+            (pot.tea_count, pot.addition_count, pot.tea_capable),
+            (tea_count, addition_count, tea_count > 0),
+        )
+
+    def test_capabilities_read_without_queries(self):
+        pots = list(Pot.objects.order_by('id'))
+        with self.assertNumQueries(0):
+            for pot in pots:
+                pot.tea_capable
+                pot.is_teapot
+                pot.tea_count
+                pot.addition_count
+
+    def test_capabilities_updated_on_add_and_remove(self):
+        self.pot.supported_teas.add(self.tea)
+        self.pot.supported_additions.add(self.addition)
+        self.assertCapabilities(self.pot, 1, 1)
+
+        self.pot.supported_teas.remove(self.tea)
+        self.assertCapabilities(self.pot, 0, 1)
+
+        self.pot.supported_additions.clear()
+        self.assertCapabilities(self.pot, 0, 0)
+
+    def test_instance_refreshed_on_change(self):
+        self.pot.supported_teas.add(self.tea)
+        self.assertTrue(self.pot.tea_capable)
+        self.pot.name = 'Renamed Press'
+        self.pot.save()
+        self.assertCapabilities(self.pot, 1, 0)
+
+    def test_capabilities_updated_on_reverse_changes(self):
+        self.tea.pot_list.add(self.pot)
+        self.assertCapabilities(self.pot, 1, 0)
+
+        self.tea.pot_list.remove(self.pot)
+        self.assertCapabilities(self.pot, 0, 0)
+
+        self.tea.pot_list.add(self.pot)
+        self.tea.pot_list.clear()
+        self.assertCapabilities(self.pot, 0, 0)
+
+    def test_capabilities_not_overwritten_by_stale_save(self):
+        pot = Pot.objects.create(name='Stale Pot')
+        self.tea.pot_list.add(pot)
+        pot.brew_coffee = False
+        pot.save()
+        self.assertCapabilities(pot, 1, 0)
+        self.assertFalse(pot.brew_coffee)
+        self.assertTrue(pot.is_teapot)
+        # Incremented by the new tea, and by no longer brewing coffee
+        self.assertEqual(pot.capability_version, 2)
+
+    def test_capabilities_not_saved_with_update_fields(self):
+        self.tea.pot_list.add(self.pot)
+        pot = Pot.objects.get(pk=self.pot.pk)
+        pot.name = 'Renamed Press'
+        pot.tea_count = 42
+        pot.save(update_fields=['name', 'tea_count'])
+        self.assertCapabilities(pot, 1, 0)
+        self.assertEqual(pot.name, 'Renamed Press')
+
+    def test_capabilities_updated_on_related_delete(self):
+        pot = Pot.objects.get(name='A Talented Cow')
+        self.addition.delete()
+        pot.supported_teas.all()[0].delete()
+        self.assertCapabilities(pot, 1, 4)
+
+    def test_rebuild_pot_capabilities_command(self):
+        Pot.objects.update(tea_count=0, addition_count=0, tea_capable=False)
+        out = StringIO()
+        call_command('rebuild_pot_capabilities', stdout=out)
+        self.assertIn('Rebuilt the capabilities of 4 pot(s).', out.getvalue())
+        self.assertCapabilities(Pot.objects.get(name='A Talented Cow'), 2, 5)
+
+
 class AdditionTests(TestCase):
     fixtures = ['rfc_2324_additions']
 
@@ -176,3 +324,56 @@ class ForbiddenCombinationTests(TestCase):
             str(comb),
             'All / Cream, Skim'
         )
+
+    def test_forbidding_additions_matches_forbids_additions(self):
+        addition_sets = [
+            [],
+            list(Addition.objects.filter(name__in=['Cream'])),
+            list(Addition.objects.filter(name__in=['Cream', 'Skim'])),
+            list(Addition.objects.filter(name__in=['Whisky', 'Rum', 'Kahlua'])),
+            list(Addition.objects.all()),
+        ]
+        for additions in addition_sets:
+            self.assertEqual(
+                list(ForbiddenCombination.objects.forbidding_additions(additions).order_by('pk')),
+                [fc for fc in ForbiddenCombination.objects.order_by('pk')
+                 if fc.forbids_additions(additions)],
+            )
+
+    def assertVersionIncremented(self, comb, increment):
+        version = comb.version
+        comb.refresh_from_db(fields=['version'])
+        self.assertEqual(comb.version, version + increment)
+
+    def test_version_incremented_on_change(self):
+        comb = ForbiddenCombination.objects.get(pk=1)
+        comb.reason = 'Too milky'
+        comb.save()
+        self.assertVersionIncremented(comb, 1)
+        comb.additions.add(Addition.objects.get(name='Rum'))
+        self.assertVersionIncremented(comb, 1)
+        Addition.objects.get(name='Rum').forbidden_combinations.clear()
+        self.assertVersionIncremented(comb, 1)
+
+    def test_version_incremented_on_related_change(self):
+        comb = ForbiddenCombination.objects.get(pk=1)
+        cream = Addition.objects.get(name='Cream')
+        cream.name = 'Double Cream'
+        cream.save()
+        self.assertVersionIncremented(comb, 1)
+        cream.delete()
+        self.assertVersionIncremented(comb, 1)
+
+    def test_version_not_overwritten_by_stale_save(self):
+        comb = ForbiddenCombination.objects.get(pk=1)
+        ForbiddenCombination.objects.get(pk=1).additions.clear()
+        comb.save()
+        # Incremented by clearing the additions, and by saving
+        self.assertVersionIncremented(comb, 2)
+
+    def test_forbidding_additions_empty_combination(self):
+        empty = ForbiddenCombination.objects.create(reason='Nothing is allowed')
+        self.assertEqual(
+            list(ForbiddenCombination.objects.forbidding_additions([])),
+            [empty],
+        )
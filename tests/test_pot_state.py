@@ -0,0 +1,222 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+import json
+import time
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.sessions.backends.base import SessionBase
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from django_htcpcp_tea import pot_state
+from django_htcpcp_tea.models import PotState
+
+STATE = {'beverage': 'coffee', 'needs_milk': True, 'currently_pouring': False}
+
+POURING_STATE = dict(STATE, needs_milk=False, currently_pouring=True)
+
+
+class PotStateBackendTestsMixin:
+
+    def make_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.backend = self.make_backend()
+        self.request = RequestFactory().get('/')
+        self.request.session = SessionBase()
+
+    def test_get_idle(self):
+        self.assertIsNone(self.backend.get(self.request, 1))
+
+    def test_compare_and_set_idle(self):
+        self.assertTrue(self.backend.compare_and_set(self.request, 1, None, STATE))
+        self.assertEqual(self.backend.get(self.request, 1), STATE)
+        self.assertIsNone(self.backend.get(self.request, 2))
+
+    def test_compare_and_set_busy(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        self.assertFalse(self.backend.compare_and_set(self.request, 1, None, POURING_STATE))
+        self.assertTrue(self.backend.compare_and_set(self.request, 1, STATE, POURING_STATE))
+        self.assertEqual(self.backend.get(self.request, 1), POURING_STATE)
+
+    def test_compare_and_set_stale(self):
+        self.backend.compare_and_set(self.request, 1, None, POURING_STATE)
+        self.assertFalse(self.backend.compare_and_set(self.request, 1, STATE, None))
+        self.assertEqual(self.backend.get(self.request, 1), POURING_STATE)
+
+    def test_compare_and_set_clears(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        self.assertTrue(self.backend.compare_and_set(self.request, 1, STATE, None))
+        self.assertIsNone(self.backend.get(self.request, 1))
+
+    def test_delete(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        self.backend.delete(self.request, 1)
+        self.assertIsNone(self.backend.get(self.request, 1))
+
+    def test_get_many(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        self.backend.compare_and_set(self.request, 2, None, POURING_STATE)
+        self.backend.delete(self.request, 2)
+        self.backend.compare_and_set(self.request, 4, None, POURING_STATE)
+        self.assertEqual(
+            self.backend.get_many(self.request, [1, 2, 3, 4]),
+            {1: STATE, 4: POURING_STATE},
+        )
+
+
+class SessionPotStateBackendTests(PotStateBackendTestsMixin, unittest.TestCase):
+
+    def make_backend(self):
+        return pot_state.SessionPotStateBackend()
+
+    def test_state_stored_in_session(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        self.assertEqual(self.request.session['htcpcp_pot_1'], STATE)
+
+
+class CachePotStateBackendTests(PotStateBackendTestsMixin, SimpleTestCase):
+
+    def make_backend(self):
+        cache.clear()
+        return pot_state.CachePotStateBackend()
+
+    def test_compare_and_set_locked(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        cache.add('htcpcp_pot_state:1:lock', True)
+        self.assertFalse(self.backend.compare_and_set(self.request, 1, STATE, None))
+
+
+class LocMemPotStateBackendTests(PotStateBackendTestsMixin, unittest.TestCase):
+
+    def make_backend(self):
+        return pot_state.LocMemPotStateBackend(timeout=60)
+
+    def test_state_expires(self):
+        with mock.patch('time.monotonic', return_value=1000):
+            self.backend.compare_and_set(self.request, 1, None, STATE)
+        with mock.patch('time.monotonic', return_value=1059):
+            self.assertEqual(self.backend.get(self.request, 1), STATE)
+        with mock.patch('time.monotonic', return_value=1060):
+            self.assertIsNone(self.backend.get(self.request, 1))
+            self.assertTrue(self.backend.compare_and_set(self.request, 1, None, STATE))
+
+
+class BrewDurationEstimatorTests(unittest.TestCase):
+
+    def test_default_estimate(self):
+        self.assertEqual(pot_state.BrewDurationEstimator(default=42).estimate, 42)
+
+    def test_moving_average(self):
+        estimator = pot_state.BrewDurationEstimator(weight=0.5)
+        estimator.observe(10)
+        self.assertEqual(estimator.estimate, 10)
+        estimator.observe(20)
+        self.assertEqual(estimator.estimate, 15)
+        estimator.reset()
+        self.assertEqual(estimator.estimate, estimator.default)
+
+
+class GetPotStateBackendTests(unittest.TestCase):
+
+    def test_default_backend(self):
+        self.assertIsInstance(
+            pot_state.get_pot_state_backend(), pot_state.SessionPotStateBackend
+        )
+
+    def test_backend_reloaded_on_setting_changed(self):
+        with override_settings(
+            HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.LocMemPotStateBackend',
+            HTCPCP_POT_STATE_OPTIONS={'timeout': 10},
+        ):
+            backend = pot_state.get_pot_state_backend()
+            self.assertIsInstance(backend, pot_state.LocMemPotStateBackend)
+            self.assertEqual(backend.timeout, 10)
+            self.assertIs(pot_state.get_pot_state_backend(), backend)
+        self.assertIsInstance(
+            pot_state.get_pot_state_backend(), pot_state.SessionPotStateBackend
+        )
+
+
+class SignedTokenPotStateBackendTests(PotStateBackendTestsMixin, unittest.TestCase):
+
+    def make_backend(self):
+        return pot_state.SignedTokenPotStateBackend()
+
+    def issue_token(self, pot_id, state):
+        request = RequestFactory().get('/')
+        self.backend.compare_and_set(request, pot_id, None, state)
+        response = HttpResponse()
+        self.backend.finalize_response(request, pot_id, response)
+        return response['Brew-Token']
+
+    def test_token_round_trip(self):
+        request = RequestFactory().get('/', HTTP_BREW_TOKEN=self.issue_token(1, STATE))
+        self.assertEqual(self.backend.get(request, 1), STATE)
+        self.assertIsNone(self.backend.get(request, 2))
+
+    def test_no_token_for_idle_pot(self):
+        request = RequestFactory().get('/', HTTP_BREW_TOKEN=self.issue_token(1, STATE))
+        self.assertTrue(self.backend.compare_and_set(request, 1, STATE, None))
+        response = HttpResponse()
+        self.backend.finalize_response(request, 1, response)
+        self.assertFalse(response.has_header('Brew-Token'))
+
+    def test_expired_token_ignored(self):
+        token = self.issue_token(1, STATE)
+        backend = pot_state.SignedTokenPotStateBackend(max_age=10)
+        request = RequestFactory().get('/', HTTP_BREW_TOKEN=token)
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertIsNone(backend.get(request, 1))
+
+
+class DatabasePotStateBackendTests(PotStateBackendTestsMixin, TestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def make_backend(self):
+        return pot_state.DatabasePotStateBackend()
+
+    def test_state_stored_in_database(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        self.assertEqual(json.loads(PotState.objects.get(pot_id=1).state), STATE)
+
+    def test_get_many_single_query(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.backend.get_many(self.request, [1, 2, 4]), {1: STATE})
+
+    def test_compare_and_set_single_query(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        with self.assertNumQueries(1):
+            self.assertTrue(self.backend.compare_and_set(self.request, 1, STATE, POURING_STATE))
+
+    def test_interleaved_starts(self):
+        other_request = RequestFactory().get('/')
+        self.assertIsNone(self.backend.get(self.request, 1))
+        self.assertIsNone(self.backend.get(other_request, 1))
+        self.assertTrue(self.backend.compare_and_set(self.request, 1, None, STATE))
+        self.assertFalse(self.backend.compare_and_set(other_request, 1, None, POURING_STATE))
+        self.assertEqual(self.backend.get(other_request, 1), STATE)
+
+    def test_interleaved_stops(self):
+        self.backend.compare_and_set(self.request, 1, None, STATE)
+        self.assertTrue(self.backend.compare_and_set(self.request, 1, STATE, None))
+        self.assertFalse(self.backend.compare_and_set(self.request, 1, STATE, None))
+        self.assertTrue(self.backend.compare_and_set(self.request, 1, None, STATE))
+
+    def test_state_expires(self):
+        backend = pot_state.DatabasePotStateBackend(timeout=60)
+        backend.compare_and_set(self.request, 1, None, STATE)
+        PotState.objects.update(updated=timezone.now() - timedelta(seconds=61))
+        self.assertIsNone(backend.get(self.request, 1))
+        self.assertFalse(backend.compare_and_set(self.request, 1, STATE, None))
+        self.assertTrue(backend.compare_and_set(self.request, 1, None, POURING_STATE))
+        self.assertEqual(backend.get(self.request, 1), POURING_STATE)
@@ -0,0 +1,185 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+import unittest
+from collections import namedtuple
+from unittest import mock, skipIf
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django_htcpcp_tea import renderer
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
+
+Item = namedtuple('Item', 'name kind')
+AdditionItem = namedtuple('AdditionItem', 'name get_type_display')
+
+
+class RegroupTests(unittest.TestCase):
+
+    def test_regroup_consecutive_items(self):
+        items = [Item('a', 1), Item('b', 1), Item('c', 2), Item('d', 1)]
+        self.assertEqual(
+            renderer.regroup(items, 'kind'),
+            [(1, items[:2]), (2, items[2:3]), (1, items[3:])],
+        )
+
+    def test_regroup_dictionaries_and_callables(self):
+        items = [{'kind': 'x'}, mock_kind(lambda: 'x')]
+        self.assertEqual(renderer.regroup(items, 'kind'), [('x', items)])
+
+    def test_regroup_empty(self):
+        self.assertEqual(renderer.regroup([], 'kind'), [])
+
+
+def mock_kind(kind):
+    return type('Mock', (), {'kind': staticmethod(kind)})()
+
+
+class RendererTests(SimpleTestCase):
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        renderer._render_static_body.cache_clear()
+
+    @override_settings(HTCPCP_RENDERER='lean')
+    def test_lean_renderer(self):
+        response = renderer.render_htcpcp(
+            self.request, 'django_htcpcp_tea/503.html', {'error_reason': '<Empty>'}, status=503
+        )
+        self.assertContains(response, '&lt;Empty&gt;', status_code=503)
+        self.assertEqual(
+            renderer.render_htcpcp_to_string(
+                self.request, 'django_htcpcp_tea/503.html', {'error_reason': '<Empty>'}
+            ),
+            response.content.decode(),
+        )
+
+    @override_settings(HTCPCP_RENDERER='lean')
+    def test_templates_compiled_once(self):
+        template = renderer.get_htcpcp_template('django_htcpcp_tea/418.html')
+        self.assertIs(renderer.get_htcpcp_template('django_htcpcp_tea/418.html'), template)
+
+    @override_settings(HTCPCP_RENDERER='lean')
+    def test_static_bodies_rendered_once(self):
+        with mock.patch.object(
+            renderer, 'get_htcpcp_template', wraps=renderer.get_htcpcp_template
+        ) as get_template:
+            first = renderer.render_static_htcpcp(
+                self.request, 'django_htcpcp_tea/503.html', 'Empty', status=503
+            )
+            second = renderer.render_static_htcpcp(
+                self.request, 'django_htcpcp_tea/503.html', 'Empty', status=503
+            )
+            renderer.render_static_htcpcp(
+                self.request, 'django_htcpcp_tea/503.html', 'Broken', status=503
+            )
+        self.assertEqual(get_template.call_count, 2)
+        self.assertEqual(first.content, second.content)
+        self.assertContains(second, 'Empty', status_code=503)
+
+    @override_settings(HTCPCP_RENDERER='lean')
+    def test_static_bodies_discarded_on_setting_changed(self):
+        renderer.render_static_htcpcp(self.request, 'django_htcpcp_tea/418.html')
+        with override_settings(HTCPCP_RENDERER='lean'):
+            self.assertEqual(renderer._render_static_body.cache_info().currsize, 0)
+
+    @override_settings(HTCPCP_RENDERER='lean', DEBUG=True)
+    def test_static_bodies_not_cached_in_debug(self):
+        renderer.render_static_htcpcp(self.request, 'django_htcpcp_tea/418.html')
+        self.assertEqual(renderer._render_static_body.cache_info().currsize, 0)
+
+    def test_static_bodies_not_cached_by_django_renderer(self):
+        response = renderer.render_static_htcpcp(
+            self.request, 'django_htcpcp_tea/418.html', status=418
+        )
+        self.assertContains(response, "I'm a tea pot", status_code=418)
+        self.assertEqual(renderer._render_static_body.cache_info().currsize, 0)
+
+    @override_settings(HTCPCP_RENDERER='lean', DEBUG=True)
+    def test_templates_reloaded_in_debug(self):
+        template = renderer.get_htcpcp_template('django_htcpcp_tea/418.html')
+        self.assertIsNot(renderer.get_htcpcp_template('django_htcpcp_tea/418.html'), template)
+
+    @override_settings(HTCPCP_RENDERER='fastest')
+    def test_unknown_renderer(self):
+        with self.assertRaises(ImproperlyConfigured):
+            renderer.render_htcpcp(self.request, 'django_htcpcp_tea/418.html')
+
+    def test_negotiated_representation(self):
+        factory = RequestFactory()
+        cases = [
+            ({}, 'html'),
+            ({'HTTP_ACCEPT': 'text/html'}, 'html'),
+            ({'HTTP_ACCEPT': '*/*'}, 'html'),
+            ({'HTTP_ACCEPT': 'application/json'}, 'json'),
+            ({'HTTP_ACCEPT': 'Application/JSON'}, 'json'),
+            ({'HTTP_ACCEPT': 'application/*, text/html;q=0.9'}, 'json'),
+            ({'HTTP_ACCEPT': 'application/json, text/plain, */*'}, 'json'),
+            ({'HTTP_ACCEPT': 'text/html, application/json'}, 'html'),
+            ({'HTTP_ACCEPT': 'application/json;q=0, */*'}, 'html'),
+            ({'HTTP_ACCEPT': 'application/json;q=bad'}, 'html'),
+            ({'HTTP_PREFER': 'respond-async, return=minimal'}, 'empty'),
+            ({'HTTP_PREFER': 'return=representation'}, 'html'),
+        ]
+        for meta, representation in cases:
+            with self.subTest(meta=meta):
+                request = factory.get('/', **meta)
+                self.assertEqual(renderer.get_representation(request), representation)
+
+    def test_json_skips_templates(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT='application/json')
+        with mock.patch.object(renderer, 'get_htcpcp_template') as get_template:
+            response = renderer.render_htcpcp(
+                request,
+                'django_htcpcp_tea/503.html',
+                {'error_reason': 'Empty', 'alternatives_placeholder': 'x'},
+                status=503,
+            )
+        get_template.assert_not_called()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.content, b'{"error_reason":"Empty"}')
+
+    def test_serialize_context(self):
+        additions = [
+            {'name': 'Cream', 'get_type_display': 'Milk'},
+            AdditionItem('Rum', lambda: 'Spirit'),
+        ]
+        self.assertEqual(
+            renderer.serialize_context({
+                'beverage': 'coffee',
+                'additions': additions,
+                'alternatives': [('/pot-1/', 'message/coffeepot')],
+                'unsupported_additions': ('Tea-Leaves',),
+            }),
+            {
+                'beverage': 'coffee',
+                'additions': [
+                    {'name': 'Cream', 'type': 'Milk'},
+                    {'name': 'Rum', 'type': 'Spirit'},
+                ],
+                'alternatives': [{'uri': '/pot-1/', 'type': 'message/coffeepot'}],
+                'unsupported_additions': ['Tea-Leaves'],
+            },
+        )
+
+    @skipIf(jinja2 is None, 'Jinja2 is not installed')
+    @override_settings(HTCPCP_RENDERER='jinja2')
+    def test_jinja2_renderer(self):
+        response = renderer.render_htcpcp(
+            self.request, 'django_htcpcp_tea/503.html', {'error_reason': '<Empty>'}, status=503
+        )
+        self.assertContains(response, '&lt;Empty&gt;', status_code=503)
+        self.assertContains(response, '503 Service Unavailable', status_code=503)
+
+    @skipIf(jinja2 is not None, 'Jinja2 is installed')
+    @override_settings(HTCPCP_RENDERER='jinja2')
+    def test_jinja2_renderer_requires_jinja2(self):
+        with self.assertRaises(ImproperlyConfigured):
+            renderer.render_htcpcp(self.request, 'django_htcpcp_tea/418.html')
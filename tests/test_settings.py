@@ -0,0 +1,32 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+import unittest
+
+from django.test import override_settings
+from django_htcpcp_tea.settings import _HTCPCPTeaSettings, htcpcp_settings
+
+
+class SettingsTests(unittest.TestCase):
+
+    def test_default_used_when_not_configured(self):
+        self.assertEqual(
+            htcpcp_settings.STRICT_REQUEST_BODY,
+            _HTCPCPTeaSettings.STRICT_REQUEST_BODY,
+        )
+
+    def test_snapshot_stored_as_instance_attributes(self):
+        self.assertIn('POT_SESSIONS', vars(htcpcp_settings))
+
+    def test_snapshot_rebuilt_on_setting_changed(self):
+        with override_settings(HTCPCP_STRICT_REQUEST_BODY=True):
+            self.assertIs(htcpcp_settings.STRICT_REQUEST_BODY, True)
+        self.assertIs(htcpcp_settings.STRICT_REQUEST_BODY, False)
+
+    def test_snapshot_ignores_other_settings(self):
+        snapshot = dict(vars(htcpcp_settings))
+        with override_settings(SOME_OTHER_SETTING=True):
+            self.assertEqual(vars(htcpcp_settings), snapshot)
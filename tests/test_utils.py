@@ -7,8 +7,12 @@
 import unittest
 
 from django.test import RequestFactory, TestCase, override_settings
+from django.urls import get_script_prefix, set_script_prefix
 from django_htcpcp_tea import urls, utils
-from django_htcpcp_tea.models import Addition, Pot
+from django_htcpcp_tea.catalog import invalidate_catalog
+from django_htcpcp_tea.models import Addition, Pot, TeaType
+
+from .utils import CatalogCacheMixin
 
 # URL patterns for UtilsTests
 urlpatterns = urls.urlpatterns
@@ -21,13 +25,13 @@ class UtilsStatelessTests(unittest.TestCase):
 
     def test_resolve_requested_additions_empty(self):
         request = self.rf.post('/')
-        self.assertEqual(utils.resolve_requested_additions(request), [])
+        self.assertEqual(utils.resolve_requested_additions(request), ())
 
     def test_resolve_requested_additions_header(self):
         request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS='Sugar, Half-and-Half')
         self.assertEqual(
             utils.resolve_requested_additions(request),
-            ['Sugar', 'Half-and-Half']
+            ('Sugar', 'Half-and-Half')
         )
 
     @override_settings(HTCPCP_GET_ADDITIONS=True)
@@ -35,7 +39,7 @@ class UtilsStatelessTests(unittest.TestCase):
         request = self.rf.post('/?', HTTP_ACCEPT_ADDITIONS='Sugar, Half-and-Half')
         self.assertEqual(
             utils.resolve_requested_additions(request),
-            ['Sugar', 'Half-and-Half']
+            ('Sugar', 'Half-and-Half')
         )
 
     @override_settings(HTCPCP_GET_ADDITIONS=True)
@@ -59,16 +63,66 @@ class UtilsStatelessTests(unittest.TestCase):
         request = self.rf.post('/?Milk&Vanilla', HTTP_ACCEPT_ADDITIONS='Sugar, Half-and-Half')
         self.assertEqual(
             utils.resolve_requested_additions(request),
-            ['Sugar', 'Half-and-Half']
+            ('Sugar', 'Half-and-Half')
         )
 
     def test_resolve_requested_additions_header_with_odd_spacing(self):
         request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS='Sugar,     Half-and-Half,Milk')
         self.assertEqual(
             utils.resolve_requested_additions(request),
-            ['Sugar', 'Half-and-Half', 'Milk']
+            ('Sugar', 'Half-and-Half', 'Milk')
         )
 
+    def test_resolve_requested_additions_normalized(self):
+        request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS=' Sugar,, Milk ,Sugar, ')
+        self.assertEqual(utils.resolve_requested_additions(request), ('Sugar', 'Milk'))
+
+    @override_settings(HTCPCP_GET_ADDITIONS=True)
+    def test_resolve_requested_additions_header_and_duplicate_get(self):
+        request = self.rf.post('/?Milk&Sugar', HTTP_ACCEPT_ADDITIONS='Sugar')
+        self.assertEqual(utils.resolve_requested_additions(request), ('Sugar', 'Milk'))
+
+    @override_settings(HTCPCP_MAX_ADDITIONS=2)
+    def test_resolve_requested_additions_header_limit(self):
+        request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS='Sugar, Milk')
+        self.assertEqual(utils.resolve_requested_additions(request), ('Sugar', 'Milk'))
+        request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS='Sugar, Milk, Rum')
+        with self.assertRaises(utils.TooManyAdditions):
+            utils.resolve_requested_additions(request)
+
+    @override_settings(HTCPCP_MAX_ADDITIONS=2)
+    def test_resolve_requested_additions_header_limit_ignores_blanks(self):
+        request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS='Cream, Skim,')
+        self.assertEqual(utils.resolve_requested_additions(request), ('Cream', 'Skim'))
+        request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS='Cream,, Skim, Cream')
+        self.assertEqual(utils.resolve_requested_additions(request), ('Cream', 'Skim'))
+
+    @override_settings(HTCPCP_MAX_ADDITIONS=2)
+    def test_resolve_requested_additions_oversized_header_not_parsed(self):
+        utils.parse_accept_additions.cache_clear()
+        request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS=',' * 5)
+        with self.assertRaises(utils.TooManyAdditions):
+            utils.resolve_requested_additions(request)
+        self.assertEqual(utils.parse_accept_additions.cache_info().misses, 0)
+
+    @override_settings(HTCPCP_MAX_ADDITIONS=2, HTCPCP_GET_ADDITIONS=True)
+    def test_resolve_requested_additions_get_limit(self):
+        request = self.rf.post('/?Rum', HTTP_ACCEPT_ADDITIONS='Sugar, Milk')
+        with self.assertRaises(utils.TooManyAdditions):
+            utils.resolve_requested_additions(request)
+
+    @override_settings(HTCPCP_MAX_ADDITIONS=None)
+    def test_resolve_requested_additions_unlimited(self):
+        header = ','.join('Addition-{}'.format(i) for i in range(1000))
+        request = self.rf.post('/', HTTP_ACCEPT_ADDITIONS=header)
+        self.assertEqual(len(utils.resolve_requested_additions(request)), 1000)
+
+    def test_parse_accept_additions_cached(self):
+        utils.parse_accept_additions.cache_clear()
+        first = utils.parse_accept_additions('Sugar, Milk')
+        self.assertIs(utils.parse_accept_additions('Sugar, Milk'), first)
+        self.assertEqual(utils.parse_accept_additions.cache_info().hits, 1)
+
     def test_render_alternates_header_empty(self):
         self.assertEqual(
             utils.render_alternates_header([]),
@@ -143,6 +197,78 @@ class UtilsTests(TestCase):
             ]
         )
 
+    def test_iter_alternates(self):
+        self.assertEqual(list(utils.iter_alternates()), list(utils.build_alternates()))
+
+    def test_iter_alternates_for_pots(self):
+        pots = Pot.objects.filter(pk__in=[1, 3])
+        alternates = list(utils.iter_alternates(pots))
+
+        self.assertEqual(
+            alternates,
+            [
+                ('/pot-1/', 'message/coffeepot'),
+                ('/pot-3/darjeeling/', 'message/teapot'),
+                ('/pot-3/earl-grey/', 'message/teapot'),
+                ('/pot-3/peppermint/', 'message/teapot'),
+            ]
+        )
+
+    def test_iter_alternates_single_query(self):
+        with self.assertNumQueries(1):
+            list(utils.iter_alternates())
+
+    def test_alternates_uri_templates(self):
+        pot_uri, tea_uri = utils.get_alternates_uri_templates()
+        self.assertEqual(pot_uri.format(7), '/pot-7/')
+        self.assertEqual(tea_uri.format(7, 'earl-grey'), '/pot-7/earl-grey/')
+
+    def test_alternates_uri_templates_use_script_prefix(self):
+        prefix = get_script_prefix()
+        set_script_prefix('/app/')
+        try:
+            self.assertEqual(
+                list(utils.build_alternates(index_pot=Pot.objects.get(pk=1))),
+                [('/app/pot-1/', 'message/coffeepot')]
+            )
+        finally:
+            set_script_prefix(prefix)
+
+    @override_settings(HTCPCP_ALTERNATES_HEADER_LIMIT=1)
+    def test_render_alternates_header_limit(self):
+        self.assertEqual(
+            utils.render_alternates_header(utils.build_alternates()),
+            '{"/pot-1/" {type message/coffeepot}},{"/"}'
+        )
+
+    @override_settings(HTCPCP_ALTERNATES_HEADER_LIMIT=1)
+    def test_render_alternates_header_within_limit(self):
+        self.assertEqual(
+            utils.render_alternates_header([('/pot-1/', 'message/coffeepot')]),
+            '{"/pot-1/" {type message/coffeepot}}'
+        )
+
+    def test_get_alternates(self):
+        alternates = utils.get_alternates()
+        self.assertIsInstance(alternates, utils.Alternates)
+        self.assertEqual(list(alternates), list(utils.build_alternates()))
+        self.assertEqual(
+            alternates.header,
+            utils.render_alternates_header(list(utils.build_alternates())),
+        )
+
+    def test_get_alternates_etag(self):
+        self.assertEqual(utils.get_alternates_etag(), utils.get_alternates().etag)
+        self.assertEqual(
+            utils.get_alternates_etag(3),
+            utils.get_alternates(index_pot=Pot.objects.get(pk=3)).etag
+        )
+        self.assertIsNone(utils.get_alternates_etag(100))
+
+    def test_render_alternates_header_uses_rendered_header(self):
+        alternates = utils.Alternates([('/pot-1/', 'message/coffeepot')])
+        self.assertIs(utils.render_alternates_header(alternates), alternates.header)
+
     def test_find_forbidden_combinations_empty(self):
         self.assertEqual(utils.find_forbidden_combinations([]), [])
 
@@ -191,3 +317,66 @@ class UtilsTests(TestCase):
                 'All / Whisky, Rum, Kahlua, Aquavit',
             ],
         )
+
+
+@override_settings(HTCPCP_FORBIDDEN_ENGINE='bitmask')
+class UtilsBitmaskEngineTests(CatalogCacheMixin, UtilsTests):
+
+    def setUp(self):
+        super().setUp()
+        invalidate_catalog()
+
+    def test_find_forbidden_combinations_uses_compiled_rules(self):
+        additions = list(Addition.objects.filter(name__in=['Cream', 'Skim']))
+        utils.find_forbidden_combinations(additions)
+        # Only the fingerprint of the combinations is read
+        with self.assertNumQueries(1):
+            self.assertEqual(len(utils.find_forbidden_combinations(additions)), 1)
+
+
+@override_settings(HTCPCP_FORBIDDEN_ENGINE='sql')
+class UtilsSQLEngineTests(UtilsTests):
+
+    def test_find_forbidden_combinations_single_query(self):
+        additions = list(Addition.objects.all())
+        with self.assertNumQueries(1):
+            self.assertEqual(len(utils.find_forbidden_combinations(additions, 'earl-grey')), 6)
+
+
+@override_settings(ROOT_URLCONF=__name__, HTCPCP_CACHE_ALTERNATES=True)
+class UtilsCachedAlternatesTests(CatalogCacheMixin, TestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def setUp(self):
+        super().setUp()
+        invalidate_catalog()
+
+    def test_alternates_cached(self):
+        alternates = utils.get_alternates()
+        with self.assertNumQueries(0):
+            self.assertIs(utils.get_alternates(), alternates)
+
+    def test_alternates_cached_per_pot(self):
+        pot = Pot.objects.get(pk=3)
+        alternates = utils.get_alternates(index_pot=pot)
+        self.assertEqual(list(alternates), list(utils.build_alternates(index_pot=pot)))
+        self.assertIsNot(utils.get_alternates(), alternates)
+        with self.assertNumQueries(0):
+            self.assertIs(utils.get_alternates(index_pot=pot), alternates)
+
+    def test_alternates_invalidated_on_tea_change(self):
+        pot = Pot.objects.get(pk=1)
+        alternates = utils.get_alternates()
+        pot.supported_teas.add(TeaType.objects.get(slug='earl-grey'))
+        self.assertIsNot(utils.get_alternates(), alternates)
+        self.assertIn(('/pot-1/earl-grey/', 'message/teapot'), utils.get_alternates())
+
+    def test_alternates_cached_per_script_prefix(self):
+        alternates = utils.get_alternates()
+        prefix = get_script_prefix()
+        set_script_prefix('/app/')
+        try:
+            self.assertEqual(utils.get_alternates()[0], ('/app/pot-1/', 'message/coffeepot'))
+        finally:
+            set_script_prefix(prefix)
+        self.assertIs(utils.get_alternates(), alternates)
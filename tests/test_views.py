@@ -4,12 +4,31 @@
 #  MIT License was not distributed with this file, you can obtain one
 #  at https://opensource.org/licenses/MIT.
 
-from django.test import TestCase, override_settings
-from django_htcpcp_tea import urls, utils
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipIf
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import (
+    RequestFactory, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django_htcpcp_tea import catalog, renderer, urls, utils
+from django_htcpcp_tea.catalog import get_catalog, invalidate_catalog
+from django_htcpcp_tea.dispatch import choose_coffee_pot
 from django_htcpcp_tea.models import Pot, TeaType
+from django_htcpcp_tea.pot_state import brew_durations, get_pot_state_backend
+
+try:
+    import jinja2
+except ImportError:
+    jinja2 = None
 
 from .utils import (
-    HTCPCPClient, HTCPCP_COFFEE_CONTENT, HTCPCP_TEA_CONTENT, make_tea_url,
+    CatalogCacheMixin, HTCPCPClient, HTCPCP_COFFEE_CONTENT, HTCPCP_TEA_CONTENT,
+    make_tea_url,
 )
 
 # URL patterns for ViewTests
@@ -70,6 +89,38 @@ class ViewTests(BaseViewTests):
             )
         )
 
+    def test_brew_no_pot_filtered_by_additions(self):
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Rum')
+        self.assertEqual(response.status_code, 300)
+        self.assertEqual(
+            response['Alternates'],
+            utils.render_alternates_header(
+                utils.build_alternates(pots=[Pot.objects.get(pk=2)])
+            )
+        )
+
+    def test_brew_no_pot_filtered_by_current_additions(self):
+        self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Cream')
+        # Remove an addition without sending signals, and update the pot's
+        # capabilities, as another process would.
+        Pot.supported_additions.through.objects.filter(
+            pot_id=4, addition__name='Cream'
+        ).delete()
+        Pot.objects.filter(pk=4).update_capabilities()
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Cream')
+        self.assertEqual(
+            response['Alternates'],
+            utils.render_alternates_header(
+                utils.build_alternates(pots=[Pot.objects.get(pk=2)])
+            )
+        )
+
+    def test_brew_no_pot_filtered_by_unsupported_additions(self):
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Tea-Leaves')
+        self.assertEqual(response.status_code, 300)
+        self.assertEqual(list(response.context['alternatives']), [])
+        self.assertFalse(response.has_header('ETag'))
+
     def test_brew_tea_start_tea(self):
         response = self.client.brew(
             make_tea_url(self.pot, self.supported_tea),
@@ -91,7 +142,11 @@ class ViewTests(BaseViewTests):
             content_type=HTCPCP_TEA_CONTENT,
             data='start'
         )
-        self.assertContains(response, b'not available for this pot', status_code=503)
+        self.assertContains(
+            response,
+            '{} is not available for this pot'.format(self.unsupported_tea.slug.capitalize()),
+            status_code=503,
+        )
 
     def test_brew_coffee_start(self):
         response = self.client.brew(
@@ -131,6 +186,37 @@ class ViewTests(BaseViewTests):
             )
         )
 
+    def test_brew_no_pot_etag(self):
+        response = self.client.brew('/', data='start')
+        self.assertEqual(response.status_code, 300)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+
+        etag = response['ETag']
+        response = self.client.brew('/', data='start', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertFalse(response.has_header('Alternates'))
+
+    def test_brew_no_pot_stale_etag(self):
+        etag = self.client.brew('/', data='start')['ETag']
+        self.pot.supported_teas.remove(self.supported_tea)
+        response = self.client.brew('/', data='start', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 300)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_brew_tea_index_etag(self):
+        url = self.pot.get_absolute_url()
+        etag = self.client.brew(url, content_type=HTCPCP_TEA_CONTENT, data='start')['ETag']
+        self.assertNotEqual(etag, self.client.brew('/', data='start')['ETag'])
+        response = self.client.brew(
+            url,
+            content_type=HTCPCP_TEA_CONTENT,
+            data='start',
+            HTTP_IF_NONE_MATCH='"other", W/{}'.format(etag),
+        )
+        self.assertEqual(response.status_code, 304)
+
     def test_when_stop(self):
         response = self.client.brew(self.pot.get_absolute_url(), data='stop')
         self.assertContains(response, b'Finished', status_code=201)
@@ -178,6 +264,23 @@ class ViewTests(BaseViewTests):
 
         self.assertNotIn(b'Raspberry', response.content)
 
+    @override_settings(HTCPCP_CATALOG_SNAPSHOT=False, HTCPCP_CHECK_FORBIDDEN=False)
+    def test_brew_pot_with_two_queries(self):
+        requests = [
+            (self.pot.get_absolute_url(), HTCPCP_COFFEE_CONTENT, 'stop', 'Cream', 200),
+            (self.pot.get_absolute_url(), HTCPCP_COFFEE_CONTENT, 'stop', 'Salt', 406),
+            (make_tea_url(self.pot, self.unsupported_tea), HTCPCP_TEA_CONTENT, 'start', '', 503),
+            ('/pot-3/', HTCPCP_COFFEE_CONTENT, 'start', '', 418),
+        ]
+        for url, content_type, data, additions, status_code in requests:
+            extra = {'HTTP_ACCEPT_ADDITIONS': additions} if additions else {}
+            catalog._addition_record_maps.clear()
+            with self.assertNumQueries(2):
+                response = self.client.brew(
+                    url, content_type=content_type, data=data, **extra
+                )
+            self.assertEqual(response.status_code, status_code)
+
     def test_brew_coffee_with_invalid_additions(self):
         response = self.client.brew(
             self.pot.get_absolute_url(),
@@ -186,6 +289,16 @@ class ViewTests(BaseViewTests):
             HTTP_ACCEPT_ADDITIONS='Salt, Whale-Oil'
         )
         self.assertContains(response, b'Not Acceptable', status_code=406)
+        self.assertEqual(response.context['unsupported_additions'], ('Salt', 'Whale-Oil'))
+
+    @override_settings(HTCPCP_MAX_ADDITIONS=2)
+    def test_brew_coffee_with_too_many_additions(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(),
+            data='start',
+            HTTP_ACCEPT_ADDITIONS='Cream, Skim, Whole-milk'
+        )
+        self.assertContains(response, b'more than 2 additions', status_code=400)
 
     def test_brew_coffee_pot_out_of_service(self):
         useless_pot = Pot.objects.create(id=100, name='Broken Pot', brew_coffee=False)
@@ -197,6 +310,346 @@ class ViewTests(BaseViewTests):
         self.assertContains(response, b'Pot out of service.', status_code=503)
 
 
+@override_settings(HTCPCP_CATALOG_SNAPSHOT=True)
+class ViewCatalogSnapshotTests(CatalogCacheMixin, ViewTests):
+
+    def setUp(self):
+        super().setUp()
+        invalidate_catalog()
+
+    def test_brew_without_queries(self):
+        get_catalog()
+        requests = [
+            (self.pot.get_absolute_url(), HTCPCP_COFFEE_CONTENT, 'start', 'Cream', 202),
+            (self.pot.get_absolute_url(), HTCPCP_COFFEE_CONTENT, 'stop', 'Cream', 200),
+            (self.pot.get_absolute_url(), HTCPCP_COFFEE_CONTENT, 'start', 'Cream, Skim', 403),
+            (self.pot.get_absolute_url(), HTCPCP_COFFEE_CONTENT, 'start', 'Salt', 406),
+            (make_tea_url(self.pot, self.supported_tea), HTCPCP_TEA_CONTENT, 'start', '', 202),
+            (make_tea_url(self.pot, self.unsupported_tea), HTCPCP_TEA_CONTENT, 'start', '', 503),
+            ('/pot-3/', HTCPCP_COFFEE_CONTENT, 'start', '', 418),
+            ('/', HTCPCP_COFFEE_CONTENT, 'start', '', 300),
+        ]
+        for url, content_type, data, additions, status_code in requests:
+            extra = {'HTTP_ACCEPT_ADDITIONS': additions} if additions else {}
+            with self.assertNumQueries(0):
+                response = self.client.brew(
+                    url, content_type=content_type, data=data, **extra
+                )
+            self.assertEqual(response.status_code, status_code)
+
+    def test_brew_unknown_pot(self):
+        response = self.client.brew('/pot-100/', data='start')
+        self.assertEqual(response.status_code, 404)
+
+    def test_brew_no_pot_filtered_by_current_additions(self):
+        # The snapshot only sees changes made without signals once the
+        # catalog is invalidated.
+        Pot.supported_additions.through.objects.filter(
+            pot_id=4, addition__name='Cream'
+        ).delete()
+        invalidate_catalog()
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Cream')
+        self.assertEqual(
+            response['Alternates'],
+            utils.render_alternates_header(
+                utils.build_alternates(pots=[Pot.objects.get(pk=2)])
+            )
+        )
+
+
+@override_settings(HTCPCP_RENDERER='lean')
+class ViewLeanRendererTests(ViewTests):
+
+    def test_teapot_body_served_from_cache(self):
+        renderer._render_static_body.cache_clear()
+        teapot_url = Pot.objects.get(pk=3).get_absolute_url()
+        first = self.client.brew(teapot_url, data='start')
+        self.assertTemplateUsed(first, 'django_htcpcp_tea/418.html')
+        second = self.client.brew(teapot_url, data='start')
+        self.assertEqual(second.status_code, 418)
+        self.assertEqual(second.templates, [])
+        self.assertEqual(second.content, first.content)
+
+    def test_context_processors_skipped(self):
+        response = self.client.brew('/', data='start')
+        self.assertNotIn('messages', response.context)
+        with override_settings(HTCPCP_RENDERER='django'):
+            response = self.client.brew('/', data='start')
+        self.assertIn('messages', response.context)
+
+
+@skipIf(jinja2 is None, 'Jinja2 is not installed')
+@override_settings(HTCPCP_RENDERER='jinja2', HTCPCP_POT_SESSIONS=False)
+class ViewJinja2RendererTests(BaseViewTests):
+
+    def test_brew_coffee_start(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(), data='start', HTTP_ACCEPT_ADDITIONS='Cream'
+        )
+        self.assertContains(response, b'Brewing coffee...', status_code=202)
+        self.assertContains(response, b'<li>Cream</li>', status_code=202)
+        self.assertContains(response, b'<a href="/pot-4/">', status_code=202)
+
+    def test_brew_coffee_in_teapot(self):
+        response = self.client.brew(Pot.objects.get(pk=3).get_absolute_url(), data='start')
+        self.assertContains(response, b"I'm a tea pot", status_code=418)
+
+    def test_brew_forbidden_additions(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(), data='start', HTTP_ACCEPT_ADDITIONS='Cream, Skim'
+        )
+        self.assertContains(response, b'<h2>Reason</h2>', status_code=403)
+
+    def test_brew_unsupported_additions(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(), data='start', HTTP_ACCEPT_ADDITIONS='Rum'
+        )
+        self.assertContains(response, b'Unavailable additions: Rum', status_code=406)
+        self.assertContains(response, b'<dt>Milk</dt>', status_code=406)
+
+    @override_settings(HTCPCP_STREAM_OPTIONS=True)
+    def test_streamed_options_match_rendered_options(self):
+        streamed = b''.join(self.client.brew('/', data='start').streaming_content)
+        with override_settings(HTCPCP_STREAM_OPTIONS=False):
+            self.assertEqual(streamed, self.client.brew('/', data='start').content)
+
+
+@override_settings(HTCPCP_CACHE_ALTERNATES=True)
+class ViewCachedAlternatesTests(CatalogCacheMixin, ViewTests):
+
+    def setUp(self):
+        super().setUp()
+        invalidate_catalog()
+
+    def test_brew_no_pot_reuses_alternates(self):
+        self.client.brew('/', data='start')
+        with self.assertNumQueries(0):
+            response = self.client.brew('/', data='start')
+        self.assertContains(response, b'Options', status_code=300)
+
+    def test_brew_tea_index_not_modified_without_queries(self):
+        url = self.pot.get_absolute_url()
+        etag = self.client.brew(url, content_type=HTCPCP_TEA_CONTENT, data='start')['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.brew(
+                url, content_type=HTCPCP_TEA_CONTENT, data='start', HTTP_IF_NONE_MATCH=etag
+            )
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(HTCPCP_STREAM_OPTIONS=True)
+class ViewStreamingOptionsTests(ViewTests):
+
+    def test_brew_no_pot_streams_options(self):
+        response = self.client.brew('/', data='start')
+        self.assertEqual(response.status_code, 300)
+        self.assertTrue(response.streaming)
+        content = b''.join(response.streaming_content)
+        self.assertIn(b'Options', content)
+        self.assertIn(b'<a href="/pot-4/earl-grey/">', content)
+
+    def test_streamed_options_match_rendered_options(self):
+        streamed = b''.join(self.client.brew('/', data='start').streaming_content)
+        with self.settings(HTCPCP_STREAM_OPTIONS=False):
+            rendered = self.client.brew('/', data='start').content
+        self.assertEqual(streamed, rendered)
+
+    @override_settings(HTCPCP_ALTERNATES_HEADER_LIMIT=2)
+    def test_brew_no_pot_limits_alternates_header(self):
+        response = self.client.brew('/', data='start')
+        self.assertEqual(
+            response['Alternates'],
+            '{"/pot-1/" {type message/coffeepot}},'
+            '{"/pot-2/" {type message/coffeepot}},'
+            '{"/"}'
+        )
+        self.assertContains(response, b'<a href="/pot-4/earl-grey/">', status_code=300)
+
+    @mock.patch('django_htcpcp_tea.utils.STREAMED_ALTERNATES_HEADER_LIMIT', 2)
+    def test_brew_no_pot_alternates_header_limited_by_default(self):
+        response = self.client.brew('/', data='start')
+        self.assertEqual(len(response.htcpcp_alternates), 3)
+        self.assertEqual(
+            response['Alternates'],
+            '{"/pot-1/" {type message/coffeepot}},'
+            '{"/pot-2/" {type message/coffeepot}},'
+            '{"/"}'
+        )
+
+    def test_options_template_without_alternatives_not_streamed(self):
+        templates = {
+            'django_htcpcp_tea/options.html': '<h1>{{ alternatives|length }} options</h1>',
+        }
+        with self.settings(TEMPLATES=[{
+            'BACKEND': 'django.template.backends.django.DjangoTemplates',
+            'OPTIONS': {
+                'loaders': [
+                    ('django.template.loaders.locmem.Loader', templates),
+                    'django.template.loaders.app_directories.Loader',
+                ],
+            },
+        }]):
+            response = self.client.brew('/', data='start')
+        self.assertFalse(response.streaming)
+        self.assertContains(response, b'<h1>8 options</h1>', status_code=300)
+        self.assertIn('Alternates', response)
+
+
+@override_settings(HTCPCP_POT_SESSIONS=False)
+class ViewContentNegotiationTests(BaseViewTests):
+
+    def test_brew_tea_start_json(self):
+        response = self.client.brew(
+            make_tea_url(self.pot, self.supported_tea),
+            content_type=HTCPCP_TEA_CONTENT,
+            data='start',
+            HTTP_ACCEPT='application/json',
+            HTTP_ACCEPT_ADDITIONS='Cream',
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(response.templates, [])
+        self.assertEqual(response.json(), {
+            'pot': {'id': self.pot.id, 'name': self.pot.name},
+            'beverage': '{} Tea'.format(self.supported_tea.slug.capitalize()),
+            'additions': [{'name': 'Cream', 'type': 'Milk'}],
+        })
+
+    def test_brew_no_pot_json(self):
+        response = self.client.brew('/', data='start', HTTP_ACCEPT='application/json, */*')
+        self.assertEqual(response.status_code, 300)
+        self.assertEqual(
+            response.json()['alternatives'],
+            [{'uri': uri, 'type': content_type}
+             for uri, content_type in utils.build_alternates()],
+        )
+        self.assertIn('Alternates', response)
+
+    @override_settings(HTCPCP_STREAM_OPTIONS=True)
+    def test_brew_no_pot_json_not_streamed(self):
+        response = self.client.brew('/', data='start', HTTP_ACCEPT='application/json')
+        self.assertFalse(response.streaming)
+        self.assertIn('alternatives', response.json())
+
+    def test_error_reason_json(self):
+        response = self.client.brew(
+            make_tea_url(self.pot, self.unsupported_tea),
+            content_type=HTCPCP_TEA_CONTENT,
+            data='start',
+            HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {
+            'error_reason': '{} is not available for this pot'.format(
+                self.unsupported_tea.slug.capitalize()
+            ),
+        })
+
+    def test_forbidden_combination_json(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(),
+            data='start',
+            HTTP_ACCEPT='application/json',
+            HTTP_ACCEPT_ADDITIONS='Cream, Skim',
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertIn(
+            "You can't have both cream and skim milk!",
+            response.json()['matched_combinations'],
+        )
+
+    def test_teapot_json(self):
+        response = self.client.brew(
+            Pot.objects.get(pk=3).get_absolute_url(),
+            data='start',
+            HTTP_ACCEPT='application/json',
+        )
+        self.assertEqual(response.status_code, 418)
+        self.assertEqual(response.json(), {})
+
+    def test_html_preferred(self):
+        for accept in ['text/html, application/json', '*/*', 'application/json;q=0.5, */*']:
+            response = self.client.brew('/', data='start', HTTP_ACCEPT=accept)
+            self.assertTemplateUsed(response, 'django_htcpcp_tea/options.html')
+
+    def test_minimal_body(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(),
+            data='start',
+            HTTP_ACCEPT='application/json',
+            HTTP_PREFER='return=minimal',
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Preference-Applied'], 'return=minimal')
+        self.assertIn('Alternates', response)
+
+    def test_etag_differs_between_representations(self):
+        etags = set()
+        for extra in [{}, {'HTTP_ACCEPT': 'application/json'}, {'HTTP_PREFER': 'return=minimal'}]:
+            for path, content_type in [('/', HTCPCP_COFFEE_CONTENT), (self.pot.get_absolute_url(), HTCPCP_TEA_CONTENT)]:
+                response = self.client.brew(path, content_type=content_type, data='start', **extra)
+                self.assertEqual(response.status_code, 300)
+                etags.add(response['ETag'])
+        self.assertEqual(len(etags), 6)
+
+    def test_etag_of_other_representation_not_matched(self):
+        html_etag = self.client.brew('/', data='start')['ETag']
+        response = self.client.brew(
+            '/', data='start', HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=html_etag
+        )
+        self.assertEqual(response.status_code, 300)
+        json_etag = response['ETag']
+        self.assertNotEqual(json_etag, html_etag)
+
+        response = self.client.brew(
+            '/', data='start', HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=json_etag
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], json_etag)
+
+        response = self.client.brew(
+            '/', data='start', HTTP_PREFER='return=minimal', HTTP_IF_NONE_MATCH=json_etag
+        )
+        self.assertEqual(response.status_code, 300)
+
+    @override_settings(HTCPCP_CACHE_ALTERNATES=True)
+    def test_etag_of_other_representation_not_matched_for_pot(self):
+        html_etag = self.client.brew(
+            self.pot.get_absolute_url(), content_type=HTCPCP_TEA_CONTENT, data='start'
+        )['ETag']
+        response = self.client.brew(
+            self.pot.get_absolute_url(),
+            content_type=HTCPCP_TEA_CONTENT,
+            data='start',
+            HTTP_ACCEPT='application/json',
+            HTTP_IF_NONE_MATCH=html_etag,
+        )
+        self.assertEqual(response.status_code, 300)
+
+    def test_vary(self):
+        response = self.client.brew(self.pot.get_absolute_url(), data='start')
+        self.assertEqual(response['Vary'], 'Accept, Prefer')
+
+    @override_settings(HTCPCP_RESPONSE_CONTENT_TYPE='message/coffeepot')
+    def test_json_content_type_not_overridden(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(), data='start', HTTP_ACCEPT='application/json'
+        )
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    @override_settings(HTCPCP_NEGOTIATE_CONTENT=False)
+    def test_negotiation_disabled(self):
+        response = self.client.brew(
+            self.pot.get_absolute_url(),
+            data='start',
+            HTTP_ACCEPT='application/json',
+            HTTP_PREFER='return=minimal',
+        )
+        self.assertTemplateUsed(response, 'django_htcpcp_tea/brewing.html')
+        self.assertFalse(response.has_header('Vary'))
+
+
 @override_settings(HTCPCP_POT_SESSIONS=True)
 class ViewSessionsTests(BaseViewTests):
 
@@ -261,6 +714,13 @@ class ViewSessionsTests(BaseViewTests):
         )
         self.assertContains(response, b'Brewing', status_code=202)
 
+    def test_busy_pot_retry_after(self):
+        brew_durations.reset()
+        self.client.brew(self.pot.get_absolute_url(), data='start')
+        response = self.client.brew(self.pot.get_absolute_url(), data='start')
+        self.assertContains(response, b'Pot is busy', status_code=503)
+        self.assertIn(int(response['Retry-After']), range(59, 61))
+
     def test_coffee_cycle_with_milk(self):
         # Start brewing a beverage with milk addition
         response = self.client.brew(
@@ -351,3 +811,291 @@ class ViewSessionsTests(BaseViewTests):
             self.assertIn(addition, response.content)
 
         self.assertNotIn(b'Raspberry', response.content)
+
+
+@override_settings(
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.CachePotStateBackend',
+)
+class ViewCachePotStateTests(ViewSessionsTests):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_state_not_stored_in_session(self):
+        self.client.brew(self.pot.get_absolute_url(), data='start')
+        self.assertNotIn('htcpcp_pot_{}'.format(self.pot.id), self.client.session)
+
+    def test_state_shared_between_clients(self):
+        self.client.brew(self.pot.get_absolute_url(), data='start')
+        response = self.client_class().brew(self.pot.get_absolute_url(), data='start')
+        self.assertContains(response, b'Pot is busy', status_code=503)
+
+
+@override_settings(
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.LocMemPotStateBackend',
+)
+class ViewLocMemPotStateTests(ViewSessionsTests):
+
+    def setUp(self):
+        super().setUp()
+        get_pot_state_backend().clear()
+
+    def test_concurrent_state_changes(self):
+        backend = get_pot_state_backend()
+        with mock.patch.object(backend, 'compare_and_set', return_value=False) as cas:
+            response = self.client.brew(self.pot.get_absolute_url(), data='start')
+        self.assertContains(response, b'Please try again', status_code=503)
+        self.assertEqual(cas.call_count, 3)
+
+
+@override_settings(
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.LocMemPotStateBackend',
+    HTCPCP_BREW_QUEUE_SIZE=1,
+)
+class ViewBrewQueueTests(BaseViewTests):
+
+    def setUp(self):
+        super().setUp()
+        get_pot_state_backend().clear()
+        brew_durations.reset()
+        self.url = self.pot.get_absolute_url()
+
+    def test_beverage_queued_when_pot_busy(self):
+        self.client.brew(self.url, data='start')
+        response = self.client.brew(
+            make_tea_url(self.pot, self.supported_tea),
+            content_type=HTCPCP_TEA_CONTENT,
+            data='start',
+        )
+        self.assertContains(response, b'number 1 in the queue', status_code=202)
+        self.assertIn(response.context['estimated_wait'], range(59, 61))
+
+    def test_queue_bounded(self):
+        self.client.brew(self.url, data='start')
+        self.client.brew(self.url, data='start')
+        response = self.client.brew(self.url, data='start')
+        self.assertContains(response, b'Pot is busy', status_code=503)
+        self.assertIn(int(response['Retry-After']), range(119, 121))
+
+    def test_queued_beverage_brewed_when_pot_finishes(self):
+        self.client.brew(self.url, data='start')
+        self.client.brew(self.url, data='start', HTTP_ACCEPT_ADDITIONS='Cream')
+
+        response = self.client.brew(self.url, data='stop')
+        self.assertContains(response, b'Finished', status_code=201)
+        self.assertEqual(response.context['additions'], [])
+
+        # The queued beverage is now brewing, and requires milk
+        response = self.client.brew(self.url, data='stop')
+        self.assertContains(response, b'Pouring', status_code=200)
+        response = self.client.when(self.url, data='stop')
+        self.assertContains(response, b'Finished', status_code=201)
+
+        response = self.client.brew(self.url, data='stop')
+        self.assertContains(response, b'No beverage is being brewed', status_code=400)
+
+    def test_observed_brew_durations_used(self):
+        for duration in (10, 30):
+            with mock.patch('django_htcpcp_tea.views._elapsed', return_value=duration):
+                self.client.brew(self.url, data='start')
+                self.client.brew(self.url, data='stop')
+        self.assertEqual(brew_durations.estimate, 14)
+
+
+@override_settings(
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.LocMemPotStateBackend',
+    HTCPCP_INDEX_DISPATCH='least-busy',
+)
+class ViewIndexDispatchTests(BaseViewTests):
+
+    def setUp(self):
+        super().setUp()
+        get_pot_state_backend().clear()
+
+    def test_idle_pot_chosen(self):
+        response = self.client.brew('/', data='start')
+        self.assertContains(response, b'Brewing', status_code=202)
+        self.assertEqual(response['Content-Location'], '/pot-1/')
+
+        response = self.client.brew('/', data='start')
+        self.assertContains(response, b'Brewing', status_code=202)
+        self.assertEqual(response['Content-Location'], '/pot-2/')
+
+    def test_pot_supporting_additions_chosen(self):
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Rum')
+        self.assertContains(response, b'Brewing', status_code=202)
+        self.assertEqual(response['Content-Location'], '/pot-2/')
+
+    def test_busy_pot_used_when_all_busy(self):
+        for _ in range(2):
+            self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Rum')
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Rum')
+        self.assertContains(response, b'Pot is busy', status_code=503)
+        self.assertEqual(response['Content-Location'], '/pot-2/')
+
+    def test_options_returned_when_no_pot_capable(self):
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Tea-Leaves')
+        self.assertEqual(response.status_code, 300)
+        self.assertNotIn('Content-Location', response)
+
+    def test_tea_not_dispatched(self):
+        response = self.client.brew('/', content_type=HTCPCP_TEA_CONTENT, data='start')
+        self.assertEqual(response.status_code, 300)
+        self.assertNotIn('Content-Location', response)
+
+    @override_settings(HTCPCP_INDEX_DISPATCH='round-robin')
+    def test_round_robin(self):
+        chosen = {
+            self.client.brew('/', data='start')['Content-Location']
+            for _ in range(3)
+        }
+        self.assertEqual(chosen, {'/pot-1/', '/pot-2/', '/pot-4/'})
+
+    @override_settings(HTCPCP_INDEX_DISPATCH='two-choices')
+    def test_two_choices(self):
+        # Of two capable pots, the idle one is always one of the two choices
+        chosen = {
+            self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Cream')['Content-Location']
+            for _ in range(2)
+        }
+        self.assertEqual(chosen, {'/pot-2/', '/pot-4/'})
+
+    @override_settings(HTCPCP_CATALOG_SNAPSHOT=True)
+    def test_catalog_snapshot(self):
+        response = self.client.brew('/', data='start', HTTP_ACCEPT_ADDITIONS='Rum')
+        self.assertEqual(response['Content-Location'], '/pot-2/')
+
+    @override_settings(
+        HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.DatabasePotStateBackend',
+    )
+    def test_pot_states_read_at_once(self):
+        Pot.objects.bulk_create(
+            Pot(name='Pot {}'.format(i), brew_coffee=True) for i in range(100)
+        )
+        request = RequestFactory().generic('BREW', '/')
+        backend = get_pot_state_backend()
+        for pot in Pot.objects.filter(brew_coffee=True)[:50]:
+            backend.compare_and_set(request, pot.pk, None, {'beverage': 'coffee'})
+        for strategy in ('least-busy', 'round-robin', 'two-choices'):
+            with self.subTest(strategy=strategy), \
+                    override_settings(HTCPCP_INDEX_DISPATCH=strategy), \
+                    CaptureQueriesContext(connection) as queries:
+                self.assertIsNotNone(choose_coffee_pot(request, ()))
+            state_queries = [q for q in queries if 'potstate' in q['sql']]
+            self.assertEqual(len(state_queries), 1)
+
+    @override_settings(HTCPCP_INDEX_DISPATCH='fastest')
+    def test_unknown_strategy(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.client.brew('/', data='start')
+
+
+class BrewTokenClient(HTCPCPClient):
+    """Test client that echoes the last brew token issued by the server."""
+
+    brew_token = None
+
+    def request(self, **request):
+        if self.brew_token:
+            request.setdefault('HTTP_BREW_TOKEN', self.brew_token)
+        response = super().request(**request)
+        if 200 <= response.status_code < 300:
+            self.brew_token = response.get('Brew-Token')
+        return response
+
+
+@override_settings(
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.SignedTokenPotStateBackend',
+)
+class ViewSignedTokenPotStateTests(ViewSessionsTests):
+    client_class = BrewTokenClient
+
+    def test_state_returned_as_token(self):
+        response = self.client.brew(self.pot.get_absolute_url(), data='start')
+        self.assertTrue(response['Brew-Token'])
+        self.assertNotIn('htcpcp_pot_{}'.format(self.pot.id), self.client.session)
+
+    def test_state_not_shared_between_clients(self):
+        self.client.brew(self.pot.get_absolute_url(), data='start')
+        response = HTCPCPClient().brew(self.pot.get_absolute_url(), data='stop')
+        self.assertContains(response, b'No beverage is being brewed', status_code=400)
+
+    def test_tampered_token_ignored(self):
+        self.client.brew(self.pot.get_absolute_url(), data='start')
+        self.client.brew_token += 'x'
+        response = self.client.brew(self.pot.get_absolute_url(), data='stop')
+        self.assertContains(response, b'No beverage is being brewed', status_code=400)
+
+    def test_token_bound_to_pot(self):
+        self.client.brew(self.pot.get_absolute_url(), data='start')
+        response = self.client.brew('/pot-2/', data='start')
+        self.assertContains(response, b'Brewing', status_code=202)
+
+
+@override_settings(
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.DatabasePotStateBackend',
+)
+class ViewDatabasePotStateTests(ViewSessionsTests):
+
+    def test_state_shared_between_clients(self):
+        self.client.brew(self.pot.get_absolute_url(), data='start')
+        response = self.client_class().brew(self.pot.get_absolute_url(), data='start')
+        self.assertContains(response, b'Pot is busy', status_code=503)
+
+
+class PotStateConcurrencyTestsMixin:
+    """Brew from many threads at once to check for double starts and stops."""
+
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    thread_count = 8
+
+    rounds = 10
+
+    def brew_concurrently(self, url, data):
+        barrier = threading.Barrier(self.thread_count)
+
+        def brew():
+            try:
+                barrier.wait()
+                return HTCPCPClient().brew(url, data=data).status_code
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.thread_count) as executor:
+            futures = [executor.submit(brew) for _ in range(self.thread_count)]
+            return sorted(future.result() for future in futures)
+
+    def test_no_double_start(self):
+        url = Pot.objects.get(pk=4).get_absolute_url()
+        for _ in range(self.rounds):
+            statuses = self.brew_concurrently(url, 'start')
+            self.assertEqual(statuses, [202] + [503] * (self.thread_count - 1))
+
+            statuses = self.brew_concurrently(url, 'stop')
+            self.assertEqual(statuses, [201] + [400] * (self.thread_count - 1))
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.LocMemPotStateBackend',
+)
+class ViewLocMemPotStateConcurrencyTests(PotStateConcurrencyTestsMixin, TransactionTestCase):
+    pass
+
+
+@override_settings(
+    ROOT_URLCONF=__name__,
+    HTCPCP_POT_SESSIONS=True,
+    HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.DatabasePotStateBackend',
+)
+class ViewDatabasePotStateConcurrencyTests(PotStateConcurrencyTestsMixin, TransactionTestCase):
+    pass
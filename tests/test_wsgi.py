@@ -0,0 +1,120 @@
+#  Copyright (c) 2019 Brian Schubert
+#
+#  This file is distributed under the MIT License. If a copy of the
+#  MIT License was not distributed with this file, you can obtain one
+#  at https://opensource.org/licenses/MIT.
+
+from django.core import signals
+from django.db import close_old_connections
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import set_script_prefix
+from django_htcpcp_tea.wsgi import HTCPCPTeaWSGIHandler, match_htcpcp_route
+
+from .utils import HTCPCP_COFFEE_CONTENT, HTCPCP_TEA_CONTENT
+
+
+@override_settings(ROOT_URLCONF='tests.test_views', HTCPCP_POT_SESSIONS=False)
+class WSGIHandlerTests(TestCase):
+    fixtures = ['demo_pots', 'rfc_2324_additions', 'rfc_7168_teas']
+
+    def setUp(self):
+        self.passed = []
+        self.handler = HTCPCPTeaWSGIHandler(self.application)
+
+    def tearDown(self):
+        set_script_prefix('/')
+
+    def application(self, environ, start_response):
+        self.passed.append(environ['PATH_INFO'])
+        start_response('204 No Content', [])
+        return []
+
+    def call(self, method, path, data='start', content_type=HTCPCP_COFFEE_CONTENT, **extra):
+        environ = RequestFactory().generic(
+            method, path, data, content_type=content_type, **extra
+        ).environ
+        started = []
+        # Like the test client, keep the connection of the test's transaction open.
+        signals.request_started.disconnect(close_old_connections)
+        try:
+            content = b''.join(self.handler(environ, lambda *args: started.extend(args)))
+        finally:
+            signals.request_started.connect(close_old_connections)
+        status, headers = started
+        return int(status.split()[0]), dict(headers), content
+
+    def test_match_htcpcp_route(self):
+        set_script_prefix('/')
+        with override_settings(ROOT_URLCONF='tests.test_views'):
+            self.assertEqual(match_htcpcp_route('/'), {})
+            self.assertEqual(match_htcpcp_route('/pot-4/'), {'pot_designator': 4})
+            self.assertEqual(
+                match_htcpcp_route('/pot-4/earl-grey/'),
+                {'pot_designator': 4, 'tea_type': 'earl-grey'},
+            )
+            self.assertIsNone(match_htcpcp_route('/pot-x/'))
+            self.assertIsNone(match_htcpcp_route('/pot-4/earl-grey/cup/'))
+
+    def test_brew_coffee_served_directly(self):
+        status, headers, content = self.call('BREW', '/pot-4/')
+        self.assertEqual(status, 202)
+        self.assertIn(b'Brewing', content)
+        self.assertIn('Alternates', headers)
+        self.assertTrue(headers['Server'].startswith('HTCPCP-TEA'))
+        self.assertEqual(self.passed, [])
+
+    def test_brew_tea_served_directly(self):
+        status, headers, content = self.call(
+            'BREW', '/pot-4/earl-grey/', content_type=HTCPCP_TEA_CONTENT
+        )
+        self.assertEqual(status, 202)
+        self.assertIn(b'Earl-grey Tea', content)
+        self.assertEqual(self.passed, [])
+
+    def test_index_served_directly(self):
+        status, headers, content = self.call('BREW', '/')
+        self.assertEqual(status, 300)
+        self.assertEqual(self.passed, [])
+
+    def test_unknown_pot(self):
+        status, headers, content = self.call('BREW', '/pot-99/')
+        self.assertEqual(status, 404)
+        self.assertEqual(self.passed, [])
+
+    def test_invalid_htcpcp_request(self):
+        status, headers, content = self.call('WHEN', '/pot-4/', data='lemon')
+        self.assertEqual(status, 404)
+
+    def test_other_requests_passed_to_application(self):
+        self.call('GET', '/pot-4/')
+        self.call('POST', '/pot-4/')
+        self.call('BREW', '/admin/')
+        self.assertEqual(self.passed, ['/pot-4/', '/pot-4/', '/admin/'])
+
+    def test_script_name(self):
+        status, headers, content = self.call('BREW', '/pot-4/', SCRIPT_NAME='/htcpcp')
+        self.assertEqual(status, 202)
+        self.assertIn('/htcpcp/pot-1/', headers['Alternates'])
+
+    @override_settings(HTCPCP_DISABLE_CSRF=False)
+    def test_passed_to_application_without_disabled_csrf(self):
+        self.call('BREW', '/pot-4/')
+        self.assertEqual(self.passed, ['/pot-4/'])
+
+    @override_settings(HTCPCP_POT_SESSIONS=True)
+    def test_passed_to_application_with_session_state(self):
+        self.call('BREW', '/pot-4/')
+        self.assertEqual(self.passed, ['/pot-4/'])
+
+    @override_settings(
+        HTCPCP_POT_SESSIONS=True,
+        HTCPCP_POT_STATE_BACKEND='django_htcpcp_tea.pot_state.SignedTokenPotStateBackend',
+    )
+    def test_served_directly_with_brew_tokens(self):
+        status, headers, content = self.call('BREW', '/pot-4/')
+        self.assertEqual(status, 202)
+        status, headers, content = self.call(
+            'BREW', '/pot-4/', data='stop', HTTP_BREW_TOKEN=headers['Brew-Token']
+        )
+        self.assertEqual(status, 201)
+        self.assertEqual(self.passed, [])
@@ -4,8 +4,11 @@
 #  MIT License was not distributed with this file, you can obtain one
 #  at https://opensource.org/licenses/MIT.
 
+from unittest import mock
+
 import django
 from django.test import Client
+from django_htcpcp_tea import catalog, models
 
 HTCPCP_COFFEE_CONTENT = 'message/coffeepot'
 
@@ -51,5 +54,38 @@ class HTCPCPClient(Client):
         return self._htcpcp_post('WHEN', *args, **kwargs)
 
 
+class CatalogCacheMixin:
+    """
+    Cache results derived from the catalog inside the transaction of each
+    test, as they would be cached outside of any transaction.
+    """
+
+    def setUp(self):
+        super().setUp()
+        # Capability versions are reused once a test's changes are rolled back.
+        models._addition_maps.clear()
+        catalog._addition_record_maps.clear()
+        catalog._get_loaded_capability_index.cache_clear()
+        catalog.get_forbidden_combination_matcher.cache_clear()
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._in_transaction_patchers = [
+            mock.patch(target, return_value=False) for target in (
+                'django_htcpcp_tea.catalog._in_transaction',
+                'django_htcpcp_tea.models._in_transaction',
+            )
+        ]
+        for patcher in cls._in_transaction_patchers:
+            patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        for patcher in cls._in_transaction_patchers:
+            patcher.stop()
+        super().tearDownClass()
+
+
 def make_tea_url(pot, tea):
     return ''.join((pot.get_absolute_url(), tea.slug, '/'))